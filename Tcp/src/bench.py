@@ -0,0 +1,606 @@
+"""
+  Benchmarks for the TCP emulation
+
+  Runs both ends of a transfer in one process, over a pair of links
+  bound to consecutive UDP ports on localhost.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+# Python imports
+import optparse
+import os
+import Queue
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+# local imports
+from eventlink import *
+from eventtcp import *
+from link import *
+from log import *
+from tcp import *
+
+class BatchSocket(TCPSocket):
+    """ The original sender, which transmits every segment at once and
+    then resends everything that is still unacknowledged in rounds,
+    waiting a full timeout for each round.  Kept as a baseline."""
+    timeout = 1
+
+    def send(self,data):
+        self.segmentData(data)
+        ackIDs = self.sendPackets(None,True)
+        count = 0
+        while (len(ackIDs)!= 0) and (count < 5) :
+            prevIDs = len(ackIDs)
+            ackIDs = self.sendPackets(ackIDs,False)
+            if(len(ackIDs) == prevIDs):
+                count += 1
+        return len(data)
+
+    def sendPackets(self,ids,newMsg):
+        if(ids == None):
+            id = 0
+            for packet in self.packets:
+                self.link.enqueue(id,packet)
+                id += 1
+        else:
+            count = 0
+            for ackID in ids:
+                if(count < self.window):
+                    self.link.enqueue(ackID,self.packets[ackID-1])
+                else:
+                    break
+                count += 1
+        return self.recvAcks(self.timeout,newMsg)
+
+    def recvAcks(self,timeout,newMsg):
+        if(newMsg):
+            self.acks= {}
+        while(True):
+            try:
+                p = self.recvPacket(timeout)
+            except Queue.Empty:
+                break
+            if(p != None):
+                if(not self.acks.has_key(p.id)):
+                    self.acks[p.id] = p
+                if(self.checkRecvAll(self.acks,len(self.packets))):
+                    return []
+        return self.checkAcks(self.acks,len(self.packets))
+
+    def checkAcks(self,packets,total):
+        index = 1;
+        ackIDs = []
+        while (index <= total):
+            if(not packets.has_key(index)):
+                ackIDs.append(index)
+            index += 1
+        return ackIDs
+
+    def checkRecvAll(self,packets,total):
+        index = 1;
+        while (index <= total):
+            if(not packets.has_key(index)):
+                return False
+            index += 1
+        return True
+
+    def recv(self,timeout):
+        """ Receive a message, acknowledging each segment by its own
+        id."""
+        msg = ''
+        packets = {}
+        while True:
+            try:
+                p = self.recvPacket(timeout)
+            except Queue.Empty:
+                break
+            if(p == None) or (p.flags & ACK):
+                continue
+            self.makeAndSendAck(p.id,p.totalPackets)
+            if(not packets.has_key(p.id)):
+                packets[p.id] = p
+                msg += p.data
+            if(self.checkRecvAll(packets,p.totalPackets)):
+                break
+        return msg
+
+class LegacyPacket:
+    """ The original packet codec, which computes the header size for
+    every packet, concatenates the header and data, and slices the
+    string to decode it.  Kept as a baseline."""
+    def __init__(self):
+        self.sourcePort = 0
+        self.destPort = 0
+        self.len = 0
+        self.cksum = 0
+        self.flags = 0
+        self.id = 0
+        self.totalPackets = 0
+        self.data = ''
+        self.format = "!HHHHHHH"
+        self.headerlen = struct.calcsize(self.format)
+
+    def pack(self):
+        string = struct.pack(self.format,self.sourcePort,self.destPort,
+                             self.len,self.cksum,self.flags,self.id,
+                             self.totalPackets)
+        return string + self.data
+
+    def unpack(self,string):
+        (self.sourcePort,self.destPort,self.len,self.cksum,self.flags,self.id,self.totalPackets) = struct.unpack(self.format,string[0:self.headerlen])
+        self.data = string[self.headerlen:]
+
+class NullLink:
+    """ A link that discards everything sent on it."""
+    mss = 1500
+
+    def enqueue(self,id,packet):
+        pass
+
+class NullTCP:
+    """ A demultiplexer that never delivers anything."""
+    drops = {}
+
+    def bind(self,port,socket):
+        pass
+
+class StubSocket:
+    """ A socket that only counts what is sent on it."""
+    def __init__(self):
+        self.count = 0
+        self.last = None
+
+    def send(self,data):
+        self.count += 1
+        self.last = time.time()
+
+class SleepOutgoing(Outgoing):
+    """ The original transmission handler, which sleeps for each
+    packet's transmission delay in turn.  Kept as a baseline."""
+    def run(self):
+        while True:
+            id,data,queued = self.queue.get()
+            if queued > time.time():
+                time.sleep(queued - time.time())
+            trans = float(len(data)*8) / (1000*1000*self.rate)
+            time.sleep(trans)
+            self.prop_queue.put([(id,data,time.time())])
+
+class Bench:
+    """ Builds pairs of links on localhost and times transfers over
+    them."""
+    def __init__(self,port,size,tcp_size,sack=True):
+        self.port = port
+        self.size = size
+        self.tcp_size = tcp_size
+        self.sack = sack
+
+    def links(self,rate,delay,cls=Link):
+        """ Create two links of class (cls) that talk to each other.
+        Each call uses a fresh pair of ports, since links never release
+        theirs."""
+        port = self.port
+        self.port += 2
+        a = cls(size=self.size,rate=rate,delay=delay,log_name=None,
+                from_addr="localhost",from_port=port,
+                to_addr="localhost",to_port=port+1)
+        b = cls(size=self.size,rate=rate,delay=delay,log_name=None,
+                from_addr="localhost",from_port=port+1,
+                to_addr="localhost",to_port=port)
+        return a,b
+
+    def sockets(self,cls,rate,delay,congestion="newreno"):
+        """ Create a connected pair of sockets of class (cls)."""
+        a,b = self.links(rate,delay)
+        tcp_a = TCP(a)
+        tcp_a.start()
+        tcp_b = TCP(b)
+        tcp_b.start()
+        s = cls(a,tcp_a,self.tcp_size,1,1,congestion)
+        s.sack = self.sack
+        return s,cls(b,tcp_b,self.tcp_size,1,1,congestion)
+
+    def transfer(self,sender,receiver,data,limit):
+        """ Send (data) from one socket to the other.  Returns the
+        elapsed time, or None if the transfer did not finish correctly
+        within (limit) seconds."""
+        result = {}
+        def receive():
+            result['data'] = receiver.recv(limit)
+        t = threading.Thread(target=receive)
+        t.daemon = True
+        t.start()
+        start = time.time()
+        sender.send(data)
+        t.join(limit)
+        elapsed = time.time() - start
+        if len(result.get('data','')) != len(data):
+            return None
+        return elapsed
+
+    def throughput(self,rates,delays,segments,limit):
+        """ Compare the throughput of the batch and sliding window
+        senders at each rate and delay."""
+        data = "x" * (1024 * segments)
+        print "%8s %8s %12s %12s" % ("Mbps","ms","batch Mbps","window Mbps")
+        for rate in rates:
+            for delay in delays:
+                row = []
+                for cls in (BatchSocket,TCPSocket):
+                    s,r = self.sockets(cls,rate,delay)
+                    elapsed = self.transfer(s,r,data,limit)
+                    if elapsed == None:
+                        row.append("failed")
+                    else:
+                        row.append("%.3f" % (len(data)*8/elapsed/1000000))
+                print "%8.1f %8d %12s %12s" % (rate,delay,row[0],row[1])
+
+    def congestion(self,rate,delay,segments,limit):
+        """ Compare the goodput of each congestion control algorithm
+        on a link whose queue is small enough to drop packets."""
+        data = "x" * (1024 * segments)
+        print "%8s %12s %12s %8s" % ("cc","goodput Mbps","retransmits","ssthresh")
+        for name in sorted(CONGESTION.keys()):
+            s,r = self.sockets(TCPSocket,rate,delay,name)
+            elapsed = self.transfer(s,r,data,limit)
+            stats = s.stats()
+            if elapsed == None:
+                goodput = "failed"
+            else:
+                goodput = "%.3f" % (len(data)*8/elapsed/1000000)
+            print "%8s %12s %12d %8.1f" % (name,goodput,
+                                           stats["retransmissions"],
+                                           stats["ssthresh"])
+
+    def reassembly(self,counts,legacy,window):
+        """ Time how long a socket takes to reassemble messages of each
+        number of segments, delivered straight into its buffer with the
+        order shuffled within each (window) of segments.  The original
+        receiver is only timed for messages of up to (legacy)
+        segments, since it takes quadratic time."""
+        print "%10s %12s %12s" % ("segments","batch s","slots s")
+        for count in counts:
+            r = TCPSocket(NullLink(),NullTCP(),0,1,1)
+            r.segmentData("x" * (r.packetsize * count))
+            ids = range(count)
+            random.seed(1)
+            for i in range(0,count,window):
+                chunk = ids[i:i+window]
+                random.shuffle(chunk)
+                ids[i:i+window] = chunk
+            packets = []
+            for i in ids:
+                u = TCPPacket()
+                u.unpack(r.packets[i])
+                packets.append(u)
+            row = []
+            for cls in (BatchSocket,TCPSocket):
+                if (cls == BatchSocket) and (count > legacy):
+                    row.append("skipped")
+                    continue
+                r = cls(NullLink(),NullTCP(),0,1,1)
+                for packet in packets:
+                    r.buffer.put(packet)
+                start = time.time()
+                data = r.recv(0)
+                elapsed = time.time() - start
+                if len(data) != r.packetsize * count:
+                    row.append("failed")
+                else:
+                    row.append("%.3f" % elapsed)
+            print "%10d %12s %12s" % (count,row[0],row[1])
+
+    def codec(self,count):
+        """ Measure how many packets per second the original and
+        current codecs encode and decode.  The original decoded every
+        packet twice, once to demultiplex it and once in the socket."""
+        r = TCPSocket(NullLink(),NullTCP(),0,1,1)
+        data = "x" * (r.packetsize * count)
+        print "%8s %14s %14s" % ("codec","encode pkt/s","decode pkt/s")
+        # original: slice the message and pack each segment
+        start = time.time()
+        packets = []
+        for i in range(count):
+            u = LegacyPacket()
+            u.data = data[i*r.packetsize:(i+1)*r.packetsize]
+            u.len = len(u.data) + 8
+            u.id = i + 1
+            u.totalPackets = count
+            packets.append(u.pack())
+        encode = count/(time.time() - start)
+        start = time.time()
+        for packet in packets:
+            LegacyPacket().unpack(packet)
+            LegacyPacket().unpack(packet)
+        decode = count/(time.time() - start)
+        print "%8s %14d %14d" % ("original",encode,decode)
+        # current: precompiled headers, and one decode per packet
+        start = time.time()
+        r.segmentData(data)
+        encode = count/(time.time() - start)
+        start = time.time()
+        for packet in r.packets:
+            TCPPacket().unpack(packet)
+        decode = count/(time.time() - start)
+        print "%8s %14d %14d" % ("current",encode,decode)
+
+    def timing(self,pairs,count,rate,delay,limit):
+        """ Compare how accurately threaded and event driven links
+        time packets when many of them run in one process.  Each of
+        (pairs) pairs of links carries a burst of (count) packets, and
+        every arrival is compared with the time the link model says it
+        should arrive: after its own and all earlier transmission
+        delays plus the propagation delay."""
+        data = "x" * 1000
+        trans = float(len(data)*8) / (1000*1000*rate)
+        print "%10s %8s %10s %12s %12s" % ("link","threads","delivered",
+                                           "mean err ms","max err ms")
+        for cls in (EventLink,Link):
+            threads = threading.active_count()
+            links = [self.links(rate,delay,cls) for i in range(pairs)]
+            threads = threading.active_count() - threads
+            errors = []
+            def collect(link,start):
+                # wait without a timeout, since a timed wait polls
+                for i in range(count):
+                    packet = link.dequeue(None)
+                    id = struct.unpack("!I",packet[:4])[0]
+                    expected = start + (id + 1)*trans + float(delay)/1000
+                    errors.append(abs(time.time() - expected))
+            collectors = []
+            for a,b in links:
+                start = time.time()
+                for i in range(count):
+                    a.enqueue(i,struct.pack("!I",i) + data[4:])
+                t = threading.Thread(target=collect,args=(b,start))
+                t.daemon = True
+                t.start()
+                collectors.append(t)
+            for t in collectors:
+                t.join(limit)
+            if errors:
+                mean = 1000*sum(errors)/len(errors)
+                worst = 1000*max(errors)
+            else:
+                mean = worst = 0
+            print "%10s %8d %10d %12.3f %12.3f" % (cls.__name__,threads,
+                                                   len(errors),mean,worst)
+
+    def density(self,connections,count,rate,delay,limit):
+        """ Compare the threads and CPU time used by threaded and event
+        driven TCP when (connections) connections share one pair of
+        links, each sending a message of (count) segments at the same
+        time."""
+        data = "x" * (1024 * count)
+        print "%8s %8s %10s %10s %10s" % ("tcp","threads","completed",
+                                          "cpu s","wall s")
+        for name in ("event","thread"):
+            threads = threading.active_count()
+            cpu = sum(os.times()[:2])
+            start = time.time()
+            if name == "event":
+                done = self.events(connections,data,rate,delay,limit)
+            else:
+                done = self.threads(connections,data,rate,delay,limit)
+            wall = time.time() - start
+            cpu = sum(os.times()[:2]) - cpu
+            print "%8s %8d %10d %10.3f %10.3f" % (name,done[1] - threads,
+                                                  done[0],cpu,wall)
+
+    def events(self,connections,data,rate,delay,limit):
+        """ Run the density benchmark with event driven sockets.
+        Returns the number of messages received intact and the peak
+        number of threads."""
+        a,b = self.links(rate,delay,EventLink)
+        tcp_a = EventTCP(a)
+        tcp_b = EventTCP(b)
+        finished = threading.Event()
+        result = [0,0]
+        def received(message):
+            if len(message) == len(data):
+                result[0] += 1
+            result[1] += 1
+            if result[1] == connections:
+                finished.set()
+        for port in range(1,connections + 1):
+            s = EventTCPSocket(a,tcp_a,self.tcp_size,port,port)
+            s.sack = self.sack
+            r = EventTCPSocket(b,tcp_b,self.tcp_size,port,port)
+            r.recv(received)
+            s.send(data)
+        threads = threading.active_count()
+        finished.wait(limit)
+        return result[0],threads
+
+    def threads(self,connections,data,rate,delay,limit):
+        """ Run the density benchmark with threaded sockets, which need
+        a thread for each sender and each receiver."""
+        a,b = self.links(rate,delay)
+        tcp_a = TCP(a)
+        tcp_a.start()
+        tcp_b = TCP(b)
+        tcp_b.start()
+        results = []
+        def receive(r):
+            results.append(len(r.recv(limit)) == len(data))
+        workers = []
+        for port in range(1,connections + 1):
+            s = TCPSocket(a,tcp_a,self.tcp_size,port,port)
+            s.sack = self.sack
+            r = TCPSocket(b,tcp_b,self.tcp_size,port,port)
+            for target,args in ((receive,(r,)),(s.send,(data,))):
+                t = threading.Thread(target=target,args=args)
+                t.daemon = True
+                t.start()
+                workers.append(t)
+        threads = threading.active_count()
+        end = time.time() + limit
+        for t in workers:
+            t.join(max(end - time.time(),0))
+        return results.count(True),threads
+
+    def pps(self,count,limit):
+        """ Measure how many packets per second a link can take in from
+        loopback, and the CPU time it spends on each, reading one
+        packet each time the socket becomes readable, as the original
+        link did, and reading in batches.  A separate process sends
+        (count) packets as fast as it can, so the kernel drops what
+        the link does not keep up with."""
+        data = "x" * 1000
+        print "%8s %10s %12s %12s" % ("batch","received","pkt/s","cpu us/pkt")
+        for batch in (1,64):
+            port = self.port
+            self.port += 2
+            link = Link(size=count + 1,rate=1000,delay=0,log_name=None,
+                        from_addr="localhost",from_port=port+1,
+                        to_addr="localhost",to_port=port,batch=batch)
+            sender = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            sender.bind(("localhost",port))
+            sender.connect(("localhost",port+1))
+            cpu = sum(os.times()[:2])
+            start = time.time()
+            child = os.fork()
+            if child == 0:
+                for i in xrange(count):
+                    try:
+                        sender.send(data)
+                    except socket.error:
+                        pass
+                # mark the end of the stream once the link has caught up
+                time.sleep(0.1)
+                sender.send("end")
+                os._exit(0)
+            received = 0
+            last = start
+            done = False
+            while not done and time.time() < start + limit:
+                packets = link.dequeue_batch(None,count)
+                if packets[-1] == "end":
+                    packets.pop()
+                    done = True
+                if packets:
+                    received += len(packets)
+                    last = time.time()
+            os.waitpid(child,0)
+            cpu = sum(os.times()[:2]) - cpu
+            print "%8d %10d %12d %12.1f" % (batch,received,
+                                           received/(last - start),
+                                           1000000*cpu/max(received,1))
+    def pacing(self,rates,seconds,limit):
+        """ Measure the rate that the original and current transmission
+        handlers achieve for each link rate, by queueing enough packets
+        of the link's maximum size to keep it busy for (seconds) and
+        timing them out of a socket that does nothing."""
+        data = "x" * 1500
+        print "%10s %10s %14s %14s" % ("Mbps","packets","sleep Mbps",
+                                       "paced Mbps")
+        for rate in rates:
+            count = int(rate*1000*1000*seconds/(len(data)*8))
+            row = []
+            for cls in (SleepOutgoing,Outgoing):
+                socket = StubSocket()
+                queue = PacketQueue()
+                handler = cls(socket=socket,queue=queue,log=Log(None),
+                              rate=rate,delay=0)
+                # queue every packet before the link starts, allowing
+                # plenty of time to do so
+                start = time.time() + 0.1 + count*0.00001
+                for id in xrange(count):
+                    queue.put((id,data,start))
+                handler.start()
+                end = start + seconds + limit
+                while (socket.count < count) and (time.time() < end):
+                    time.sleep(0.01)
+                if socket.count < count:
+                    row.append("failed")
+                else:
+                    elapsed = socket.last - start
+                    row.append("%.3f" % (count*len(data)*8/elapsed/1000000))
+            print "%10.1f %10d %14s %14s" % (rate,count,row[0],row[1])
+
+
+def parse_options():
+    """ Parse options. """
+    parser = optparse.OptionParser(usage = "%prog [options] throughput|congestion|reassembly|codec|timing|density|pps|pacing",
+                                   version = "%prog 0.1")
+
+    parser.add_option("","--port",type="int",dest="port",
+                      default=6000,
+                      help="first UDP port to use on localhost")
+    parser.add_option("","--rates",type="string",dest="rates",
+                      default="1,10,50",
+                      help="comma separated link rates in Mbps")
+    parser.add_option("","--delays",type="string",dest="delays",
+                      default="10,50,100",
+                      help="comma separated propagation delays in ms")
+    parser.add_option("","--size",type="int",dest="size",
+                      default=100,
+                      help="size of the link queues")
+    parser.add_option("","--tcp-size",type="int",dest="tcp_size",
+                      default=100,
+                      help="size of the TCP queues")
+    parser.add_option("","--segments",type="int",dest="segments",
+                      default=500,
+                      help="number of segments in each transfer")
+    parser.add_option("","--limit",type="int",dest="limit",
+                      default=60,
+                      help="seconds to allow for each transfer")
+    parser.add_option("","--counts",type="string",dest="counts",
+                      default="10000,100000",
+                      help="comma separated message sizes in segments")
+    parser.add_option("","--legacy",type="int",dest="legacy",
+                      default=10000,
+                      help="largest message to time with the batch receiver")
+    parser.add_option("","--pairs",type="int",dest="pairs",
+                      default=100,
+                      help="pairs of links for the timing benchmark")
+    parser.add_option("","--connections",type="int",dest="connections",
+                      default=200,
+                      help="concurrent connections for the density benchmark")
+    parser.add_option("","--no-sack",action="store_false",dest="sack",
+                      default=True,
+                      help="ignore selective acknowledgements when sending")
+
+    (options,args) = parser.parse_args()
+    return options,args
+
+if __name__ == '__main__':
+    options,args = parse_options()
+    b = Bench(options.port,options.size,options.tcp_size,options.sack)
+    if not args or args[0] == "throughput":
+        rates = [float(x) for x in options.rates.split(',')]
+        delays = [int(x) for x in options.delays.split(',')]
+        b.throughput(rates,delays,options.segments,options.limit)
+    elif args[0] == "congestion":
+        rate = float(options.rates.split(',')[0])
+        delay = int(options.delays.split(',')[0])
+        b.congestion(rate,delay,options.segments,options.limit)
+    elif args[0] == "reassembly":
+        counts = [int(x) for x in options.counts.split(',')]
+        b.reassembly(counts,options.legacy,100)
+    elif args[0] == "timing":
+        rate = float(options.rates.split(',')[0])
+        delay = int(options.delays.split(',')[0])
+        b.timing(options.pairs,options.segments/50,rate,delay,options.limit)
+    elif args[0] == "density":
+        rate = float(options.rates.split(',')[0])
+        delay = int(options.delays.split(',')[0])
+        b.density(options.connections,options.segments/50,rate,delay,
+                  options.limit)
+    elif args[0] == "pps":
+        b.pps(options.segments*100,options.limit)
+    elif args[0] == "pacing":
+        rates = [float(x) for x in options.rates.split(',')]
+        b.pacing(rates,2,options.limit)
+    elif args[0] == "codec":
+        b.codec(options.segments*100)
+    else:
+        print "Unknown benchmark",args[0]
+        sys.exit(1)
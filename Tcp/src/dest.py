@@ -8,11 +8,16 @@
 """
 
 # Python imports
+import hashlib
+import mmap
 import optparse
 import sys
 
 # local imports
+from impair import *
 from link import *
+from metrics import *
+from queues import *
 from tcp import *
 
 class Dest:
@@ -24,11 +29,110 @@ class Dest:
         self.socket2 = TCPSocket(link,self.tcp,size,2,2)
 
     def start(self):
-        data = self.socket1.recv(None)
-        print data
+        # write the file out as it arrives, instead of all at the end
+        self.socket1.recvStream(sys.stdout)
+        print
         data = self.socket2.recv(None)
         print data
 
+    def recvFile(self,name,packetsize):
+        """ Receive a file sent by Source.sendFile into the file (name),
+        writing each segment into a memory map of the file at its
+        offset as soon as it arrives.  The segment size is learned from
+        the segments unless (packetsize) is given.  Returns whether the
+        checksum of the file matches the one sent."""
+        out = MappedFile(name,packetsize)
+        try:
+            self.socket1.recvSegments(out.place)
+        except ValueError,e:
+            out.close()
+            print "can not receive the file:",e
+            return False
+        digest = out.close()
+        fields = self.socket2.recv(None).split()
+        # let the last ACKs out before the program ends
+        self.link.idle()
+        if (len(fields) == 2) and (fields[0] == "md5") and \
+           (fields[1] == digest):
+            print "received %d bytes, checksum ok" % out.length
+            return True
+        print "received %d bytes, checksum MISMATCH" % out.length
+        return False
+
+
+class MappedFile:
+    """ A file written through a memory map at the offsets of the
+    segments that carry it.  Every segment but the last is full, so
+    if the segment size is not given it is taken from the first of
+    those to arrive, and the last segment is held until then."""
+    def __init__(self,name,packetsize=None):
+        self.fh = open(name,'w+b')
+        self.packetsize = packetsize
+        self.held = None
+        self.map = None
+        self.size = 0
+        self.length = 0
+
+    def place(self,id,total,data):
+        """ Write segment (id) of (total), or of an unknown number if
+        total is 0, at its offset.  Raises ValueError if the segments
+        do not have the size given, or if the size can not be learned
+        because the number of segments is unknown."""
+        if not data:
+            return
+        if total and (id < total):
+            if self.packetsize == None:
+                self.packetsize = len(data)
+                if self.held != None:
+                    self.write(*self.held)
+                    self.held = None
+            elif len(data) != self.packetsize:
+                raise ValueError("segments are %d bytes, not %d" %
+                                 (len(data),self.packetsize))
+        elif self.packetsize == None:
+            if not total:
+                raise ValueError("the segment size of a stream of unknown "
+                                 "length must be given")
+            if total > 1:
+                self.held = (id,total,data)
+                return
+            self.packetsize = len(data)
+        elif len(data) > self.packetsize:
+            raise ValueError("segments are %d bytes, not %d" %
+                             (len(data),self.packetsize))
+        self.write(id,total,data)
+
+    def write(self,id,total,data):
+        """ Write segment (id) of (total) at its offset.  The file is
+        preallocated for all of the segments if their number is known,
+        and grown by doubling otherwise."""
+        offset = (id - 1)*self.packetsize
+        end = offset + len(data)
+        if end > self.size:
+            self.grow(max(end,total*self.packetsize,2*self.size))
+        self.map[offset:end] = data
+        self.length = max(self.length,end)
+
+    def grow(self,size):
+        if self.map == None:
+            self.fh.truncate(size)
+            self.map = mmap.mmap(self.fh.fileno(),size)
+        else:
+            self.map.resize(size)
+        self.size = size
+
+    def close(self):
+        """ Cut the file to the data received, close it, and return its
+        MD5 checksum."""
+        digest = hashlib.md5()
+        if self.map != None:
+            digest.update(buffer(self.map,0,self.length))
+            self.map.flush()
+            self.map.close()
+        self.fh.truncate(self.length)
+        self.fh.close()
+        return digest.hexdigest()
+
 
 def parse_options():
     """ Parse options. """
@@ -52,13 +156,22 @@ def parse_options():
                       help="size of the link queues")
     parser.add_option("","--log",type="string",dest="log",
                       default=None,
-                      help="log file")
+                      help="log file, or a binary trace if it ends in .trace")
+    add_queue_options(parser)
+    add_impairment_options(parser)
+    add_metrics_options(parser)
     parser.add_option("","--tcp-size",type="int",dest="tcp_size",
                       default=100,
                       help="size of the TCP queues")
     parser.add_option("","--verbose",action="store_true",dest="verbose",
                       default=False,
                       help="print statistics")
+    parser.add_option("","--out",type="string",dest="out",
+                      default=None,
+                      help="write a file sent with source.py --file here and verify its checksum")
+    parser.add_option("","--packet-size",type="int",dest="packet_size",
+                      default=None,
+                      help="the --packet-size of the source, for --out; learned from the segments by default")
 
     (options,args) = parser.parse_args()
     return options
@@ -77,8 +190,14 @@ if __name__ == '__main__':
     l = Link(size=options.size,rate=options.rate,delay=options.delay,
              log_name=options.log,
              from_addr=from_addr,from_port=from_port,
-             to_addr=to_addr,to_port=to_port)
+             to_addr=to_addr,to_port=to_port,queue=create_queue(options),
+             impair=create_impairments(options),
+             metrics=create_metrics(options))
 
     # create and run destination
     d = Dest(l,options.tcp_size)
-    d.start()
+    if options.out != None:
+        if not d.recvFile(options.out,options.packet_size):
+            sys.exit(1)
+    else:
+        d.start()
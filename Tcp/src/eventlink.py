@@ -0,0 +1,286 @@
+"""
+  Implements emulated links driven by a single event loop
+
+  The Link class uses three threads per link and models every delay
+  with time.sleep.  Here one EventLoop thread emulates any number of
+  links: transmission and propagation are timed events on a heap, and
+  incoming packets are read from all of the UDP sockets with select.
+  Since propagation is just an event, any number of packets can be
+  in flight on a link at once.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import errno
+import heapq
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+
+from link import *
+from log import *
+from metrics import *
+
+__all__ = [ "EventLoop","EventLink","default_loop" ]
+
+class EventLoop(threading.Thread):
+    """
+    Runs timed events in order and reads from the sockets of the links
+    that are added to it.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        threading.Thread.daemon = True
+        # heap of (time,sequence,function,args)
+        self.events = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        # links to read from, by socket file number
+        self.links = {}
+        # writing to this pipe wakes the loop from select
+        self.wakeup_in,self.wakeup_out = os.pipe()
+
+    def clock(self):
+        """ Return the current time, in seconds."""
+        return time.time()
+
+    def schedule(self,when,function,*args):
+        """ Call function(*args) at time (when).  May be called from
+        any thread."""
+        self.lock.acquire()
+        self.sequence += 1
+        heapq.heappush(self.events,(when,self.sequence,function,args))
+        first = self.events[0][1] == self.sequence
+        self.lock.release()
+        # the loop may be waiting for a later event
+        if first and threading.current_thread() is not self:
+            self.wakeup()
+
+    def add(self,link):
+        """ Start reading packets for (link) from its socket."""
+        self.lock.acquire()
+        self.links[link.socket.fileno()] = link
+        self.lock.release()
+        self.wakeup()
+
+    def wakeup(self):
+        os.write(self.wakeup_out,'x')
+
+    def run(self):
+        """ Wait for the next event or an incoming packet, whichever
+        comes first, and handle it.  This method is activated by a
+        call to start() and runs in a separate thread."""
+        while True:
+            self.lock.acquire()
+            if self.events:
+                timeout = max(self.events[0][0] - self.clock(),0)
+            else:
+                timeout = None
+            files = self.links.keys() + [self.wakeup_in]
+            self.lock.release()
+            try:
+                readable,writable,errors = select.select(files,[],[],timeout)
+            except select.error:
+                continue
+            for file in readable:
+                if file == self.wakeup_in:
+                    os.read(self.wakeup_in,4096)
+                else:
+                    self.links[file].receive()
+            self.run_events()
+
+    def run_events(self):
+        """ Run every event that is due."""
+        now = self.clock()
+        while True:
+            self.lock.acquire()
+            if not self.events or self.events[0][0] > now:
+                self.lock.release()
+                return
+            when,sequence,function,args = heapq.heappop(self.events)
+            self.lock.release()
+            function(*args)
+
+
+# loop shared by every link that is not given one
+_default_loop = None
+_default_lock = threading.Lock()
+
+def default_loop():
+    """ Return the shared event loop, starting it on first use."""
+    global _default_loop
+    _default_lock.acquire()
+    if _default_loop == None:
+        _default_loop = EventLoop()
+        _default_loop.start()
+    _default_lock.release()
+    return _default_loop
+
+
+class EventLink(Link):
+    """
+    A virtual link between two machines, using UDP to transmit
+    packets, that is emulated by an EventLoop instead of its own
+    threads.  It has the same interface as Link.
+    """
+    def __init__(self,size,rate,delay,log_name,
+                 from_addr,from_port,to_addr,to_port,loop=None,queue=None,
+                 impair=None,metrics=None):
+        """
+        Initialize the link, with the same parameters as Link, plus:
+        * loop       the EventLoop to run on; the shared one by default
+        * queue      the queue discipline for outgoing packets, as for
+                     Link
+        * impair     the Impairments to apply to packets, as for Link
+        * metrics    the Registry to keep the link's metrics in, as for
+                     Link
+        """
+        self.size = size
+        self.rate = rate
+        self.delay = delay
+        self.log = open_log(log_name)
+        self.from_addr = from_addr
+        self.from_port = from_port
+        self.to_addr = to_addr
+        self.to_port = to_port
+        self.loop = loop
+        self.impair = impair
+        if self.loop == None:
+            self.loop = default_loop()
+        self.mss = 1500
+        self.in_queue = PacketQueue(size)
+        self.out_queue = queue
+        if self.out_queue == None:
+            self.out_queue = PacketQueue(size)
+        self.out_queue.log = self.log
+        self.out_queue.clock = self.loop.clock
+        self.metrics = None
+        if metrics != None:
+            self.metrics = LinkMetrics(metrics,self.name())
+            self.metrics.watch(self.out_queue,self.in_queue)
+        self.out_queue.metrics = self.metrics
+        self.lock = threading.Lock()
+        # whether a packet is being transmitted, the number of packets
+        # propagating, and when a packet was last received
+        self.busy = False
+        self.propagating = 0
+        self.received = 0
+        # if set, called from the loop with each packet received instead
+        # of putting it on the incoming queue
+        self.receiver = None
+        self.create_socket()
+        if self.socket:
+            self.loop.add(self)
+
+    def enqueue(self,id,packet):
+        """ Add id and packet to the outgoing queue.  If the queue is
+        full, the packet is dropped."""
+        now = self.loop.clock()
+        self.lock.acquire()
+        try:
+            self.out_queue.put_nowait((id,packet,now))
+        except Queue.Full,e:
+            self.lock.release()
+            reason = " ".join(e.args) or None
+            self.log.event(now,id,"dropped",reason)
+            if self.metrics != None:
+                self.metrics.dropped(reason or "overflow")
+            return
+        self.log.event(now,id,"added")
+        if self.metrics != None:
+            self.metrics.enqueued.inc()
+        start = not self.busy
+        self.busy = True
+        self.lock.release()
+        if start:
+            self.loop.schedule(now,self.transmit,now)
+
+    def transmit(self,now):
+        """ Start transmitting the next packet at time (now), if there
+        is one."""
+        self.lock.acquire()
+        packets = self.out_queue.get_batch(0,1)
+        if not packets:
+            self.busy = False
+            self.lock.release()
+            return
+        id,data,queued = packets[0]
+        self.lock.release()
+        self.log.event(now,id,"sending")
+        if self.metrics != None:
+            self.metrics.queue_delay.observe(now - queued)
+        trans = float(len(data)*8) / (1000*1000*self.rate)
+        self.loop.schedule(now + trans,self.transmitted,now + trans,id,data)
+
+    def transmitted(self,now,id,data):
+        """ Finish transmitting a packet at time (now): start its
+        propagation delay and start on the next packet."""
+        self.log.event(now,id,"sent")
+        if self.metrics != None:
+            self.metrics.sent.inc()
+            self.metrics.sent_bytes.inc(len(data))
+        delays = [float(self.delay)/1000]
+        if self.impair != None:
+            delays = self.impair.delays(delays[0])
+            if not delays:
+                self.log.event(now,id,"lost")
+                if self.metrics != None:
+                    self.metrics.lost.inc()
+        for delay in delays:
+            self.propagating += 1
+            self.loop.schedule(now + delay,self.arrive,data)
+        self.transmit(now)
+
+    def arrive(self,data):
+        """ Deliver a packet to the other side of the link."""
+        self.propagating -= 1
+        try:
+            self.socket.send(data)
+        except:
+            print "Can't send on UDP socket"
+            print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
+
+    def receive(self):
+        """ Read every packet waiting on the socket and deliver it."""
+        while True:
+            try:
+                data = self.socket.recv(self.mss)
+            except socket.error,e:
+                if e.args[0] not in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    print "Can't receive from UDP socket"
+                    print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
+                return
+            self.deliver(data)
+
+    def deliver(self,data):
+        """ Hand a packet that has arrived to (receiver) if there is
+        one, or put it on the incoming queue.  If the queue is full then
+        the packet is dropped."""
+        now = self.loop.clock()
+        self.received = now
+        self.log.event(now,None,"received")
+        if self.metrics != None:
+            self.metrics.received.inc()
+            self.metrics.received_bytes.inc(len(data))
+        if self.receiver != None:
+            self.receiver(data)
+            return
+        try:
+            self.in_queue.put_nowait(data)
+        except Queue.Full:
+            if self.metrics != None:
+                self.metrics.dropped("incoming")
+
+    def idle(self):
+        """ Wait until nothing is queued or in flight and nothing has
+        been received for a second."""
+        while True:
+            if not self.busy and self.propagating == 0 and \
+               self.loop.clock() - self.received >= 1:
+                return
+            time.sleep(0.1)
@@ -0,0 +1,207 @@
+"""
+  Implements TCP sockets driven by an event loop
+
+  TCP and TCPSocket block on queues, so every socket needs a thread to
+  send or receive on, and the demultiplexer needs another.  Here the
+  demultiplexer is called by the EventLoop of an EventLink for each
+  packet that arrives, sockets react to packets and to their
+  retransmission timer as events on the same loop, and send and recv
+  return at once and call back when they finish.  The sliding window,
+  congestion control and reassembly are those of TCPSocket, so any
+  number of connections can run on the one loop thread.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import collections
+import sys
+import threading
+
+from eventlink import *
+from tcp import *
+
+__all__ = [ "EventTCP","EventTCPSocket" ]
+
+class EventTCP:
+    """ Demultiplexes packets arriving on an EventLink to the
+    EventTCPSockets bound to their destination ports.  It has no
+    thread: the link's event loop calls it for every packet."""
+    def __init__(self,link):
+        self.link = link
+        self.binding = {}
+        self.semaphore = threading.Semaphore()
+        # packets dropped because a socket's buffer was full, by port
+        self.drops = {}
+        self.link.receiver = self.deliver
+
+    def bind(self,port,socket):
+        """ Bind a socket to the requested port, as TCP.bind does;
+        binding a port that is already bound is an error."""
+        self.semaphore.acquire()
+        if port in self.binding:
+            self.semaphore.release()
+            raise 'AddressInUse'
+        binding = dict(self.binding)
+        binding[port] = socket
+        self.binding = binding
+        self.semaphore.release()
+
+    def unbind(self,port):
+        self.semaphore.acquire()
+        binding = dict(self.binding)
+        if port in binding:
+            del binding[port]
+        self.binding = binding
+        self.semaphore.release()
+
+    def deliver(self,packet):
+        """ Decode a packet and hand it to the socket bound to its
+        destination port."""
+        u = TCPPacket()
+        try:
+            u.unpack(packet)
+        except:
+            print "Exception: unpacking a TCP packet"
+            print "  ",sys.exc_info()[0],sys.exc_info()[1]
+            return
+        socket = self.binding.get(u.destPort)
+        if socket != None:
+            socket.handle(u)
+
+
+class EventTCPSocket(TCPSocket):
+    """ Emulate a TCP socket on a host, driven by the event loop of
+    its link.  Callbacks are called from the loop thread and must not
+    block."""
+    def __init__(self,link,tcp,size,sourcePort,destPort,
+                 congestion="newreno",cwndLog=None,packetsize=1024,wide=None):
+        """
+        Initialize the socket, with the same parameters as TCPSocket.
+        (size) limits the data segments held for a message that
+        arrive before recv is called.
+        """
+        TCPSocket.__init__(self,link,tcp,size,sourcePort,destPort,
+                           congestion,cwndLog,packetsize,wide)
+        self.size = size
+        self.loop = link.loop
+        self.clock = self.loop.clock
+        self.start = self.clock()
+        self.pending = collections.deque()
+        # whether a message is being sent or received, and who to tell
+        # when it is done
+        self.sending = False
+        self.sender = None
+        self.receiving = False
+        self.receiver = None
+        # when the retransmission timer expires, or None if it is not
+        # running
+        self.timer = None
+
+    # sending data
+    def send(self,data,callback=None):
+        """ Start sending (data) and return at once.  When every
+        segment has been acknowledged, or the socket gives up after
+        (retries) consecutive timeouts, callback(bytes) is called with
+        the number of bytes sent."""
+        self.loop.schedule(self.clock(),self.startSend,data,callback)
+
+    def sendStream(self,source,callback=None,length=None):
+        """ Start sending the data read from (source), a file or an
+        iterator of strings, and of (length) bytes if given, as
+        TCPSocket.sendStream does, and return at once.  Reading from
+        the source must not block.  When the stream has been
+        acknowledged, or the socket gives up, callback(bytes) is
+        called with the number of bytes sent."""
+        self.loop.schedule(self.clock(),self.startStream,source,callback,
+                           length)
+
+    def startSend(self,data,callback):
+        self.sending = True
+        self.sender = callback
+        self.beginSend(data)
+        self.pump()
+
+    def startStream(self,source,callback,length=None):
+        self.sending = True
+        self.sender = callback
+        self.beginStream(source,length)
+        self.pump()
+
+    def pump(self):
+        """ Send whatever the window allows and keep the retransmission
+        timer running, or finish the transfer if it is done."""
+        if self.sendDone():
+            self.sending = False
+            self.timer = None
+            self.endSend()
+            callback,self.sender = self.sender,None
+            if callback != None:
+                callback(self.length)
+            return
+        self.refill()
+        self.fillWindow(self.total)
+        self.logCwnd()
+        deadline = self.sent[self.base] + self.rtt.rto
+        if (self.timer == None) or (deadline < self.timer):
+            self.timer = deadline
+            self.loop.schedule(deadline,self.expire,deadline)
+
+    def expire(self,deadline):
+        """ Handle a retransmission timer event.  The event is stale if
+        the timer has been set again since; if the oldest segment has
+        not been outstanding for the timeout yet, wait until it
+        has."""
+        if (not self.sending) or (deadline != self.timer):
+            return
+        self.timer = None
+        if self.clock() >= self.sent[self.base] + self.rtt.rto:
+            self.timedOut()
+            self.logCwnd()
+        self.pump()
+
+    # receiving data
+    def recv(self,callback):
+        """ Start receiving a message and return at once.  When all of
+        its segments have arrived, callback(data) is called with the
+        message."""
+        self.loop.schedule(self.clock(),self.startRecv,callback)
+
+    def recvStream(self,sink,callback=None):
+        """ Start receiving a stream, or a message, and return at once.
+        Its data is passed in order to (sink), a file or a function
+        taking a string, as TCPSocket.recvStream does.  When all of it
+        has arrived, callback(bytes) is called with the number of
+        bytes received."""
+        self.loop.schedule(self.clock(),self.startRecv,callback,sink)
+
+    def startRecv(self,callback,sink=None):
+        self.receiving = True
+        self.receiver = callback
+        if sink != None:
+            sink = getattr(sink,"write",sink)
+            if callback != None:
+                self.receiver = lambda data: callback(self.streamed)
+        self.beginRecv(sink)
+        while self.receiving and self.pending:
+            self.handle(self.pending.popleft())
+
+    def handle(self,p):
+        """ Handle a packet from the demultiplexer.  Data segments that
+        arrive before recv is called are held, up to (size) of them."""
+        if p.flags & ACK:
+            if self.sending:
+                self.handleAck(p)
+                self.pump()
+        elif self.receiving:
+            self.handleData(p)
+            if self.missing == 0:
+                self.receiving = False
+                callback,self.receiver = self.receiver,None
+                if callback != None:
+                    callback(self.message())
+        elif len(self.pending) < self.size:
+            self.pending.append(p)
+        else:
+            self.tcp.drops[self.sourcePort] = \
+                self.tcp.drops.get(self.sourcePort,0) + 1
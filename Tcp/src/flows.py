@@ -0,0 +1,321 @@
+"""
+  Runs many TCP flows at once and measures how they share links
+
+  "python flows.py --flows 8" opens eight connections over one pair of
+  links, each sending its own message at the same time, and prints
+  each flow's completion time and throughput, the aggregate
+  throughput, and Jain's fairness index of the flows' throughputs,
+  which is 1 when they all get the same share and 1/n when one flow
+  gets everything.  With --links the flows are spread over that many
+  pairs of links instead.
+
+  --mode thread runs threaded sockets over Links, with a thread for
+  each sender and receiver; --mode event runs event driven sockets
+  over EventLinks on one loop thread; and --mode virtual runs them
+  over VirtualLinks in virtual time, so runs are repeatable.  Queue
+  disciplines and impairments apply to the forward links, which carry
+  the data.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+# Python imports
+import optparse
+import sys
+import threading
+import time
+
+# local imports
+from eventlink import *
+from eventtcp import *
+from impair import *
+from link import *
+from metrics import *
+from queues import *
+from tcp import *
+from virtual import *
+
+MODES = ("thread","event","virtual")
+
+class Flow:
+    """ One flow: the message it sends, and when it started and
+    finished."""
+    def __init__(self,number,length):
+        self.number = number
+        # each flow sends different data, so crossed flows are noticed
+        pattern = "%07d " % number
+        self.data = (pattern * (length/len(pattern) + 1))[:length]
+        self.start = None
+        self.finish = None
+        self.intact = False
+        self.sender = None
+
+    def elapsed(self):
+        """ Return the flow completion time, in seconds, or None if it
+        did not complete."""
+        if (self.finish == None) or (self.start == None):
+            return None
+        return self.finish - self.start
+
+    def throughput(self):
+        """ Return the flow's goodput in Mbps, counting a flow that did
+        not complete intact as 0."""
+        elapsed = self.elapsed()
+        if not self.intact or not elapsed:
+            return 0.0
+        return len(self.data)*8/elapsed/1000000
+
+
+def jain(values):
+    """ Return Jain's fairness index of (values): the square of their
+    sum over n times the sum of their squares."""
+    squares = sum([x*x for x in values])
+    if not squares:
+        return 0.0
+    return sum(values)**2/(len(values)*squares)
+
+
+class Driver:
+    """ Builds pairs of links for one mode and runs flows over them."""
+    def __init__(self,mode,rate,delay,size,links=1,port=6000,log=None,
+                 queue=None,impair=None,metrics=None):
+        """
+        Initialize the driver:
+        * mode     one of MODES
+        * rate     the bandwidth of each link, in Mbps
+        * delay    the propagation delay of each link, in ms
+        * size     the size of each link's queues, in packets
+        * links    the number of pairs of links to spread flows over
+        * port     the first UDP port to use for threaded and event
+                   links; each pair uses two
+        * log      log file for the first forward link
+        * queue    a function returning a queue discipline for each
+                   forward link, or None for the default queue
+        * impair   a function returning the Impairments for each
+                   forward link, given the link's number from 0, or
+                   None
+        * metrics  the Registry to keep the links' metrics in, or None
+        """
+        self.mode = mode
+        self.loop = None
+        if mode == "virtual":
+            self.loop = VirtualLoop()
+        elif mode == "event":
+            self.loop = default_loop()
+        self.pairs = []
+        for i in range(links):
+            extra = {}
+            if queue != None:
+                extra["queue"] = queue()
+            if impair != None:
+                extra["impair"] = impair(i)
+            name = None
+            if i == 0:
+                name = log
+            if mode == "virtual":
+                a = VirtualLink(size,rate,delay,name,self.loop,
+                                metrics=metrics,**extra)
+                b = VirtualLink(size,rate,delay,None,self.loop,
+                                metrics=metrics)
+                a.connect(b)
+            else:
+                cls = Link
+                if mode == "event":
+                    cls = EventLink
+                    extra["loop"] = self.loop
+                a = cls(size=size,rate=rate,delay=delay,log_name=name,
+                        from_addr="localhost",from_port=port + 2*i,
+                        to_addr="localhost",to_port=port + 2*i + 1,
+                        metrics=metrics,**extra)
+                b = cls(size=size,rate=rate,delay=delay,log_name=None,
+                        from_addr="localhost",from_port=port + 2*i + 1,
+                        to_addr="localhost",to_port=port + 2*i,
+                        metrics=metrics)
+            if mode == "thread":
+                tcp_a = TCP(a)
+                tcp_a.start()
+                tcp_b = TCP(b)
+                tcp_b.start()
+            else:
+                tcp_a = EventTCP(a)
+                tcp_b = EventTCP(b)
+            self.pairs.append((a,b,tcp_a,tcp_b))
+
+    def run(self,count,length,tcp_size,congestion="newreno",stagger=0,
+            limit=60,granularity=0.2):
+        """ Run (count) flows of (length) bytes each, flow i starting
+        i times (stagger) seconds after the first, on pair i modulo
+        the number of pairs.  Waits up to (limit) seconds for them to
+        finish, and returns the Flows.  In virtual time the RTT
+        variance has the (granularity) floor described in
+        simulate.py."""
+        flows = [Flow(i + 1,length) for i in range(count)]
+        if self.mode == "thread":
+            self.run_threads(flows,tcp_size,congestion,stagger,limit)
+        else:
+            self.run_events(flows,tcp_size,congestion,stagger,limit,
+                            granularity)
+        return flows
+
+    def sockets(self,flow,cls,tcp_size,congestion):
+        """ Create the sending and receiving sockets for (flow), bound
+        to the flow's number as their port."""
+        a,b,tcp_a,tcp_b = self.pairs[(flow.number - 1) % len(self.pairs)]
+        s = cls(a,tcp_a,tcp_size,flow.number,flow.number,congestion)
+        r = cls(b,tcp_b,tcp_size,flow.number,flow.number,congestion)
+        flow.sender = s
+        return s,r
+
+    def run_threads(self,flows,tcp_size,congestion,stagger,limit):
+        """ Run each flow's sender and receiver in threads of their
+        own."""
+        begin = time.time()
+        def send(flow,s):
+            delay = begin + (flow.number - 1)*stagger - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            flow.start = time.time()
+            s.send(flow.data)
+        def receive(flow,r):
+            data = r.recv(limit)
+            flow.finish = time.time()
+            flow.intact = data == flow.data
+        workers = []
+        for flow in flows:
+            s,r = self.sockets(flow,TCPSocket,tcp_size,congestion)
+            for target,args in ((receive,(flow,r)),(send,(flow,s))):
+                t = threading.Thread(target=target,args=args)
+                t.daemon = True
+                t.start()
+                workers.append(t)
+        end = time.time() + limit + (len(flows) - 1)*stagger
+        for t in workers:
+            t.join(max(end - time.time(),0))
+
+    def run_events(self,flows,tcp_size,congestion,stagger,limit,
+                   granularity):
+        """ Run every flow on the event loop of the links."""
+        finished = threading.Event()
+        remaining = [len(flows)]
+        def start(flow,s):
+            flow.start = self.loop.clock()
+            s.send(flow.data)
+        def received(flow,data):
+            flow.finish = self.loop.clock()
+            flow.intact = data == flow.data
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                finished.set()
+        begin = self.loop.clock()
+        for flow in flows:
+            s,r = self.sockets(flow,EventTCPSocket,tcp_size,congestion)
+            if self.mode == "virtual":
+                s.rtt.granularity = granularity
+            r.recv(lambda data,flow=flow: received(flow,data))
+            self.loop.schedule(begin + (flow.number - 1)*stagger,start,
+                               flow,s)
+        if self.mode == "virtual":
+            self.loop.run()
+        else:
+            finished.wait(limit + (len(flows) - 1)*stagger)
+
+
+def report(flows):
+    """ Print each flow's results, then the aggregate throughput and
+    the fairness index."""
+    print "%6s %10s %10s %10s %10s %10s %8s" % ("flow","bytes","start s",
+                                                "finish s","fct s","Mbps",
+                                                "intact")
+    starts = [flow.start for flow in flows if flow.start != None]
+    first = min(starts or [0])
+    for flow in flows:
+        elapsed = flow.elapsed()
+        if elapsed == None:
+            print "%6d %10d %10s %10s %10s %10.3f %8s" % \
+                (flow.number,len(flow.data),"-","-","-",0,"no")
+            continue
+        print "%6d %10d %10.3f %10.3f %10.3f %10.3f %8s" % \
+            (flow.number,len(flow.data),flow.start - first,
+             flow.finish - first,elapsed,flow.throughput(),
+             "yes" if flow.intact else "no")
+    done = [flow for flow in flows if flow.intact]
+    total = sum([len(flow.data) for flow in done])
+    if done:
+        span = max([flow.finish for flow in done]) - first
+    else:
+        span = 0
+    aggregate = 0.0
+    if span > 0:
+        aggregate = total*8/span/1000000
+    print "%d of %d flows intact, %d bytes in %.3f s, aggregate %.3f Mbps" % \
+        (len(done),len(flows),total,span,aggregate)
+    print "Jain's fairness index %.4f" % jain([flow.throughput()
+                                               for flow in flows])
+
+
+def parse_options():
+    """ Parse options. """
+    parser = optparse.OptionParser(usage = "%prog [options]",
+                                   version = "%prog 0.1")
+
+    parser.add_option("","--mode",type="choice",dest="mode",
+                      choices=MODES,default="thread",
+                      help="sockets and links to use: thread, event or virtual")
+    parser.add_option("","--flows",type="int",dest="flows",
+                      default=4,
+                      help="number of flows")
+    parser.add_option("","--links",type="int",dest="links",
+                      default=1,
+                      help="number of pairs of links to spread the flows over")
+    parser.add_option("","--bytes",type="int",dest="bytes",
+                      default=1024*500,
+                      help="bytes each flow sends")
+    parser.add_option("","--stagger",type="float",dest="stagger",
+                      default=0,
+                      help="ms between the starts of successive flows")
+    parser.add_option("","--port",type="int",dest="port",
+                      default=6000,
+                      help="first UDP port to use")
+    parser.add_option("","--rate",type="float",dest="rate",
+                      default=10.0,
+                      help="bandwidth of each link in Mbps")
+    parser.add_option("","--delay",type="int",dest="delay",
+                      default=10,
+                      help="propagation delay of each link in ms")
+    parser.add_option("","--size",type="int",dest="size",
+                      default=100,
+                      help="size of the link queues")
+    parser.add_option("","--log",type="string",dest="log",
+                      default=None,
+                      help="log file for the first forward link, or a binary trace if it ends in .trace")
+    parser.add_option("","--tcp-size",type="int",dest="tcp_size",
+                      default=100,
+                      help="size of the TCP queues")
+    parser.add_option("","--cc",type="choice",dest="cc",
+                      choices=sorted(CONGESTION.keys()),default="newreno",
+                      help="congestion control: cubic, newreno, reno or tahoe")
+    parser.add_option("","--limit",type="int",dest="limit",
+                      default=120,
+                      help="seconds to wait for the flows to finish")
+    add_queue_options(parser)
+    add_impairment_options(parser)
+    add_metrics_options(parser)
+
+    (options,args) = parser.parse_args()
+    return options
+
+if __name__ == '__main__':
+    options = parse_options()
+    queue = None
+    if options.queue != None:
+        queue = lambda: create_queue(options)
+    impair = None
+    if create_impairments(options) != None:
+        impair = lambda i: create_impairments(options,i)
+    driver = Driver(options.mode,options.rate,options.delay,options.size,
+                    options.links,options.port,options.log,queue,impair,
+                    create_metrics(options))
+    flows = driver.run(options.flows,options.bytes,options.tcp_size,
+                       options.cc,options.stagger/1000,options.limit)
+    report(flows)
@@ -0,0 +1,201 @@
+"""
+  Implements random impairments for packets crossing a link
+
+  Impairments decide, for each packet that finishes transmission,
+  whether it is lost, how much its propagation delay varies, whether
+  it is held back so that later packets overtake it, and whether it
+  is duplicated.  Every decision comes from one seeded random number
+  generator, so the same seed gives the same decisions for the same
+  sequence of packets.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import random
+
+__all__ = [ "Impairments","BernoulliLoss","GilbertElliottLoss","Jitter",
+            "add_impairment_options","create_impairments" ]
+
+class BernoulliLoss:
+    """ Loses each packet independently with a fixed probability."""
+    def __init__(self,probability):
+        self.probability = probability
+
+    def lost(self,random):
+        return random.random() < self.probability
+
+
+class GilbertElliottLoss:
+    """ Loses packets in bursts.  The channel moves between a good and
+    a bad state before each packet, and loses the packet with the
+    probability of its state."""
+    def __init__(self,p,r,good=0.0,bad=1.0):
+        """
+        Initialize the model:
+        * p     probability of going from the good to the bad state
+        * r     probability of going from the bad to the good state
+        * good  probability of losing a packet in the good state
+        * bad   probability of losing a packet in the bad state
+        """
+        self.p = p
+        self.r = r
+        self.good = good
+        self.bad = bad
+        self.state_bad = False
+
+    def lost(self,random):
+        if self.state_bad:
+            if random.random() < self.r:
+                self.state_bad = False
+        elif random.random() < self.p:
+            self.state_bad = True
+        if self.state_bad:
+            return random.random() < self.bad
+        return random.random() < self.good
+
+
+class Jitter:
+    """ Varies the propagation delay of each packet.  The variation is
+    uniform between -amount and amount, normal with a standard
+    deviation of amount (cut off at three deviations), or exponential
+    with a mean of amount."""
+    KINDS = ("uniform","normal","exponential")
+
+    def __init__(self,kind,amount):
+        """
+        Initialize the distribution:
+        * kind    one of KINDS
+        * amount  the scale of the variation, in seconds
+        """
+        if kind not in self.KINDS:
+            raise ValueError("unknown jitter distribution %s" % kind)
+        self.kind = kind
+        self.amount = amount
+
+    def sample(self,random):
+        if self.kind == "uniform":
+            return random.uniform(-self.amount,self.amount)
+        if self.kind == "normal":
+            return max(min(random.gauss(0,self.amount),3*self.amount),
+                       -3*self.amount)
+        return random.expovariate(1.0/self.amount)
+
+    def lowest(self):
+        """ Return the smallest variation this can produce."""
+        if self.kind == "uniform":
+            return -self.amount
+        if self.kind == "normal":
+            return -3*self.amount
+        return 0
+
+
+class Impairments:
+    """ Combines loss, jitter, reordering and duplication."""
+    def __init__(self,loss=None,jitter=None,reorder=0,reorder_delay=0,
+                 duplicate=0,seed=None):
+        """
+        Initialize the impairments:
+        * loss           a loss model, or None for no loss
+        * jitter         a Jitter, or None for a fixed delay
+        * reorder        probability of holding a packet back
+        * reorder_delay  the most a packet is held back, in seconds, so
+                         it can only be overtaken by packets sent in
+                         that time
+        * duplicate      probability of delivering a packet twice
+        * seed           seed for the random number generator
+        """
+        self.loss = loss
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.random = random.Random(seed)
+
+    def delays(self,delay):
+        """ Return the propagation delays, in seconds, after which to
+        deliver copies of a packet whose delay would be (delay): none
+        if it is lost, and two if it is duplicated."""
+        if (self.loss != None) and self.loss.lost(self.random):
+            return []
+        copies = 1
+        if self.duplicate and (self.random.random() < self.duplicate):
+            copies = 2
+        delays = []
+        for i in range(copies):
+            d = delay
+            if self.jitter != None:
+                d += self.jitter.sample(self.random)
+            if self.reorder and (self.random.random() < self.reorder):
+                d += self.random.uniform(0,self.reorder_delay)
+            delays.append(max(d,0))
+        return delays
+
+    def earliest(self,delay):
+        """ Return the shortest delay that delays() can give."""
+        if self.jitter != None:
+            delay += self.jitter.lowest()
+        return max(delay,0)
+
+
+def parse_gilbert(option,opt,value,parser):
+    """ Parse the value of the --gilbert option into the arguments of
+    GilbertElliottLoss, reporting a malformed one as a usage error."""
+    try:
+        values = [float(x) for x in value.split(',')]
+    except ValueError:
+        parser.error("%s takes numbers, as p,r[,good,bad]" % opt)
+    if not (2 <= len(values) <= 4):
+        parser.error("%s takes 2 to 4 values, as p,r[,good,bad]" % opt)
+    if [x for x in values if not (0 <= x <= 1)]:
+        parser.error("%s values are probabilities, from 0 to 1" % opt)
+    setattr(parser.values,option.dest,values)
+
+def add_impairment_options(parser):
+    """ Add options for impairing a link to (parser)."""
+    parser.add_option("","--loss",type="float",dest="loss",
+                      default=0,
+                      help="probability of losing each packet")
+    parser.add_option("","--gilbert",type="string",dest="gilbert",
+                      default=None,action="callback",callback=parse_gilbert,
+                      help="bursty loss as p,r[,good,bad]: the probabilities of going from the good to the bad state and back, and of loss in each state")
+    parser.add_option("","--jitter",type="float",dest="jitter",
+                      default=0,
+                      help="variation in propagation delay in ms")
+    parser.add_option("","--jitter-dist",type="choice",dest="jitter_dist",
+                      choices=Jitter.KINDS,default="uniform",
+                      help="jitter distribution: uniform, normal or exponential")
+    parser.add_option("","--reorder",type="float",dest="reorder",
+                      default=0,
+                      help="probability of holding a packet back")
+    parser.add_option("","--reorder-delay",type="float",dest="reorder_delay",
+                      default=10,
+                      help="most a packet is held back in ms")
+    parser.add_option("","--duplicate",type="float",dest="duplicate",
+                      default=0,
+                      help="probability of duplicating a packet")
+    parser.add_option("","--seed",type="int",dest="seed",
+                      default=None,
+                      help="seed for the random impairments")
+
+def create_impairments(options,stream=0):
+    """ Return the impairments chosen by (options), or None if there
+    are none.  Links that should not share random decisions are given
+    different (stream) numbers, which are added to the seed."""
+    loss = None
+    if options.gilbert:
+        loss = GilbertElliottLoss(*options.gilbert)
+    elif options.loss:
+        loss = BernoulliLoss(options.loss)
+    jitter = None
+    if options.jitter:
+        jitter = Jitter(options.jitter_dist,options.jitter/1000)
+    if (loss == None) and (jitter == None) and not options.reorder and \
+       not options.duplicate:
+        return None
+    seed = options.seed
+    if seed != None:
+        seed += stream
+    return Impairments(loss,jitter,options.reorder,
+                       options.reorder_delay/1000,options.duplicate,
+                       seed)
@@ -7,13 +7,17 @@
 
 """
 
+import errno
+import heapq
 import Queue
+import select
 import socket
 import sys
 import threading
 import time
 
 from log import *
+from metrics import *
 
 class Link:
     """
@@ -21,59 +25,102 @@ class Link:
     transmit packets.
     """
     def __init__(self,size,rate,delay,log_name,
-                 from_addr,from_port,to_addr,to_port):
+                 from_addr,from_port,to_addr,to_port,batch=64,queue=None,
+                 impair=None,metrics=None):
         """
         Initialize the link:
         * size       the size of the queue used to store packets that are
                      going out or coming in over the link
         * rate       the rate of the link, in Mbps
         * delay      the propagation delay of the link, in ms
-        * log_name   log file name
+        * log_name   log file name; a name ending in .trace writes a
+                     binary trace, see tracefile.py
         * from_addr  the IP address on this side of the link
         * from_port  the UDP port on this side of the link
         * to_addr    the IP address on the other side of the link
         * to_port    the UDP port on the other side of the link
+        * batch      the most packets to read from the socket each
+                     time it becomes readable
+        * queue      the queue discipline for outgoing packets, from
+                     queues.py; by default a queue of (size) packets
+        * impair     the Impairments to apply to packets as they
+                     propagate, from impair.py; by default none
+        * metrics    the Registry to keep the link's metrics in, from
+                     metrics.py; by default none are kept
         """
         # setup member variables
         self.rate = rate
         self.delay = delay
-        self.log = Log(log_name)
+        self.log = open_log(log_name)
         self.from_addr = from_addr
         self.from_port = from_port
         self.to_addr = to_addr
         self.to_port = to_port
+        self.metrics = None
+        if metrics != None:
+            self.metrics = LinkMetrics(metrics,self.name())
         # setup UDP socket
+        self.create_socket()
+        # start incoming handler
+        self.in_queue = PacketQueue(size)
+        self.in_thread = Incoming(socket=self.socket,queue=self.in_queue,
+                                  log=self.log,batch=batch,
+                                  metrics=self.metrics)
+        self.in_thread.start()
+        self.mss = self.in_thread.mss
+        # start outgoing handler
+        self.out_queue = queue
+        if self.out_queue == None:
+            self.out_queue = PacketQueue(size)
+        self.out_queue.log = self.log
+        self.out_queue.metrics = self.metrics
+        if self.metrics != None:
+            self.metrics.watch(self.out_queue,self.in_queue)
+        self.out_thread = Outgoing(socket=self.socket,queue=self.out_queue,
+                                   log=self.log,rate=self.rate,delay=self.delay,
+                                   impair=impair,metrics=self.metrics)
+        self.out_thread.start()
+
+    def name(self):
+        """ Return the name of the link in its metrics."""
+        return "%s:%s" % (self.from_addr,self.from_port)
+
+    def create_socket(self):
+        """ Create the UDP socket for this link, bound to this side and
+        connected to the other side.  Sets socket to None on failure.
+
+        The socket is non-blocking: a socket with a timeout polls
+        before every send and receive, doubling the system calls per
+        packet, so the handlers wait with select only when they have
+        to."""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-            self.socket.settimeout(1)
+            self.socket.setblocking(0)
             self.socket.bind((self.from_addr,self.from_port))
             self.socket.connect((self.to_addr,self.to_port))
         except:
             self.socket = None
             print "Can't initialize socket"
             print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
-        # start incoming handler
-        self.in_queue = Queue.Queue(size)
-        self.in_thread = Incoming(socket=self.socket,queue=self.in_queue,
-                                  log=self.log)
-        self.in_thread.start()
-        # start outgoing handler
-        self.out_queue = Queue.Queue(size)
-        self.out_thread = Outgoing(socket=self.socket,queue=self.out_queue,
-                                   log=self.log,rate=self.rate,delay=self.delay)
-        self.out_thread.start()
 
     def enqueue(self,id,packet):
         """ Add id and packet to the outgoing queue.  If the queue is
-        full, the packet is dropped."""
+        full, or its discipline decides to drop the packet, the packet
+        is dropped."""
         now = time.time()
         try:
-            self.log.write("%f %d added\n" % (now, id))
-            self.out_queue.put_nowait((id,packet))
-        except:
-            self.log.write("%f %d dropped\n" % (now, id))
-            pass
+            self.log.event(now,id,"added")
+            self.out_queue.put_nowait((id,packet,now))
+        except Queue.Full,e:
+            # queue disciplines give the reason for the drop
+            reason = " ".join(e.args) or None
+            self.log.event(now,id,"dropped",reason)
+            if self.metrics != None:
+                self.metrics.dropped(reason or "overflow")
+            return
+        if self.metrics != None:
+            self.metrics.enqueued.inc()
 
     def dequeue(self,timeout):
         """ Get packet from the incoming queue. Blocks until data is
@@ -84,6 +131,12 @@ class Link:
             packet = None
         return packet
 
+    def dequeue_batch(self,timeout,count):
+        """ Get up to (count) packets from the incoming queue, waiting
+        as dequeue() does for the first one but not for the rest.
+        Returns a list, which is empty if the timeout expired."""
+        return self.in_queue.get_batch(timeout,count)
+
     def idle(self):
         while True:
             if self.out_thread.idle and self.in_thread.idle:
@@ -91,13 +144,64 @@ class Link:
             else:
                 time.sleep(1)
     
+class PacketQueue(Queue.Queue):
+    """
+    A queue that can add or remove a batch of packets while taking
+    its lock only once, instead of once per packet.
+    """
+    def put_batch(self,items):
+        """ Add as many of (items) as there is room for, without
+        blocking.  Returns the number added; the rest are dropped."""
+        self.not_full.acquire()
+        try:
+            if self.maxsize > 0:
+                items = items[:max(self.maxsize - self._qsize(),0)]
+            for item in items:
+                self._put(item)
+            self.unfinished_tasks += len(items)
+            if items:
+                self.not_empty.notify()
+            return len(items)
+        finally:
+            self.not_full.release()
+
+    def get_batch(self,timeout,count):
+        """ Remove and return up to (count) items.  Waits up to
+        (timeout) seconds for the first one, or indefinitely if timeout
+        is None, and returns an empty list if none arrives."""
+        self.not_empty.acquire()
+        try:
+            if timeout == None:
+                while not self._qsize():
+                    self.not_empty.wait()
+            else:
+                end = time.time() + timeout
+                while not self._qsize():
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return []
+                    self.not_empty.wait(remaining)
+            items = self._take(count)
+            self.not_full.notify(len(items))
+            return items
+        finally:
+            self.not_empty.release()
+
+    def _take(self,count):
+        """ Remove up to (count) items, with the lock held."""
+        items = []
+        while self._qsize() and (len(items) < count):
+            items.append(self._get())
+        return items
+
 class Outgoing(threading.Thread):
     """
     Handler for the outgoing queue of the link.  Takes packets from
     the queue, emulates the transmission delay, and then queues them
     for emulation of propagation delay.
     """
-    def __init__(self,socket,queue,log,rate,delay):
+    def __init__(self,socket,queue,log,rate,delay,burst=64,quantum=0.001,
+                 impair=None,metrics=None):
         """
         Initialize the handler:
         * socket  the UDP socket used for the link
@@ -105,6 +209,12 @@ class Outgoing(threading.Thread):
         * log     a logging object
         * rate    the rate of the link, in Mbps
         * delay   the propagation delay of the link, in ms
+        * burst   the most packets to take from the queue at once when
+                  catching up
+        * quantum how far the handler may run ahead of the link model,
+                  in seconds, rather than sleep for less
+        * impair  the Impairments to apply during propagation, or None
+        * metrics the LinkMetrics to count packets in, or None
         """
         threading.Thread.__init__(self)
         threading.Thread.daemon = True
@@ -112,42 +222,94 @@ class Outgoing(threading.Thread):
         self.socket = socket
         self.queue = queue
         self.log = log
+        self.metrics = metrics
         self.rate = rate
         self.delay = delay
+        self.burst = burst
+        self.quantum = quantum
         self.idle = False
         # setup propagation delay queue and handler
         self.prop_queue = Queue.Queue()
         self.prop_thread = Propagation(socket=self.socket,queue=self.prop_queue,
-                                       log=self.log,delay=self.delay)
+                                       log=self.log,delay=self.delay,
+                                       impair=impair,metrics=metrics)
         self.prop_thread.start()
 
     def run(self):
         """ Continuously read data from the queue and emulate
         transmission delay.  Once the transmission delay is finished,
         add the data to a propagation delay queue.  This method is
-        activated by a call to start() and runs in a separate thread."""
+        activated by a call to start() and runs in a separate thread.
+
+        Rather than sleeping for each packet's transmission delay, the
+        handler keeps the time the link will finish sending what it
+        has taken so far.  A packet starts at that time, or when it
+        was queued if the link was idle then, and is stamped with the
+        times the model gives it.  The handler only sleeps while it
+        is ahead of the model; when sleeps overshoot, the packets that
+        should already have been sent are released back to back, and
+        handed to the propagation handler together, so the link keeps
+        its rate however coarse the sleeps are.  Packets are only taken
+        from the queue once the model has them start within the
+        quantum, so that they wait in the queue, and count against its
+        size and its discipline, for as long as they would on a real
+        link."""
         if not self.socket:
             return
+        # when the link finishes transmitting the last packet taken,
+        # kept as the time the link last became busy plus the time it
+        # has been transmitting since, since adding many small delays
+        # to a large time would lose precision
+        epoch = 0
+        busy = 0.0
+        departure = 0
+        # the longest transmission delay seen, to count the packets the
+        # link will start on within the quantum without overestimating
+        longest = 1e-9
         while True:
+            # wait until the link is free
+            now = time.time()
+            if departure > now + self.quantum:
+                time.sleep(departure - now - self.quantum)
             # get data to send
-            try:
-                packet = self.queue.get(timeout=1)
-                self.idle = False
-            except Queue.Empty:
+            packets = self.queue.get_batch(1,1)
+            if not packets:
                 self.idle = True
                 continue
-            id,data = packet
-            now = time.time()
-            self.log.write("%f %d sending\n" % (now, id))
-            # calculate transmission delay
-            trans = float(len(data)*8) / (1000*1000*self.rate)
-            # sleep
-            time.sleep(trans)
+            self.idle = False
             now = time.time()
-            self.log.write("%f %d sent\n" % (now, id))
+            ready = []
+            while packets:
+                for id,data,queued in packets:
+                    if queued > departure:
+                        epoch = queued
+                        busy = 0.0
+                    start = epoch + busy
+                    # calculate transmission delay
+                    trans = float(len(data)*8) / (1000*1000*self.rate)
+                    longest = max(longest,trans)
+                    busy += trans
+                    departure = epoch + busy
+                    if self.log.file:
+                        self.log.event(start,id,"sending")
+                        self.log.event(departure,id,"sent")
+                    if self.metrics != None:
+                        self.metrics.queue_delay.observe(start - queued)
+                    ready.append((id,data,departure))
+                # take the packets the link will have started on within
+                # the quantum, if any are waiting; a packet queued while
+                # the link is busy starts when it is done
+                if (departure > now + self.quantum) or \
+                   (len(ready) >= self.burst):
+                    break
+                count = 1 + int((now + self.quantum - departure)/longest)
+                packets = self.queue.get_batch(0,min(count,
+                                                     self.burst - len(ready)))
+            if self.metrics != None:
+                self.metrics.sent.inc(len(ready))
+                self.metrics.sent_bytes.inc(sum([len(p[1]) for p in ready]))
             # queue for propagation delay
-            now = time.time()
-            self.prop_queue.put((id,data,now))
+            self.prop_queue.put(ready)
 
 class Propagation(threading.Thread):
     """
@@ -155,12 +317,14 @@ class Propagation(threading.Thread):
     from the queue and emulates the delay, then sends them on the UDP
     socket.
     """
-    def __init__(self,socket,queue,log,delay):
+    def __init__(self,socket,queue,log,delay,impair=None,metrics=None):
         """
         Initialize the handler:
         * socket  the UDP socket used for the link
         * queue   the outgoing queue for the link
         * delay   the propagation delay of the link, in ms
+        * impair  the Impairments to apply, or None
+        * metrics the LinkMetrics to count lost packets in, or None
         """
         threading.Thread.__init__(self)
         threading.Thread.daemon = True
@@ -168,25 +332,83 @@ class Propagation(threading.Thread):
         self.queue = queue
         self.log = log
         self.delay = float(delay)/1000
+        self.impair = impair
+        self.metrics = metrics
 
     def run(self):
         """ Continuously read data from the queue and emulate
         propagation delay.  Once the delay is finished, send it over
         the virtual link.  This method is activated by a call to
-        start() and runs in a separate thread."""
+        start() and runs in a separate thread.
+
+        Packets arrive in bursts, in the order they are due, so each
+        time it wakes up it sends every packet in the burst whose delay
+        has finished before sleeping again."""
+        if self.impair != None:
+            self.run_impaired()
+            return
         while True:
             # get data to send
-            id,data,then = self.queue.get()
+            packets = self.queue.get()
+            for id,data,then in packets:
+                now = time.time()
+                if (now - then) < self.delay:
+                    time.sleep(self.delay - (now - then))
+                # transmit the data over the socket
+                if not self.send(data):
+                    return
+
+    def run_impaired(self):
+        """ Emulate propagation delay with impairments.  Since delays
+        vary, packets are kept on a heap and sent when they are due,
+        not in the order they arrived.  A packet that arrives while
+        the handler sleeps cannot be due sooner than the shortest delay
+        the impairments give, so the handler never sleeps for longer
+        than that."""
+        heap = []
+        sequence = 0
+        earliest = max(self.impair.earliest(self.delay),0.001)
+        while True:
+            # take new packets, waiting for them only if none are due
+            while True:
+                if heap:
+                    try:
+                        packets = self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                else:
+                    packets = self.queue.get()
+                for id,data,then in packets:
+                    delays = self.impair.delays(self.delay)
+                    if not delays:
+                        self.log.event(then,id,"lost")
+                        if self.metrics != None:
+                            self.metrics.lost.inc()
+                    for delay in delays:
+                        sequence += 1
+                        heapq.heappush(heap,(then + delay,sequence,data))
+            # send whatever is due
             now = time.time()
-            if (now - then) < self.delay:
-                time.sleep(self.delay - (now - then))
-            # transmit the data over the socket
+            while heap and (heap[0][0] <= now):
+                if not self.send(heapq.heappop(heap)[2]):
+                    return
+            if heap:
+                time.sleep(min(heap[0][0] - now,earliest))
+
+    def send(self,data):
+        """ Send a packet on the UDP socket, waiting for room in the
+        socket's buffer if it is full.  Returns False on failure."""
+        while True:
             try:
                 self.socket.send(data)
-            except:
+                return True
+            except socket.error,e:
+                if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    select.select([],[self.socket],[],1)
+                    continue
                 print "Can't send on UDP socket"
                 print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
-                return
+                return False
 
 class Incoming(threading.Thread):
     """
@@ -194,12 +416,15 @@ class Incoming(threading.Thread):
     the UDP socket and puts them on the queue.  If the queue is full then
     packets are dropped.
     """
-    def __init__(self,socket,queue,log):
+    def __init__(self,socket,queue,log,batch=64,metrics=None):
         """
         Initialize the handler:
         * socket  the UDP socket used for the link
         * queue   the incoming queue for the link
         * log     a logging object
+        * batch   the most packets to read each time the socket
+                  becomes readable
+        * metrics the LinkMetrics to count packets in, or None
         """
         threading.Thread.__init__(self)
         threading.Thread.daemon = True
@@ -207,6 +432,8 @@ class Incoming(threading.Thread):
         self.log = log
         self.socket = socket
         self.queue = queue
+        self.batch = batch
+        self.metrics = metrics
         self.idle = False
         # set the maximum segment size for the link
         self.mss = 1500
@@ -214,25 +441,52 @@ class Incoming(threading.Thread):
     def run(self):
         """ Continuously receive data over the virtual link and add it
         to a queue.  This method is activated by a call to start() and
-        runs in a separate thread."""
+        runs in a separate thread.
+
+        It waits until the socket is readable, then reads up to (batch)
+        packets without waiting again and adds them to the queue
+        together, so a burst costs one wakeup, one system call per
+        packet and one acquisition of the queue's lock."""
         if not self.socket:
             return
         while True:
-            # receive incoming segment
-            try:
-                data,addr = self.socket.recvfrom(self.mss)
-                self.idle = False
-            except socket.timeout:
+            # wait for an incoming segment
+            readable,writable,errors = select.select([self.socket],[],[],1)
+            if not readable:
                 self.idle = True
                 continue
-            except:
-                print "Can't receive from UDP socket"
-                print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
-                return
+            # receive everything that has arrived; an ICMP error left by
+            # an earlier send, such as the other side having exited,
+            # also makes the socket readable, and only ends the batch
+            packets = []
+            failed = False
+            while len(packets) < self.batch:
+                try:
+                    packets.append(self.socket.recv(self.mss))
+                except socket.error,e:
+                    if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK,
+                                     errno.ECONNREFUSED):
+                        break
+                    print "Can't receive from UDP socket"
+                    print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
+                    failed = True
+                    break
+            if not packets:
+                self.idle = True
+                if failed:
+                    return
+                continue
+            self.idle = False
             now = time.time()
-            self.log.write("%f received\n" % (now))
+            for data in packets:
+                self.log.event(now,None,"received")
             # put data on incoming queue
-            try:
-                self.queue.put_nowait(data)
-            except Queue.Full:
-                pass
+            added = self.queue.put_batch(packets)
+            if self.metrics != None:
+                self.metrics.received.inc(len(packets))
+                self.metrics.received_bytes.inc(sum([len(p) for p in packets]))
+                if added < len(packets):
+                    self.metrics.dropped("incoming",len(packets) - added)
+            if failed:
+                self.idle = True
+                return
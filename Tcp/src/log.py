@@ -2,13 +2,16 @@
   Implements a thread safe logger
 
   Author: Daniel Zappala, Brigham Young University
-  
+
   This program is licensed under the GPL; see LICENSE for details.
 
 """
 
+import atexit
 import threading
 
+from tracefile import Trace
+
 class Log:
     def __init__(self,file):
         if file == None:
@@ -17,12 +20,44 @@ class Log:
         self.file = file
         if self.file:
             self.fh = open(self.file,'w')
+            atexit.register(self.close)
         self.sem = threading.Semaphore()
-        
+
     def write(self,str):
         if not self.file:
             return
         self.sem.acquire()
-        self.fh.write(str)
+        # the log may have been closed at exit while threads still run
+        if self.file:
+            self.fh.write(str)
         self.sem.release()
 
+    def event(self,time,id,kind,reason=None):
+        """ Log that packet (id) was (kind) at (time), for a reason if
+        it was dropped, as "time id kind [reason]".  Packets received
+        from the network have no id yet, and are logged as "time
+        kind"."""
+        if not self.file:
+            return
+        if id == None:
+            self.write("%f %s\n" % (time,kind))
+        elif reason == None:
+            self.write("%f %d %s\n" % (time,id,kind))
+        else:
+            self.write("%f %d %s %s\n" % (time,id,kind,reason))
+
+    def close(self):
+        if not self.file:
+            return
+        self.sem.acquire()
+        self.fh.close()
+        self.file = None
+        self.sem.release()
+
+
+def open_log(file):
+    """ Return a log for packet events in (file): a binary Trace if
+    the name ends in .trace, and a text Log otherwise."""
+    if file and file.endswith(".trace"):
+        return Trace(file)
+    return Log(file)
@@ -0,0 +1,313 @@
+"""
+  Implements live metrics for links and TCP sockets
+
+  A Registry holds counters, gauges and histograms, each named and
+  labeled as Prometheus expects, and renders them in the Prometheus
+  text format.  It can serve them over HTTP at /metrics, or write them
+  to a file every few seconds, while a run is in progress.  Links and
+  sockets given a registry keep their metrics in it through
+  LinkMetrics and SocketMetrics; without one they keep none, and pay
+  only for checking that they have none.
+
+  Gauges for queue lengths and socket state call a function when the
+  metrics are rendered, so they cost nothing between renderings.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import atexit
+import bisect
+import BaseHTTPServer
+import os
+import threading
+
+__all__ = [ "Registry","Counter","Gauge","Histogram","LinkMetrics",
+            "SocketMetrics","LATENCY_BUCKETS","add_metrics_options",
+            "create_metrics" ]
+
+# upper bounds of the default latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,
+                   0.5,1.0,2.5,5.0,10.0)
+
+def format_value(value):
+    if isinstance(value,(int,long)):
+        return "%d" % value
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    return repr(float(value))
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [(name,str(value).replace("\\","\\\\").replace('"','\\"')
+                .replace("\n","\\n")) for name,value in labels]
+    return "{%s}" % ",".join(['%s="%s"' % label for label in escaped])
+
+class Counter:
+    """ A count that only goes up."""
+    def __init__(self,labels):
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self,amount=1):
+        self.lock.acquire()
+        self.value += amount
+        self.lock.release()
+
+    def samples(self,name):
+        return [(name,self.labels,self.value)]
+
+
+class Gauge:
+    """ A value that goes up and down.  It is either set, or read from
+    (function) when the metrics are rendered."""
+    def __init__(self,labels,function=None):
+        self.labels = labels
+        self.value = 0
+        self.function = function
+
+    def set(self,value):
+        self.value = value
+
+    def samples(self,name):
+        if self.function != None:
+            return [(name,self.labels,self.function())]
+        return [(name,self.labels,self.value)]
+
+
+class Histogram:
+    """ Counts observations in buckets by their upper bound, and keeps
+    their count and sum."""
+    def __init__(self,labels,buckets=LATENCY_BUCKETS):
+        self.labels = labels
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self,value):
+        i = bisect.bisect_left(self.buckets,value)
+        self.lock.acquire()
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.lock.release()
+
+    def samples(self,name):
+        self.lock.acquire()
+        counts = list(self.counts)
+        total = self.sum
+        count = self.count
+        self.lock.release()
+        samples = []
+        cumulative = 0
+        for bound,n in zip(self.buckets + [float("inf")],counts):
+            cumulative += n
+            samples.append((name + "_bucket",
+                            self.labels + (("le",format_value(bound)),),
+                            cumulative))
+        samples.append((name + "_sum",self.labels,total))
+        samples.append((name + "_count",self.labels,count))
+        return samples
+
+
+class Registry:
+    """ Holds metrics by name and labels, and renders them."""
+    def __init__(self):
+        # name -> [kind,help,{labels : metric}], in the order added
+        self.families = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def metric(self,cls,kind,name,help,labels,*args):
+        """ Return the metric with (name) and (labels), creating it with
+        (cls) if there is none yet."""
+        labels = tuple(sorted(labels.items()))
+        self.lock.acquire()
+        try:
+            if name not in self.families:
+                self.families[name] = [kind,help,{}]
+                self.order.append(name)
+            family = self.families[name]
+            if family[0] != kind:
+                raise ValueError("%s is a %s, not a %s" % (name,family[0],kind))
+            if labels not in family[2]:
+                family[2][labels] = cls(labels,*args)
+            return family[2][labels]
+        finally:
+            self.lock.release()
+
+    def counter(self,name,help,**labels):
+        return self.metric(Counter,"counter",name,help,labels)
+
+    def gauge(self,name,help,function=None,**labels):
+        """ Return the gauge with (name) and (labels).  If (function)
+        is given it replaces that of an existing gauge, so that a new
+        socket on a port reused after an earlier one is closed reports
+        its own state rather than the earlier one's."""
+        gauge = self.metric(Gauge,"gauge",name,help,labels,function)
+        if function != None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self,name,help,buckets=LATENCY_BUCKETS,**labels):
+        return self.metric(Histogram,"histogram",name,help,labels,buckets)
+
+    def expose(self):
+        """ Return every metric in the Prometheus text format."""
+        self.lock.acquire()
+        families = [(name,) + tuple(self.families[name][:2]) +
+                    (self.families[name][2].values(),)
+                    for name in self.order]
+        self.lock.release()
+        lines = []
+        for name,kind,help,metrics in families:
+            lines.append("# HELP %s %s\n" % (name,help))
+            lines.append("# TYPE %s %s\n" % (name,kind))
+            for metric in metrics:
+                for sample,labels,value in metric.samples(name):
+                    lines.append("%s%s %s\n" % (sample,format_labels(labels),
+                                                format_value(value)))
+        return "".join(lines)
+
+    def serve(self,port,addr="localhost"):
+        """ Serve the metrics over HTTP at http://addr:port/metrics from
+        a background thread.  Returns the server."""
+        registry = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/","/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.expose()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,format,*args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((addr,port),Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def snapshot(self,file,interval=None):
+        """ Write the metrics to (file), replacing it at once so that
+        readers never see half of it.  If (interval) is given, keep
+        doing so every (interval) seconds from a background thread,
+        and once more when the program exits."""
+        if interval == None:
+            fh = open(file + ".tmp",'w')
+            fh.write(self.expose())
+            fh.close()
+            os.rename(file + ".tmp",file)
+            return
+        stopped = threading.Event()
+        def run():
+            while not stopped.is_set():
+                stopped.wait(interval)
+                self.snapshot(file)
+        def stop():
+            stopped.set()
+            self.snapshot(file)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        atexit.register(stop)
+
+
+class LinkMetrics:
+    """ The metrics of one link, labeled with its name."""
+    def __init__(self,registry,link):
+        self.registry = registry
+        self.link = link
+        self.enqueued = registry.counter("link_enqueued_packets_total",
+            "Packets added to the outgoing queue",link=link)
+        self.sent = registry.counter("link_sent_packets_total",
+            "Packets transmitted",link=link)
+        self.sent_bytes = registry.counter("link_sent_bytes_total",
+            "Bytes transmitted",link=link)
+        self.received = registry.counter("link_received_packets_total",
+            "Packets received",link=link)
+        self.received_bytes = registry.counter("link_received_bytes_total",
+            "Bytes received",link=link)
+        self.lost = registry.counter("link_lost_packets_total",
+            "Packets lost to impairments",link=link)
+        self.queue_delay = registry.histogram("link_queue_delay_seconds",
+            "Time from being queued to starting transmission",link=link)
+        self.drops = {}
+
+    def dropped(self,reason,count=1):
+        """ Count (count) packets dropped for (reason)."""
+        counter = self.drops.get(reason)
+        if counter == None:
+            counter = self.registry.counter("link_dropped_packets_total",
+                "Packets dropped, by reason",link=self.link,reason=reason)
+            self.drops[reason] = counter
+        counter.inc(count)
+
+    def watch(self,out_queue,in_queue):
+        """ Report the lengths of the link's queues."""
+        self.registry.gauge("link_out_queue_packets",
+            "Packets in the outgoing queue",out_queue.qsize,link=self.link)
+        self.registry.gauge("link_in_queue_packets",
+            "Packets in the incoming queue",in_queue.qsize,link=self.link)
+
+
+class SocketMetrics:
+    """ The metrics of one TCP socket, labeled with the name of its
+    link and its port."""
+    def __init__(self,registry,link,port,socket):
+        self.segments = registry.counter("tcp_segments_sent_total",
+            "Data segments sent, including retransmissions",link=link,
+            port=port)
+        self.retransmissions = registry.counter("tcp_retransmissions_total",
+            "Data segments retransmitted",link=link,port=port)
+        self.timeouts = registry.counter("tcp_timeouts_total",
+            "Retransmission timer expiries",link=link,port=port)
+        self.received = registry.counter("tcp_segments_received_total",
+            "Data segments received",link=link,port=port)
+        self.rtt = registry.histogram("tcp_rtt_seconds",
+            "Round trip time samples",link=link,port=port)
+        registry.gauge("tcp_cwnd_bytes","Congestion window",
+                       lambda: int(socket.cc.cwnd*socket.packetsize),
+                       link=link,port=port)
+        registry.gauge("tcp_srtt_seconds","Smoothed round trip time",
+                       lambda: socket.rtt.srtt or 0.0,link=link,port=port)
+        registry.gauge("tcp_rto_seconds","Retransmission timeout",
+                       lambda: socket.rtt.rto,link=link,port=port)
+
+
+def add_metrics_options(parser):
+    """ Add options for exporting metrics to (parser)."""
+    parser.add_option("","--metrics-port",type="int",dest="metrics_port",
+                      default=None,
+                      help="serve metrics over HTTP on this port")
+    parser.add_option("","--metrics-file",type="string",dest="metrics_file",
+                      default=None,
+                      help="write metrics to this file periodically")
+    parser.add_option("","--metrics-interval",type="float",
+                      dest="metrics_interval",default=1.0,
+                      help="seconds between writes of --metrics-file")
+
+def create_metrics(options):
+    """ Return a Registry exported as chosen by (options), or None if
+    metrics are not wanted."""
+    if (options.metrics_port == None) and (options.metrics_file == None):
+        return None
+    registry = Registry()
+    if options.metrics_port != None:
+        registry.serve(options.metrics_port)
+    if options.metrics_file != None:
+        registry.snapshot(options.metrics_file,options.metrics_interval)
+    return registry
@@ -0,0 +1,312 @@
+"""
+  Implements queue disciplines for the outgoing buffer of a link
+
+  A discipline decides which packets to drop.  Drop-tail disciplines
+  drop arrivals when the buffer is full, counted in packets or in
+  bytes.  RED drops arrivals early, with a probability that grows with
+  the average queue length, and CoDel drops packets as they leave if
+  they have spent too long in the queue.  The link logs every drop
+  that happens on arrival, and CoDel logs its own, as
+
+    time id dropped reason
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import math
+import Queue
+import random
+import time
+
+from link import *
+from log import *
+
+__all__ = [ "Discipline","DropTail","ByteDropTail","RED","CoDel","QUEUES",
+            "add_queue_options","create_queue" ]
+
+class Discipline(PacketQueue):
+    """
+    Base class for queue disciplines.  Items are (id,data,queued)
+    tuples, where queued is the time the packet arrived.  The queue
+    itself is unbounded; subclasses decide which packets to admit with
+    admit(), and may drop packets as they leave by overriding
+    _take().
+    """
+    def __init__(self,size):
+        """
+        Initialize the discipline:
+        * size    the most packets the buffer holds
+        """
+        PacketQueue.__init__(self,0)
+        self.size = size
+        # bytes queued, the clock to use, and where to log and count
+        # drops made as packets leave; links set the last three
+        self.bytes = 0
+        self.clock = time.time
+        self.log = Log(None)
+        self.metrics = None
+
+    def _put(self,item):
+        self.queue.append(item)
+        self.bytes += len(item[1])
+
+    def _get(self):
+        item = self.queue.popleft()
+        self.bytes -= len(item[1])
+        return item
+
+    def put(self,item,block=True,timeout=None):
+        """ Add (item) to the queue, or raise Queue.Full with the
+        reason if the discipline drops it.  Never blocks."""
+        self.mutex.acquire()
+        try:
+            reason = self.admit(item)
+            if reason != None:
+                raise Queue.Full(reason)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.mutex.release()
+
+    def admit(self,item):
+        """ Return the reason to drop (item) as it arrives, or None to
+        queue it.  Called with the lock held."""
+        return None
+
+    def dropped(self,item,reason):
+        """ Log a packet dropped as it leaves."""
+        self.log.event(self.clock(),item[0],"dropped",reason)
+        if self.metrics != None:
+            self.metrics.dropped(reason)
+
+
+class DropTail(Discipline):
+    """ Drops arrivals when the buffer holds (size) packets."""
+    def admit(self,item):
+        if self._qsize() >= self.size:
+            return "droptail"
+        return None
+
+
+class ByteDropTail(Discipline):
+    """ Drops arrivals that would take the buffer past a number of
+    bytes."""
+    def __init__(self,size,limit):
+        """
+        Initialize the discipline:
+        * size    ignored; the buffer is limited by bytes alone
+        * limit   the most bytes the buffer holds
+        """
+        Discipline.__init__(self,size)
+        self.limit = limit
+
+    def admit(self,item):
+        if self.bytes + len(item[1]) > self.limit:
+            return "bytes"
+        return None
+
+
+class RED(Discipline):
+    """ Random Early Detection (Floyd and Jacobson, 1993).  Keeps an
+    exponentially weighted average of the queue length, and drops
+    arrivals with a probability that rises from 0 to (probability) as
+    the average goes from (minimum) to (maximum) packets, and always
+    above (maximum)."""
+    def __init__(self,size,minimum=5,maximum=15,probability=0.1,
+                 weight=0.002,rate=None,seed=None):
+        """
+        Initialize the discipline:
+        * size         the most packets the buffer holds
+        * minimum      average queue length to start dropping at
+        * maximum      average queue length to drop everything above
+        * probability  drop probability as the average reaches maximum
+        * weight       weight of each new sample in the average
+        * rate         the rate of the link, in Mbps; if given, the
+                       average decays while the queue is empty as if
+                       full sized packets had arrived to an empty queue
+        * seed         seed for the random drop decisions
+        """
+        Discipline.__init__(self,size)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.probability = probability
+        self.weight = weight
+        self.typical = None
+        if rate:
+            self.typical = 1500*8.0/(rate*1000*1000)
+        self.random = random.Random(seed)
+        self.average = 0.0
+        # arrivals since the last drop, and when the queue went empty
+        self.count = -1
+        self.empty = None
+
+    def _get(self):
+        item = Discipline._get(self)
+        if not self.queue:
+            self.empty = self.clock()
+        return item
+
+    def admit(self,item):
+        length = self._qsize()
+        if (length == 0) and (self.empty != None) and self.typical:
+            idle = (self.clock() - self.empty)/self.typical
+            self.average *= (1 - self.weight)**idle
+        else:
+            self.average = (1 - self.weight)*self.average + \
+                           self.weight*length
+        if self.average >= self.maximum:
+            self.count = 0
+            return "red-forced"
+        if self.average >= self.minimum:
+            self.count += 1
+            p = self.probability*(self.average - self.minimum) / \
+                (self.maximum - self.minimum)
+            if self.count*p < 1:
+                p = p/(1 - self.count*p)
+            else:
+                p = 1
+            if self.random.random() < p:
+                self.count = 0
+                return "red-early"
+        else:
+            self.count = -1
+        if length >= self.size:
+            return "red-overflow"
+        return None
+
+
+class CoDel(Discipline):
+    """ Controlled Delay (RFC 8289).  Once packets have spent longer
+    than (target) in the queue for at least (interval), drops packets
+    as they leave, more often the longer the delay persists."""
+    def __init__(self,size,target=0.005,interval=0.1,mtu=1500):
+        """
+        Initialize the discipline:
+        * size      the most packets the buffer holds
+        * target    acceptable queueing delay, in seconds; at low
+                    rates it should be at least the time to send one
+                    packet
+        * interval  how long the delay may exceed target before
+                    dropping starts, in seconds
+        * mtu       never drop when this many bytes or fewer remain
+        """
+        Discipline.__init__(self,size)
+        self.target = target
+        self.interval = interval
+        self.mtu = mtu
+        self.first_above_time = 0
+        self.drop_next = 0
+        self.count = 0
+        self.lastcount = 0
+        self.dropping = False
+
+    def admit(self,item):
+        if self._qsize() >= self.size:
+            return "codel-overflow"
+        return None
+
+    def _take(self,count):
+        items = []
+        while self._qsize() and (len(items) < count):
+            item = self.codel_dequeue(self.clock())
+            if item != None:
+                items.append(item)
+        return items
+
+    def control_law(self,t):
+        return t + self.interval/math.sqrt(self.count)
+
+    def do_dequeue(self,now):
+        """ Remove the next packet, and return it and whether it has
+        been above target long enough that it may be dropped."""
+        if not self._qsize():
+            self.first_above_time = 0
+            return None,False
+        item = self._get()
+        ok_to_drop = False
+        if (now - item[2] < self.target) or (self.bytes <= self.mtu):
+            self.first_above_time = 0
+        elif self.first_above_time == 0:
+            self.first_above_time = now + self.interval
+        elif now >= self.first_above_time:
+            ok_to_drop = True
+        return item,ok_to_drop
+
+    def codel_dequeue(self,now):
+        """ Remove and return the next packet that is not dropped, or
+        None if every packet is dropped."""
+        item,ok_to_drop = self.do_dequeue(now)
+        if item == None:
+            self.dropping = False
+            return None
+        if self.dropping:
+            if not ok_to_drop:
+                self.dropping = False
+            while self.dropping and (now >= self.drop_next):
+                self.dropped(item,"codel")
+                self.count += 1
+                item,ok_to_drop = self.do_dequeue(now)
+                if not ok_to_drop:
+                    self.dropping = False
+                else:
+                    self.drop_next = self.control_law(self.drop_next)
+        elif ok_to_drop:
+            self.dropped(item,"codel")
+            item,ok_to_drop = self.do_dequeue(now)
+            self.dropping = True
+            delta = self.count - self.lastcount
+            if (delta > 1) and (now - self.drop_next < 16*self.interval):
+                self.count = delta
+            else:
+                self.count = 1
+            self.drop_next = self.control_law(now)
+            self.lastcount = self.count
+        return item
+
+
+QUEUES = { "droptail" : DropTail,
+           "bytes" : ByteDropTail,
+           "red" : RED,
+           "codel" : CoDel }
+
+def add_queue_options(parser):
+    """ Add options for choosing a queue discipline to (parser)."""
+    parser.add_option("","--queue",type="choice",dest="queue",
+                      choices=sorted(QUEUES.keys()),default=None,
+                      help="queue discipline: bytes, codel, droptail or red")
+    parser.add_option("","--queue-bytes",type="int",dest="queue_bytes",
+                      default=None,
+                      help="size of the link queue in bytes, for --queue bytes; 1500 times --size by default")
+    parser.add_option("","--red-min",type="float",dest="red_min",
+                      default=5,
+                      help="average queue length RED starts dropping at")
+    parser.add_option("","--red-max",type="float",dest="red_max",
+                      default=15,
+                      help="average queue length RED drops everything above")
+    parser.add_option("","--red-p",type="float",dest="red_p",
+                      default=0.1,
+                      help="RED drop probability at --red-max")
+    parser.add_option("","--codel-target",type="float",dest="codel_target",
+                      default=5,
+                      help="CoDel target queueing delay in ms")
+    parser.add_option("","--codel-interval",type="float",dest="codel_interval",
+                      default=100,
+                      help="CoDel interval in ms")
+
+def create_queue(options):
+    """ Return the queue discipline chosen by (options), or None for
+    the default queue.  Uses the size and rate options as well."""
+    if options.queue == "droptail":
+        return DropTail(options.size)
+    if options.queue == "bytes":
+        return ByteDropTail(options.size,
+                            options.queue_bytes or 1500*options.size)
+    if options.queue == "red":
+        return RED(options.size,options.red_min,options.red_max,
+                   options.red_p,rate=options.rate)
+    if options.queue == "codel":
+        return CoDel(options.size,options.codel_target/1000,
+                     options.codel_interval/1000)
+    return None
@@ -0,0 +1,180 @@
+"""
+  Runs experiments in virtual time
+
+  "python simulate.py tcp" sends a message over a pair of virtual
+  links with the event driven TCP sockets, writing the same link and
+  congestion window logs as source.py, but with virtual times.  Queue
+  disciplines and impairments apply to the forward link, which
+  carries the data.
+
+  "python simulate.py delay" sends a constant bit rate stream over one
+  virtual link and writes a trace of when each packet was sent and
+  received, in the format of the ns-3 TraceDelay output read by
+  delay/src/Graph/scatterplot.py.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+# Python imports
+import optparse
+import struct
+import sys
+import time
+
+# local imports
+from eventtcp import *
+from impair import *
+from metrics import *
+from queues import *
+from tcp import *
+from virtual import *
+
+# sequence number and send time at the start of each delay packet,
+# like the ns-3 SeqTsHeader
+STAMP = struct.Struct("!Id")
+
+class Simulation:
+    def __init__(self,rate,delay,size,log=None,queue=None,impair=None,
+                 metrics=None):
+        self.loop = VirtualLoop()
+        self.rate = rate
+        self.delay = delay
+        self.size = size
+        self.forward = VirtualLink(size,rate,delay,log,self.loop,queue,impair,
+                                   metrics)
+        self.reverse = VirtualLink(size,rate,delay,None,self.loop,
+                                   metrics=metrics)
+        self.forward.connect(self.reverse)
+
+    def tcp(self,length,tcp_size,congestion="newreno",cwndLog=None,
+            packetsize=1024,wide=None,sack=True,granularity=0.2):
+        """ Send a message of (length) bytes from one end to the other.
+        Returns the sending socket and whether the message arrived
+        intact.
+
+        Virtual time has no jitter, so the RTT variance decays to
+        nothing whenever the queue is steady, and the timer then fires
+        as soon as the queue grows by a packet.  (granularity) sets the
+        smallest variance term in the timeout, as a real clock
+        would."""
+        source = EventTCPSocket(self.forward,EventTCP(self.forward),tcp_size,
+                                1,1,congestion,cwndLog,packetsize,wide)
+        source.sack = sack
+        source.rtt.granularity = granularity
+        dest = EventTCPSocket(self.reverse,EventTCP(self.reverse),tcp_size,
+                              1,1,congestion)
+        data = "H" * length
+        result = []
+        dest.recv(result.append)
+        source.send(data)
+        self.loop.run()
+        return source,(result == [data])
+
+    def cbr(self,trace,count,packetsize,load):
+        """ Send (count) packets of (packetsize) bytes, spaced so that
+        they offer (load) times the link rate, and write a line to
+        (trace) when each one is sent and received."""
+        interval = float(packetsize*8) / (1000*1000*self.rate*load)
+        def send(seq):
+            now = self.loop.clock()
+            trace.write("TraceDelay TX %d bytes to 10.1.1.2 Uid: %d Time: %.9g\n" %
+                        (packetsize,seq,now))
+            packet = STAMP.pack(seq,now) + "x" * (packetsize - STAMP.size)
+            self.forward.enqueue(seq,packet)
+            if seq + 1 < count:
+                self.loop.schedule(now + interval,send,seq + 1)
+        def receive(packet):
+            now = self.loop.clock()
+            seq,sent = STAMP.unpack_from(packet)
+            # the payload size reported excludes the header
+            trace.write("TraceDelay: RX %d bytes from 10.1.1.1 Sequence Number: %d Uid: %d TXtime: +%.1fns RXtime: +%.1fns Delay: +%.1fns\n" %
+                        (len(packet) - 12,seq,seq,sent*1e9,now*1e9,
+                         (now - sent)*1e9))
+        self.reverse.receiver = receive
+        self.loop.schedule(0,send,0)
+        self.loop.run()
+
+
+def parse_options():
+    """ Parse options. """
+    parser = optparse.OptionParser(usage = "%prog [options] tcp|delay",
+                                   version = "%prog 0.1")
+
+    parser.add_option("","--rate",type="float",dest="rate",
+                      default=1.0,
+                      help="bandwidth of the link in Mbps")
+    parser.add_option("","--delay",type="int",dest="delay",
+                      default=100,
+                      help="propagation delay of the link in ms")
+    parser.add_option("","--size",type="int",dest="size",
+                      default=100,
+                      help="size of the link queues")
+    parser.add_option("","--log",type="string",dest="log",
+                      default=None,
+                      help="log file for the forward link, or a binary trace if it ends in .trace")
+    parser.add_option("","--bytes",type="int",dest="bytes",
+                      default=1024*1000,
+                      help="size of the TCP message in bytes")
+    parser.add_option("","--tcp-size",type="int",dest="tcp_size",
+                      default=100,
+                      help="size of the TCP queues")
+    parser.add_option("","--cc",type="choice",dest="cc",
+                      choices=sorted(CONGESTION.keys()),default="newreno",
+                      help="congestion control: cubic, newreno, reno or tahoe")
+    parser.add_option("","--cwnd-log",type="string",dest="cwnd_log",
+                      default=None,
+                      help="log the congestion window to this file")
+    parser.add_option("","--packet-size",type="int",dest="packet_size",
+                      default=None,
+                      help="bytes in a TCP segment (1024) or delay packet (1472)")
+    parser.add_option("","--wide",action="store_true",dest="wide",
+                      default=None,
+                      help="always use 32-bit segment ids")
+    parser.add_option("","--no-sack",action="store_false",dest="sack",
+                      default=True,
+                      help="ignore selective acknowledgements when sending")
+    parser.add_option("","--granularity",type="float",dest="granularity",
+                      default=0.2,
+                      help="clock granularity of the TCP timer, in seconds")
+    add_queue_options(parser)
+    add_impairment_options(parser)
+    add_metrics_options(parser)
+    parser.add_option("","--packets",type="int",dest="packets",
+                      default=10000,
+                      help="number of packets in the delay stream")
+    parser.add_option("","--load",type="float",dest="load",
+                      default=0.9,
+                      help="offered load of the delay stream, as a fraction of the rate")
+    parser.add_option("","--trace",type="string",dest="trace",
+                      default=None,
+                      help="file to write the delay trace to, instead of stdout")
+
+    (options,args) = parser.parse_args()
+    return options,args
+
+if __name__ == '__main__':
+    options,args = parse_options()
+    sim = Simulation(options.rate,options.delay,options.size,options.log,
+                     create_queue(options),create_impairments(options),
+                     create_metrics(options))
+    start = time.time()
+    if not args or args[0] == "tcp":
+        s,ok = sim.tcp(options.bytes,options.tcp_size,options.cc,
+                       options.cwnd_log,options.packet_size or 1024,
+                       options.wide,options.sack,options.granularity)
+        print "%s in %f virtual seconds, %f real seconds" % \
+            ("received" if ok else "FAILED",sim.loop.clock(),
+             time.time() - start)
+        print s.stats()
+    elif args[0] == "delay":
+        trace = sys.stdout
+        if options.trace != None:
+            trace = open(options.trace,'w')
+        sim.cbr(trace,options.packets,options.packet_size or 1472,
+                options.load)
+        if options.trace != None:
+            trace.close()
+    else:
+        print "Unknown experiment",args[0]
+        sys.exit(1)
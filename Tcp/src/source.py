@@ -8,27 +8,35 @@
 """
 
 # Python imports
+import hashlib
+import mmap
 import optparse
+import os
 import sys
 
 # local imports
+from impair import *
 from link import *
+from metrics import *
+from queues import *
 from tcp import *
 
 class Source:
-    def __init__(self,link,size,):
+    def __init__(self,link,size,congestion="newreno",cwndLog=None,
+                 packetsize=1024,wide=None):
         self.link = link
         self.tcp = TCP(link)
         self.tcp.start()
-        self.socket1 = TCPSocket(link,self.tcp,size,1,1)
-        self.socket2 = TCPSocket(link,self.tcp,size,2,2)
+        self.socket1 = TCPSocket(link,self.tcp,size,1,1,congestion,cwndLog,
+                                 packetsize,wide)
+        self.socket2 = TCPSocket(link,self.tcp,size,2,2,congestion)
 
     def start(self):
         packetsize = 1024
         numOfPackets = 1000
         f = open('TestFile','r+')
         count = 1
-        msg = f.read()
+        msg = f.read(1)
         if (msg == ''):
             while (numOfPackets>0):
                 while (count<packetsize):
@@ -38,12 +46,33 @@ class Source:
                 numOfPackets -= 1 
                 count = 1
             f.write(msg)            
-            msg = f.read();
-        self.socket1.send(msg)
+        # stream the file, so it is never all in memory
+        f.seek(0)
+        self.socket1.sendStream(f)
+        f.close()
         self.socket2.send("hello 1")
         # wait for link to be idle before ending
         self.link.idle()
 
+    def sendFile(self,name):
+        """ Send the file (name) on the first socket, reading it through
+        a memory map, so segments are copied straight from the page
+        cache, then send its MD5 checksum on the second socket."""
+        f = open(name,'rb')
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # an empty file can not be mapped
+            digest = hashlib.md5().hexdigest()
+            self.socket1.sendStream(f,0)
+        else:
+            m = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            digest = hashlib.md5(m).hexdigest()
+            self.socket1.sendStream(m,size)
+            m.close()
+        f.close()
+        self.socket2.send("md5 %s" % digest)
+        self.link.idle()
+
 
 def parse_options():
     """ Parse options. """
@@ -67,13 +96,31 @@ def parse_options():
                       help="size of the link queues")
     parser.add_option("","--log",type="string",dest="log",
                       default=None,
-                      help="log file")
+                      help="log file, or a binary trace if it ends in .trace")
+    add_queue_options(parser)
+    add_impairment_options(parser)
+    add_metrics_options(parser)
     parser.add_option("","--tcp-size",type="int",dest="tcp_size",
                       default=100,
                       help="size of the TCP queues")
+    parser.add_option("","--cc",type="choice",dest="cc",
+                      choices=sorted(CONGESTION.keys()),default="newreno",
+                      help="congestion control: cubic, newreno, reno or tahoe")
+    parser.add_option("","--cwnd-log",type="string",dest="cwnd_log",
+                      default=None,
+                      help="log the congestion window to this file")
+    parser.add_option("","--packet-size",type="int",dest="packet_size",
+                      default=1024,
+                      help="most data to put in a TCP segment, in bytes")
+    parser.add_option("","--wide",action="store_true",dest="wide",
+                      default=None,
+                      help="always use 32-bit segment ids")
     parser.add_option("","--verbose",action="store_true",dest="verbose",
                       default=False,
                       help="print statistics")
+    parser.add_option("","--file",type="string",dest="file",
+                      default=None,
+                      help="send this file, with its checksum, instead of TestFile")
 
     (options,args) = parser.parse_args()
     return options
@@ -95,8 +142,16 @@ if __name__ == '__main__':
     l = Link(size=options.size,rate=options.rate,delay=options.delay,
              log_name=options.log,
              from_addr=from_addr,from_port=from_port,
-             to_addr=to_addr,to_port=to_port)
+             to_addr=to_addr,to_port=to_port,queue=create_queue(options),
+             impair=create_impairments(options),
+             metrics=create_metrics(options))
 
     # create and run source
-    s = Source(l,options.tcp_size)
-    s.start()
+    s = Source(l,options.tcp_size,options.cc,options.cwnd_log,
+               options.packet_size,options.wide)
+    if options.file != None:
+        s.sendFile(options.file)
+    else:
+        s.start()
+    if options.verbose:
+        print s.socket1.stats()
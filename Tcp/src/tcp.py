@@ -8,21 +8,47 @@
 """
 
 import Queue
+import bisect
 import struct
 import sys
 import threading
 import time
 
-__all__ = [ "TCP","TCPSocket" ]
+from log import *
+from metrics import *
+
+__all__ = [ "TCP","TCPSocket","TCPPacket","RTTEstimator","CongestionControl",
+            "Tahoe","Reno","NewReno","Cubic","CONGESTION","ACK","WIDE","FIN" ]
+
+# header flags; FIN marks the last segment of a stream, whose length
+# is not known when it starts
+ACK = 1
+WIDE = 2
+FIN = 4
+
+# packet formats, compiled once; the flags come before the id, so they
+# are in the same place in the narrow and wide headers
+HEADER = struct.Struct("!HHHHHHH")
+WIDE_HEADER = struct.Struct("!HHHHHII")
+SACK = struct.Struct("!HH")
+WIDE_SACK = struct.Struct("!II")
 
 class TCP(threading.Thread):
     """ Emulate TCP on a host. """
-    def __init__(self,link):
+    def __init__(self,link,batch=64):
+        """
+        Initialize the demultiplexer:
+        * link   the link to receive packets from
+        * batch  the most packets to take from the link at once
+        """
         self.link = link
+        self.batch = batch
         threading.Thread.__init__(self)
         threading.Thread.daemon = True
         self.sem = threading.Semaphore()
         self.binding = {}
+        # packets dropped because a socket's buffer was full, by port
+        self.drops = {}
 
     def bind(self,port,socket):
         """ Bind a socket to the requested port.
@@ -32,7 +58,9 @@ class TCP(threading.Thread):
         bound port will be passed to the supplied socket.
 
         Note: all access to memory that is shared among all sockets
-        must be protected with a semaphore.
+        must be protected with a semaphore.  The binding map is copied
+        and replaced rather than modified, so the receiving thread can
+        read it without taking the semaphore.
 
         """
         # lock
@@ -42,7 +70,9 @@ class TCP(threading.Thread):
         if (port) in self.binding:
             self.sem.release()
             raise 'AddressInUse'
-        self.binding[port] = socket
+        binding = dict(self.binding)
+        binding[port] = socket
+        self.binding = binding
 
         # unlock
         self.sem.release()
@@ -51,33 +81,55 @@ class TCP(threading.Thread):
         """ Remove the binding for a socket."""
         self.sem.acquire()
         if port in self.binding:
-            del self.binding[port]
+            binding = dict(self.binding)
+            del binding[port]
+            self.binding = binding
         self.sem.release()
 
     # this method will run when the thread is started
     def run(self):
         while (True):
-            packet = self.link.dequeue(None)
-            u = TCPPacket()
-            try:        
-                u.unpack(packet)
-            except:
-                print "Exception: unpacking a TCP packet"
-                print "  ",sys.exc_info()[0],sys.exc_info()[1]
-                return
+            packets = self.link.dequeue_batch(None,self.batch)
+            binding = self.binding
+            for packet in packets:
+                u = TCPPacket()
+                try:        
+                    u.unpack(packet)
+                except:
+                    print "Exception: unpacking a TCP packet"
+                    print "  ",sys.exc_info()[0],sys.exc_info()[1]
+                    continue
 
-            # find binding for port and deliver to appropriate socket
-            if u.destPort in self.binding:
-                try:
-                    self.binding[u.destPort].buffer.put_nowait(packet)
-                except Queue.Full:
-                    # drop packet if full
-                    pass
+                # find binding for port and deliver the decoded packet
+                # to the appropriate socket
+                if u.destPort in binding:
+                    try:
+                        binding[u.destPort].buffer.put_nowait(u)
+                    except Queue.Full:
+                        # drop packet if full
+                        self.drops[u.destPort] = self.drops.get(u.destPort,0) + 1
 
 
 class TCPSocket:
     """ Emulate a TCP socket on a host."""
-    def __init__(self,link,tcp,size,sourcePort,destPort):
+    def __init__(self,link,tcp,size,sourcePort,destPort,
+                 congestion="newreno",cwndLog=None,packetsize=1024,wide=None):
+        """
+        Initialize the socket:
+        * link        the link to send packets on
+        * tcp         the TCP demultiplexer to bind to
+        * size        the size of the socket's receive buffer
+        * sourcePort  the port on this host
+        * destPort    the port on the other host
+        * congestion  the name of the congestion control algorithm, one
+                      of the keys of CONGESTION
+        * cwndLog     file to log the congestion window to, as lines of
+                      "time cwnd" with cwnd in bytes
+        * packetsize  the most data to put in a segment, in bytes
+        * wide        whether to use 32-bit segment ids; if None, they
+                      are used only for messages of more than 65535
+                      segments
+        """
         self.link = link
         self.buffer = Queue.Queue(size)
         self.sourcePort = sourcePort
@@ -85,149 +137,763 @@ class TCPSocket:
         self.tcp = tcp
         self.tcp.bind(sourcePort,self)
         self.packets = []
-        self.packetsize = 1024
-        self.acks = []
+        self.wide = wide
+        self.setPacketSize(packetsize)
         self.window = 100
-        self.timeout = 1
+        self.sack = True
+        self.sackBlocks = 16
+        self.rtt = RTTEstimator()
+        self.cc = CONGESTION[congestion]()
+        self.cwndLog = Log(cwndLog)
+        self.cwnd = None
+        self.clock = time.time
+        self.start = self.clock()
+        self.retries = 5
+        self.retransmissions = 0
+        self.goodput = None
+        # sockets keep metrics in the registry of their link, if it has
+        # one
+        self.metrics = None
+        linkMetrics = getattr(link,"metrics",None)
+        if linkMetrics != None:
+            self.metrics = SocketMetrics(linkMetrics.registry,
+                                         linkMetrics.link,sourcePort,self)
+
     # sending data
     def send(self,data):
-        """ Send a TCP packet. """
-        # make a packet
-        self.segmentData(data)
-        ackIDs = self.sendPackets(None,True) 
-        #print len(ackIDs)
-        count = 0
-        while (len(ackIDs)!= 0) and (count < 5) :
-            prevIDs = len(ackIDs)
-            ackIDs = self.sendPackets(ackIDs,False)
-            if(len(ackIDs) == prevIDs):
-                count += 1
+        """ Send data reliably using a sliding window.
+
+        The number of segments outstanding is limited by both (window)
+        and the congestion window.  The window advances as cumulative
+        ACKs arrive.  Three duplicate ACKs trigger a fast retransmit of
+        the oldest unacknowledged segment, and that segment is also
+        retransmitted if it has been outstanding for longer than the
+        retransmission timeout estimated by (rtt).  Gives up after
+        (retries) consecutive timeouts.  Returns the number of bytes
+        sent.
+
+        If (sack) is set, the selective acknowledgements carried by
+        ACKs are kept in a scoreboard, and the window limits the
+        estimated number of segments in the network rather than the
+        span from the oldest outstanding segment (RFC 6675).  Holes
+        with at least three selectively acknowledged segments above
+        them are considered lost and are retransmitted ahead of new
+        data, without waiting for the timer.
+        """
+        self.beginSend(data)
+        self.transfer()
         return len(data)
-    
-    def sendPackets(self,ids,newMsg):        
-        # send the packet
-        if(ids == None):
-            id = 0        
-            for packet in self.packets: 
-                self.link.enqueue(id,packet)
-                id += 1
+
+    def sendStream(self,source,length=None):
+        """ Send the data read from (source), a file or an iterator of
+        strings, reliably as send() does, and return the number of
+        bytes sent.
+
+        Segments are read from the source only as the window reaches
+        them and dropped once acknowledged, so no more than (window)
+        of them are held at once however long the stream is.  If the
+        (length) of the stream is given, in bytes, segments carry the
+        number of segments as a message does, so the receiver can
+        prepare for all of them; it must be exact.  Otherwise the
+        length is not sent ahead, and the last segment has the FIN
+        flag instead.  Streams of unknown length use 32-bit segment
+        ids unless (wide) is False."""
+        self.beginStream(source,length)
+        self.transfer()
+        return self.length
+
+    def transfer(self):
+        """ Send the segments set up by beginSend or beginStream until
+        they are all acknowledged or the sender gives up."""
+        while not self.sendDone():
+            self.refill()
+            self.fillWindow(self.total)
+            wait = self.sent[self.base] + self.rtt.rto - self.clock()
+            ack = self.recvAck(wait)
+            if ack == None:
+                self.timedOut()
+            else:
+                self.handleAck(ack)
+            self.logCwnd()
+        self.endSend()
+
+    def beginSend(self,data):
+        """ Segment (data) and reset the sending state for it."""
+        self.length = len(data)
+        self.segmentData(data)
+        self.total = len(self.packets)
+        self.source = None
+        self.ended = True
+        self.resetSend()
+
+    def beginStream(self,source,length=None):
+        """ Start reading segments from (source) and reset the sending
+        state for them.  (packets) holds the segments read and not yet
+        acknowledged, by id - 1, (total) is the number read so far,
+        and (count) is the number there will be, or 0 if unknown."""
+        self.length = 0
+        self.packets = {}
+        self.total = 0
+        self.source = chunked(source,self.packetsize)
+        self.ended = False
+        self.count = 0
+        if length != None:
+            self.count = (length + self.packetsize - 1)/self.packetsize
+        self.sendWide = self.wide
+        if self.sendWide == None:
+            self.sendWide = (length == None) or (self.count > 0xffff)
+        # one chunk is read ahead, to tell whether the one before it is
+        # the last; an empty stream is sent as one empty segment
+        self.lookahead = next(self.source,'')
+        self.resetSend()
+
+    def refill(self):
+        """ Read segments from the stream being sent until there are
+        (window) of them from the oldest unacknowledged one, or the
+        stream ends."""
+        if self.ended:
+            return
+        if self.sendWide:
+            header,flags = WIDE_HEADER,WIDE
+        else:
+            header,flags = HEADER,0
+        while (not self.ended) and (self.total < self.base + self.window - 1):
+            id = self.total + 1
+            if (not self.sendWide) and (id > 0xffff):
+                raise ValueError("stream too long for 16-bit segment ids")
+            chunk = self.lookahead
+            self.lookahead = next(self.source,None)
+            if self.lookahead == None:
+                self.ended = True
+                flags |= FIN
+            # ignore checksum
+            self.packets[id-1] = header.pack(self.sourcePort,self.destPort,
+                                             len(chunk) + 8,0,flags,id,
+                                             self.count) + chunk
+            self.total = id
+            self.length += len(chunk)
+
+    def resetSend(self):
+        """ Reset the sending state for a new transfer."""
+        self.began = self.clock()
+        # oldest unacknowledged segment and next new segment to send
+        self.base = 1
+        self.next = 1
+        # time each outstanding segment was last transmitted, and the
+        # ids of segments that have been retransmitted
+        self.sent = {}
+        self.resent = set()
+        # duplicate ACK count, and the last segment outstanding when
+        # fast recovery started
+        self.dupacks = 0
+        self.recover = None
+        # segments above base that have been selectively acknowledged,
+        # holes retransmitted since the last loss was detected, and the
+        # first segment not outstanding when the timer last expired
+        self.sacked = set()
+        self.holes = set()
+        self.expired = 0
+        # consecutive timeouts
+        self.timeouts = 0
+        self.logCwnd()
+
+    def sendDone(self):
+        """ Return True once every segment has been acknowledged or
+        the sender has given up."""
+        return ((self.base > self.total) and self.ended) or \
+            (self.timeouts >= self.retries)
+
+    def endSend(self):
+        """ Record the goodput if the transfer completed."""
+        if (self.base > self.total) and self.ended:
+            self.goodput = self.length*8/(self.clock() - self.began)/1000000
+
+    def handleAck(self,ack):
+        """ Handle an ACK: record its selective acknowledgements, then
+        advance the window or count a duplicate.  An ACK for a segment
+        not sent yet, such as a late or duplicated one from an earlier
+        transfer on the socket, is ignored."""
+        if ack.id >= self.next:
+            return
+        if self.sack:
+            self.scoreboard(ack)
+        if ack.id >= self.base:
+            self.acked(ack.id)
+            self.timeouts = 0
+        elif (ack.id == self.base - 1) and (self.next > self.base):
+            self.duplicate()
+
+    def acked(self,id):
+        """ Handle a cumulative ACK for segment (id), advancing the
+        window.  Following Karn's rule, the RTT is not sampled if any
+        segment the ACK covers was retransmitted: we cannot tell which
+        transmission it is for, and once a retransmission fills a hole
+        the segments above it were sent long before the ACK."""
+        now = self.clock()
+        if self.resent.isdisjoint(xrange(self.base,id + 1)):
+            self.rtt.sample(now - self.sent[id])
+            if self.metrics != None:
+                self.metrics.rtt.observe(now - self.sent[id])
+        for i in range(self.base,id + 1):
+            del self.sent[i]
+            self.resent.discard(i)
+            self.sacked.discard(i)
+            self.holes.discard(i)
+            if self.source != None:
+                del self.packets[i-1]
+        count = id + 1 - self.base
+        self.base = id + 1
+        self.dupacks = 0
+        if self.recover == None:
+            self.cc.acked(count,now)
+        elif id < self.recover:
+            # the next hole is lost as well; with SACK the scoreboard
+            # takes care of it
+            if not self.sack and self.cc.partial(count):
+                self.sendSegment(self.base)
         else:
-            count = 0
-            for ackID in ids:
-                if(count < self.window):
-                    #print ackID
-                    self.link.enqueue(ackID,self.packets[ackID-1])
-                else:
-                    break
-                count += 1
-        return self.recvAcks(self.timeout,newMsg)
-    
+            self.cc.exit()
+            self.recover = None
+
+    def duplicate(self):
+        """ Handle a duplicate ACK.  The third one starts a fast
+        retransmit."""
+        self.dupacks += 1
+        if self.recover != None:
+            if not self.sack:
+                self.cc.dupack()
+        elif self.dupacks == 3:
+            self.cc.loss(self.next - self.base,self.clock())
+            self.holes = set([self.base])
+            self.sendSegment(self.base)
+            if self.cc.recovery:
+                self.recover = self.next - 1
+
+    def scoreboard(self,ack):
+        """ Record the segments selectively acknowledged by (ack)."""
+        for first,last in ack.sack():
+            for id in range(max(first,self.base),min(last,self.next - 1) + 1):
+                self.sacked.add(id)
+
+    def lost(self):
+        """ Return the holes that are considered lost but have not been
+        retransmitted yet, in order.  A hole is lost once three
+        segments above it have been selectively acknowledged, or if it
+        was outstanding when the timer expired."""
+        limit = self.expired
+        if len(self.sacked) >= 3:
+            limit = max(limit,sorted(self.sacked)[-3])
+        return [id for id in range(self.base,limit)
+                if (id not in self.sacked) and (id not in self.holes)]
+
+    def timedOut(self):
+        """ Handle expiry of the retransmission timer by backing off
+        the timeout and resending the oldest outstanding segment."""
+        self.rtt.backoff()
+        self.cc.timeout(self.next - self.base,self.clock())
+        self.dupacks = 0
+        self.recover = None
+        self.holes = set([self.base])
+        self.expired = self.next
+        self.timeouts += 1
+        if self.metrics != None:
+            self.metrics.timeouts.inc()
+        self.sendSegment(self.base)
+
+    def fillWindow(self,total):
+        """ Send new segments until the window is full or there is no
+        more data."""
+        window = min(self.window,self.cc.window())
+        if not self.sack:
+            while (self.next < self.base + window) and (self.next <= total):
+                self.sendSegment(self.next)
+                self.next += 1
+            return
+        # estimate the segments in the network: those outstanding,
+        # less those selectively acknowledged or lost
+        lost = self.lost()
+        pipe = self.next - self.base - len(self.sacked) - len(lost)
+        while pipe < window:
+            if lost:
+                id = lost.pop(0)
+                self.holes.add(id)
+                self.sendSegment(id)
+            elif (self.next <= total) and (self.next < self.base + self.window):
+                self.sendSegment(self.next)
+                self.next += 1
+            else:
+                break
+            pipe += 1
+
+    def sendSegment(self,id):
+        """ Transmit (or retransmit) the segment with the given id."""
+        if id in self.sent:
+            self.resent.add(id)
+            self.retransmissions += 1
+            if self.metrics != None:
+                self.metrics.retransmissions.inc()
+        if self.metrics != None:
+            self.metrics.segments.inc()
+        self.sent[id] = self.clock()
+        self.link.enqueue(id,self.packets[id-1])
+
+    def logCwnd(self):
+        """ Log the congestion window if it has changed."""
+        cwnd = int(self.cc.cwnd * self.packetsize)
+        if cwnd != self.cwnd:
+            self.cwnd = cwnd
+            self.cwndLog.write("%f %d\n" % (self.clock() - self.start, cwnd))
+
+    def stats(self):
+        """ Return a dictionary of statistics for this socket."""
+        return { "srtt" : self.rtt.srtt,
+                 "rttvar" : self.rtt.rttvar,
+                 "rto" : self.rtt.rto,
+                 "cwnd" : self.cc.cwnd,
+                 "ssthresh" : self.cc.ssthresh,
+                 "retransmissions" : self.retransmissions,
+                 "drops" : self.tcp.drops.get(self.sourcePort,0),
+                 "goodput" : self.goodput }
+
+    def setPacketSize(self,packetsize):
+        """ Set the most data to put in a segment.  A segment with the
+        wide header must still fit in the link's maximum segment
+        size."""
+        largest = self.link.mss - WIDE_HEADER.size
+        if not 0 < packetsize <= largest:
+            raise ValueError("packet size must be between 1 and %d bytes" %
+                             largest)
+        self.packetsize = packetsize
+
     def segmentData(self,data):
         """ Segment the Data"""
-        index = 0;
-        id = 1
+        self.packets = []
         totalPackets = len(data)/self.packetsize
         totalPackets += 0 if (len(data)%self.packetsize == 0) else 1        
-        while (index < len(data)):
-            if ((index+self.packetsize)<len(data)):
-                self.packets.append(self.makepacket(data[index:(index+self.packetsize)],id,totalPackets))
-            else:
-                self.packets.append(self.makepacket(data[index:len(data)],id,totalPackets))
-            index += self.packetsize
-            id +=1    
-                            
-    def makepacket(self,data,id,totalPackets):
-        u = TCPPacket()
-        u.sourcePort = self.sourcePort
-        u.destPort = self.destPort
-        u.len = len(data) + 8
-        u.data = data
-        # ignore checksum
-        u.cksum = 0
-        u.id = id
-        u.totalPackets = totalPackets
-        packet = u.pack()
-        return packet
-    
-    def makeAndSendAck(self,packet):
+        self.sendWide = self.wide
+        if self.sendWide == None:
+            self.sendWide = totalPackets > 0xffff
+        if self.sendWide:
+            header,flags = WIDE_HEADER,WIDE
+        else:
+            header,flags = HEADER,0
+        for id in xrange(1,totalPackets + 1):
+            chunk = data[(id-1)*self.packetsize:id*self.packetsize]
+            # ignore checksum
+            self.packets.append(header.pack(self.sourcePort,self.destPort,
+                                            len(chunk) + 8,0,flags,id,
+                                            totalPackets) + chunk)
+
+    def makeAndSendAck(self,id,totalPackets,blocks=[],wide=False):
+        """ Send a cumulative ACK: every segment up to and including
+        (id) has been received.  The ACK also carries (blocks), a list
+        of (first,last) ranges of segments received above (id), and
+        uses the wide header if (wide) is set."""
         ack = TCPPacket()
-        ack.sourcePort = packet.destPort
-        ack.destPort = packet.sourcePort
-        ack.data = "Ack"
+        ack.sourcePort = self.sourcePort
+        ack.destPort = self.destPort
+        ack.flags = ACK
+        ack.setWide(wide)
+        ack.setSack(blocks)
         ack.len = len(ack.data) + 8
         ack.cksum = 0
-        ack.id = packet.id
-        ack.totalPackets = packet.totalPackets
+        ack.id = id
+        ack.totalPackets = totalPackets
         packet = ack.pack()
         self.link.enqueue(ack.id,packet)
             
     # receiving data
     def recv(self,timeout):
-        msg ='';
-        flag = False
-        packets= {}
-        while(not flag):
-            p = self.recvPacket(timeout)
-            if(p != None): 
-                if(not packets.has_key(p.id)):
-                    packets[p.id] = p
-                    msg += p.data
-                flag = self.checkRecvAll(packets,p.totalPackets)
-            else:
-                break
-        return msg        
-    
-    def recvAcks(self,timeout,newMsg):
-        if(newMsg):
-            self.acks= {}
-        while(True):
+        """ Receive a message, acknowledging every segment that
+        arrives with the id of the last segment received in order and
+        the ranges of segments received above it.
+
+        Segments are stored in a slot array indexed by id, so the
+        message is reassembled in order however they arrive, and a
+        count of missing segments tells when it is complete.  If no
+        segment arrives for (timeout) seconds first, only the data
+        before the first missing segment is returned.  A stream sent
+        with sendStream is received as by recvStream, and returned
+        whole."""
+        self.beginRecv()
+        self.receive(timeout)
+        return self.message()
+
+    def recvStream(self,sink,timeout=None):
+        """ Receive a stream, or a message, passing its data in order
+        to (sink), a file or a function taking a string, as soon as
+        all of the data before it has arrived.  Only segments that
+        arrive ahead of a gap are held, so memory stays bounded by the
+        sender's window.  Returns the number of bytes received."""
+        self.beginRecv(getattr(sink,"write",sink))
+        self.receive(timeout)
+        return self.streamed
+
+    def recvSegments(self,place,timeout=None):
+        """ Receive a stream, or a message, calling place(id,total,data)
+        with each segment the first time it arrives, in whatever order
+        segments arrive.  (total) is the number of segments if the
+        sender gave it, or 0.  Segments are not held at all, so this
+        suits receivers that can put data where it belongs at once,
+        such as at offset (id - 1) times the packet size of a file.
+        Returns the number of bytes received."""
+        self.beginRecv(None,place)
+        self.receive(timeout)
+        return self.streamed
+
+    def receive(self,timeout):
+        """ Handle data segments until the transfer is complete, or
+        until none arrives for (timeout) seconds."""
+        while self.missing != 0:
             try:
                 p = self.recvPacket(timeout)
-                if(p != None): 
-                    if(not self.acks.has_key(p.id)):
-                        self.acks[p.id] = p
-                    if(self.checkRecvAll(self.acks,p.totalPackets)):  
-                        return []
-                else:                
-                    break
-            except:
-                return self.checkAcks(self.acks,len(self.packets))   
-        return self.checkAcks(self.acks,len(self.packets))     
-    
-    def checkAcks(self,packets,total):            
-        index = 1;
-        ackIDs = []
-        #print total
-        while (index <= total):
-            if(not packets.has_key(index)):
-                ackIDs.append(index)
-            index += 1
-        return ackIDs       
-        
-    
-    def checkRecvAll(self,packets,total):
-        index = 1;
-        while (index <= total):
-            if(not packets.has_key(index)):
-                return False
-            index += 1
-        return True                    
-    
-    def recvPacket(self,timeout):
-        """ Receive a TCP packet and return the data. If no data is
-        available, wait indefinitely for the next available packet."""        
-        packet = self.buffer.get(True,timeout)
-        u = TCPPacket()
-        try:        
-            u.unpack(packet)
-        except:
-            print "Exception: unpacking a TCP packet"
-            print "  ",sys.exc_info()[0],sys.exc_info()[1]
+            except Queue.Empty:
+                break
+            self.handleData(p)
+
+    def beginRecv(self,sink=None,place=None):
+        """ Reset the receiving state for a new transfer, whose data
+        goes to (sink) or (place) if given."""
+        self.slots = None
+        self.missing = None
+        self.expected = 1
+        # the ranges of segments received above the first missing one,
+        # as sorted lists of their first and last ids
+        self.firsts = []
+        self.lasts = []
+        # for streams: where in-order data goes, or where each segment
+        # goes as it arrives, the segments held until the gap before
+        # them is filled, the id of the last segment once it is known,
+        # and the bytes passed on so far
+        self.sink = sink
+        self.place = place
+        self.held = None
+        self.last = None
+        self.streamed = 0
+        self.chunks = None
+
+    def handleData(self,p):
+        """ Store a data segment in its slot and acknowledge it.  ACKs
+        are ignored."""
+        if(p == None) or (p.flags & ACK):
             return
-        if(u.data != "Ack"):        
-            self.makeAndSendAck(u) 
-        #print 'ID: '+str(u.id)+' Data: '+u.data                  
-        return u
+        if self.metrics != None:
+            self.metrics.received.inc()
+        if (self.slots == None) and (self.held == None):
+            # streams have no total; when they are received as a
+            # message, the data is collected until the end
+            if (self.sink == None) and (self.place == None) and \
+               p.totalPackets:
+                self.slots = [None] * p.totalPackets
+                self.missing = p.totalPackets
+            else:
+                self.held = {}
+                if (self.sink == None) and (self.place == None):
+                    self.chunks = []
+                    self.sink = self.chunks.append
+        if self.held != None:
+            self.handleStream(p)
+            return
+        slots = self.slots
+        if (self.expected <= p.id <= len(slots)) and (slots[p.id-1] == None):
+            slots[p.id-1] = p.data
+            self.missing -= 1
+            self.addRange(p.id)
+        self.makeAndSendAck(self.expected - 1,len(slots),self.sackRanges(),
+                            p.wide)
+
+    def handleStream(self,p):
+        """ Pass a data segment, and any held ones that follow it, to
+        the sink if it is the next one expected, or hold it, or give
+        it to (place) straight away; then acknowledge it."""
+        if p.totalPackets:
+            self.last = p.totalPackets
+        elif p.flags & FIN:
+            self.last = p.id
+        held = self.held
+        if (p.id >= self.expected) and (p.id not in held):
+            if self.place != None:
+                # only which segments have arrived needs keeping
+                self.place(p.id,p.totalPackets,p.data)
+                self.streamed += len(p.data)
+                held[p.id] = None
+            else:
+                held[p.id] = p.data
+            first = self.expected
+            self.addRange(p.id)
+            if self.expected > first:
+                run = [held.pop(id) for id in xrange(first,self.expected)]
+                if self.place == None:
+                    data = ''.join(run)
+                    self.streamed += len(data)
+                    self.sink(data)
+        if (self.last != None) and (self.expected > self.last):
+            self.missing = 0
+        self.makeAndSendAck(self.expected - 1,self.last or 0,
+                            self.sackRanges(),p.wide)
+
+    def message(self):
+        """ Return the data received in order, up to the first missing
+        segment.  This is the whole message only if the transfer
+        completed, which (missing) being 0 tells."""
+        if self.chunks != None:
+            return ''.join(self.chunks)
+        if self.slots == None:
+            return ''
+        return ''.join(self.slots[:self.expected - 1])
+
+    def addRange(self,id):
+        """ Add the newly arrived segment (id) to the ranges of
+        segments received, merging it with those next to it.  If it is
+        the first missing segment, the range it starts is taken off
+        and (expected) moves past it, so that each arrival costs only
+        a search of the ranges, however many segments they hold."""
+        firsts = self.firsts
+        lasts = self.lasts
+        i = bisect.bisect(firsts,id)
+        if (i > 0) and (lasts[i-1] == id - 1):
+            lasts[i-1] = id
+            if (i < len(firsts)) and (firsts[i] == id + 1):
+                lasts[i-1] = lasts[i]
+                del firsts[i]
+                del lasts[i]
+        elif (i < len(firsts)) and (firsts[i] == id + 1):
+            firsts[i] = id
+        else:
+            firsts.insert(i,id)
+            lasts.insert(i,id)
+        if firsts[0] <= self.expected:
+            self.expected = lasts[0] + 1
+            del firsts[0]
+            del lasts[0]
+
+    def sackRanges(self):
+        """ Return up to (sackBlocks) ranges of segments received
+        above the first missing segment, as (first,last) pairs."""
+        return zip(self.firsts[:self.sackBlocks],self.lasts[:self.sackBlocks])
+
+    def recvAck(self,timeout):
+        """ Wait up to (timeout) seconds for an ACK and return it, or
+        return None if the timeout expires first."""
+        end = time.time() + max(timeout,0)
+        while True:
+            try:
+                p = self.recvPacket(max(end - time.time(),0))
+            except Queue.Empty:
+                return None
+            if(p != None) and (p.flags & ACK):
+                return p
+
+    def recvPacket(self,timeout):
+        """ Receive a TCP packet, already decoded by the demultiplexer,
+        and return it. If no packet is available, wait up to (timeout)
+        seconds, or indefinitely if timeout is None, and raise
+        Queue.Empty if none arrives."""        
+        return self.buffer.get(True,timeout)
+
+
+def chunked(source,size):
+    """ Generate the data of (source), a file or an iterator of
+    strings, in chunks of (size) bytes; only the last may be
+    shorter."""
+    if hasattr(source,"read"):
+        while True:
+            chunk = source.read(size)
+            if not chunk:
+                return
+            yield chunk
+    pending = []
+    length = 0
+    for data in source:
+        pending.append(data)
+        length += len(data)
+        if length >= size:
+            data = ''.join(pending)
+            for i in xrange(0,len(data) - size + 1,size):
+                yield data[i:i+size]
+            rest = data[len(data) - len(data) % size:]
+            pending = [rest]
+            length = len(rest)
+    if length:
+        yield ''.join(pending)
+
+
+class RTTEstimator:
+    """ Estimate the round trip time of a connection and derive the
+    retransmission timeout from it, following RFC 6298."""
+    def __init__(self,rto=1.0,minimum=0.2,maximum=60.0):
+        """
+        Initialize the estimator:
+        * rto      the timeout to use before the first sample, in seconds
+        * minimum  the smallest timeout allowed, in seconds
+        * maximum  the largest timeout allowed, in seconds
+        """
+        self.srtt = None
+        self.rttvar = None
+        self.rto = rto
+        self.minimum = minimum
+        self.maximum = maximum
+        # gains for the smoothed RTT and RTT variance
+        self.alpha = 0.125
+        self.beta = 0.25
+        # clock granularity, in seconds
+        self.granularity = 0.001
+
+    def sample(self,rtt):
+        """ Update the estimate with a new RTT measurement."""
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta)*self.rttvar + \
+                          self.beta*abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha)*self.srtt + self.alpha*rtt
+        rto = self.srtt + max(self.granularity,4*self.rttvar)
+        self.rto = min(max(rto,self.minimum),self.maximum)
+
+    def backoff(self):
+        """ Double the timeout after a retransmission timer expires."""
+        self.rto = min(self.rto*2,self.maximum)
+
+
+class CongestionControl:
+    """ Base class for congestion control, with the slow start and
+    congestion avoidance of Reno.  Windows are measured in segments.
+    The socket calls:
+    * acked(count,now)     when (count) new segments are acknowledged
+                           outside of fast recovery
+    * loss(flight,now)     on a fast retransmit, with (flight) segments
+                           outstanding
+    * dupack()             for each further duplicate ACK during fast
+                           recovery
+    * partial(count)       for an ACK during fast recovery that does not
+                           cover every segment outstanding when it
+                           started; returns True to stay in recovery and
+                           retransmit the next hole
+    * exit()               when fast recovery ends
+    * timeout(flight,now)  when the retransmission timer expires
+    """
+    # whether a fast retransmit starts fast recovery
+    recovery = True
+
+    def __init__(self,cwnd=2,ssthresh=64):
+        """
+        Initialize the algorithm:
+        * cwnd      the initial congestion window
+        * ssthresh  the initial slow start threshold
+        """
+        self.cwnd = float(cwnd)
+        self.ssthresh = float(ssthresh)
+
+    def window(self):
+        """ Return the number of segments that may be outstanding."""
+        return max(int(self.cwnd),1)
+
+    def reduce(self,flight):
+        """ Return the slow start threshold to use after a loss."""
+        return max(flight/2.0,2)
+
+    def acked(self,count,now):
+        while (count > 0) and (self.cwnd < self.ssthresh):
+            self.cwnd += 1
+            count -= 1
+        if count > 0:
+            self.avoid(count,now)
+
+    def avoid(self,count,now):
+        """ Grow the window during congestion avoidance."""
+        self.cwnd += float(count)/self.cwnd
+
+    def loss(self,flight,now):
+        self.ssthresh = self.reduce(flight)
+        self.cwnd = self.ssthresh + 3
+
+    def dupack(self):
+        self.cwnd += 1
+
+    def partial(self,count):
+        return False
+
+    def exit(self):
+        self.cwnd = self.ssthresh
+
+    def timeout(self,flight,now):
+        self.ssthresh = self.reduce(flight)
+        self.cwnd = 1
+
+
+class Tahoe(CongestionControl):
+    """ TCP Tahoe: a fast retransmit returns to slow start."""
+    recovery = False
+
+    def loss(self,flight,now):
+        self.timeout(flight,now)
+
+
+class Reno(CongestionControl):
+    """ TCP Reno: fast recovery, left on the first new ACK."""
+    pass
+
+
+class NewReno(CongestionControl):
+    """ TCP NewReno (RFC 6582): partial ACKs keep fast recovery going
+    and retransmit the next hole."""
+    def partial(self,count):
+        self.cwnd = max(self.cwnd - count + 1,1)
+        return True
+
+
+class Cubic(NewReno):
+    """ CUBIC (RFC 8312).  The window grows as a cubic function of the
+    time since the last loss, but never more slowly than Reno would."""
+    C = 0.4
+    beta = 0.7
+
+    def __init__(self,cwnd=2,ssthresh=64):
+        NewReno.__init__(self,cwnd,ssthresh)
+        self.wmax = 0
+        self.epoch = None
+        self.k = 0
+        self.origin = 0
+        self.west = 0
+
+    def reduce(self,flight):
+        # fast convergence: release bandwidth sooner if the window is
+        # shrinking
+        if self.cwnd < self.wmax:
+            self.wmax = self.cwnd*(1 + self.beta)/2
+        else:
+            self.wmax = self.cwnd
+        self.epoch = None
+        return max(self.cwnd*self.beta,2)
+
+    def avoid(self,count,now):
+        if self.epoch == None:
+            self.epoch = now
+            if self.cwnd < self.wmax:
+                self.k = ((self.wmax - self.cwnd)/self.C) ** (1.0/3)
+                self.origin = self.wmax
+            else:
+                self.k = 0
+                self.origin = self.cwnd
+            self.west = self.cwnd
+        t = now - self.epoch
+        target = self.origin + self.C*(t - self.k)**3
+        # TCP-friendly region: the window Reno would have reached,
+        # estimated by counting ACKs
+        self.west += count*3*(1 - self.beta)/(1 + self.beta)/self.west
+        target = max(target,self.west)
+        if target > self.cwnd:
+            self.cwnd += count*(target - self.cwnd)/self.cwnd
+        else:
+            self.cwnd += count*0.01/self.cwnd
+
+
+# congestion control algorithms, by name
+CONGESTION = { "tahoe" : Tahoe,
+               "reno" : Reno,
+               "newreno" : NewReno,
+               "cubic" : Cubic }
 
 
 class TCPPacket:
@@ -241,23 +907,60 @@ class TCPPacket:
         self.destPort = 0
         self.len = 0
         self.cksum = 0
+        self.flags = 0
         self.id = 0
         self.totalPackets = 0
         self.data = ''
 
         # packing information
-        self.format = "!HHHHHH    "
-        self.headerlen = struct.calcsize(self.format)
+        self.wide = False
+        self.header = HEADER
+        self.sackFormat = SACK
+        self.headerlen = HEADER.size
+
+    def setWide(self,wide):
+        """ Choose between the header with 16-bit segment ids and
+        counts and the wide one with 32-bit ids and counts.  The WIDE
+        flag tells the receiver which one was used."""
+        self.wide = wide
+        if wide:
+            self.header = WIDE_HEADER
+            self.sackFormat = WIDE_SACK
+        else:
+            self.header = HEADER
+            self.sackFormat = SACK
+        self.headerlen = self.header.size
 
     def pack(self):
         """ Create a string from a TCP packet """
-        string = struct.pack(self.format,self.sourcePort,self.destPort,
-                             self.len,self.cksum,self.id,self.totalPackets)
+        flags = self.flags
+        if self.wide:
+            flags |= WIDE
+        string = self.header.pack(self.sourcePort,self.destPort,self.len,
+                                  self.cksum,flags,self.id,self.totalPackets)
         return string + self.data
 
     def unpack(self,string):
         """ Create a TCP packet from a string """
-        # unpack the header fields
-        (self.sourcePort,self.destPort,self.len,self.cksum,self.id,self.totalPackets) = struct.unpack(self.format,string[0:self.headerlen])
+        # unpack the header fields, switching to the wide header if the
+        # flags say it was used
+        fields = HEADER.unpack_from(string)
+        if fields[4] & WIDE:
+            self.setWide(True)
+            fields = WIDE_HEADER.unpack_from(string)
+        (self.sourcePort,self.destPort,self.len,self.cksum,self.flags,
+         self.id,self.totalPackets) = fields
         # unpack the data
-        self.data = string[self.headerlen:]
\ No newline at end of file
+        self.data = string[self.headerlen:]
+
+    def setSack(self,blocks):
+        """ Store SACK (blocks), a list of (first,last) segment ids, as
+        the data of an ACK."""
+        self.data = ''.join([self.sackFormat.pack(first,last)
+                             for first,last in blocks])
+
+    def sack(self):
+        """ Return the SACK blocks carried in the data of an ACK."""
+        size = self.sackFormat.size
+        return [self.sackFormat.unpack_from(self.data,i)
+                for i in range(0,len(self.data) - size + 1,size)]
@@ -0,0 +1,71 @@
+"""
+  Tests for TCPSocket
+
+  Run with "python -m unittest test_tcp" from this directory.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import unittest
+
+from tcp import *
+
+class FakeLink:
+    """ A link that keeps the packets sent on it."""
+    def __init__(self):
+        self.mss = 1500
+        self.sent = []
+
+    def enqueue(self,id,packet):
+        self.sent.append(id)
+
+
+class FakeTCP:
+    """ A demultiplexer that accepts any binding."""
+    def bind(self,port,socket):
+        pass
+
+
+def make_ack(id,blocks=[]):
+    """ Return an ACK for segment (id) carrying the SACK (blocks)."""
+    ack = TCPPacket()
+    ack.flags = ACK
+    ack.setSack(blocks)
+    ack.id = id
+    return ack
+
+
+class AckTests(unittest.TestCase):
+    def setUp(self):
+        self.link = FakeLink()
+        self.socket = TCPSocket(self.link,FakeTCP(),10,1,1,packetsize=10)
+        # ten segments, of which the window sends the first few
+        self.socket.beginSend("x"*100)
+        self.socket.fillWindow(self.socket.total)
+
+    def test_ack_beyond_sent_is_ignored(self):
+        s = self.socket
+        next = s.next
+        s.handleAck(make_ack(next,[(next + 1,next + 3)]))
+        s.handleAck(make_ack(121))
+        self.assertEqual(s.base,1)
+        self.assertEqual(s.sacked,set())
+        self.assertEqual(s.dupacks,0)
+
+    def test_stale_ack_from_earlier_transfer_is_ignored(self):
+        s = self.socket
+        s.handleAck(make_ack(s.next - 1))
+        self.assertEqual(s.base,s.next)
+        # the next transfer starts over at segment 1, while ACKs of the
+        # whole of this one may still arrive
+        s.beginSend("y"*100)
+        s.fillWindow(s.total)
+        s.handleAck(make_ack(s.total))
+        self.assertEqual(s.base,1)
+        s.handleAck(make_ack(1))
+        self.assertEqual(s.base,2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+"""
+  Implements binary traces of packet events
+
+  A Trace has the same event() method as a Log, but instead of
+  formatting and writing a line of text for each event in the thread
+  that saw it, it only appends the event to a queue.  A writer thread
+  packs the queued events into fixed size records, writes them to the
+  file and flushes it every (interval) seconds, and the trace is
+  closed, with every event written, when the program exits.  The queue
+  holds at most (limit) events; if the disk can not keep up, further
+  events are counted rather than queued, and the count is written as
+  an "overrun" event whose id is the number of events missed.  Events
+  of a kind or for a reason the format does not know are refused with
+  a ValueError, rather than recorded as something else.
+
+  Each record is 16 bytes: the time as a double, the packet id as an
+  unsigned 32-bit integer, and one byte each for the kind of event, the
+  reason for a drop, and flags, all little endian.  Running
+
+    python tracefile.py link.trace > link.log
+
+  converts a trace back to the text format of Log, "time id kind
+  [reason]".
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import atexit
+import collections
+import optparse
+import struct
+import sys
+import threading
+
+__all__ = [ "Trace","read_trace","KINDS","REASONS" ]
+
+MAGIC = "LINKTRC1"
+RECORD = struct.Struct("<dIBBBx")
+
+# the kinds of events, and the reasons queue disciplines give for
+# drops; each is recorded as its index
+KINDS = ("added","dropped","sending","sent","received","lost","overrun")
+REASONS = (None,"droptail","bytes","red-forced","red-early",
+           "red-overflow","codel","codel-overflow")
+OVERRUN = KINDS.index("overrun")
+
+# flags
+NO_ID = 1
+
+class Trace:
+    def __init__(self,file,interval=1.0,limit=262144):
+        """
+        Initialize the trace:
+        * file      the file to write records to
+        * interval  how often to write queued records, in seconds
+        * limit     the most events to queue before missing them
+        """
+        self.file = file
+        self.fh = open(self.file,'wb')
+        self.fh.write(MAGIC)
+        self.interval = interval
+        # appending to and popping from a deque are atomic, so event()
+        # needs no lock; the lock keeps the writer thread and close()
+        # from writing at the same time
+        self.events = collections.deque()
+        self.limit = limit
+        # events missed because the queue was full, and how many of
+        # them have been written as overruns
+        self.missed = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+        self.kinds = dict([(kind,i) for i,kind in enumerate(KINDS)])
+        self.reasons = dict([(reason,i) for i,reason in enumerate(REASONS)])
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def event(self,time,id,kind,reason=None):
+        """ Record that packet (id) was (kind) at (time), as for
+        Log.event."""
+        try:
+            code = self.kinds[kind]
+            cause = self.reasons[reason]
+        except KeyError:
+            raise ValueError("can not trace a %s event for reason %s" %
+                             (kind,reason))
+        if len(self.events) >= self.limit:
+            self.missed += 1
+            return
+        self.events.append((time,id,code,cause))
+
+    def write(self,str):
+        """ Record an event given as a line of the text format."""
+        fields = str.split()
+        if len(fields) == 2:
+            self.event(float(fields[0]),None,fields[1])
+        elif len(fields) > 2:
+            self.event(float(fields[0]),int(fields[1]),fields[2],
+                       " ".join(fields[3:]) or None)
+
+    def run(self):
+        while not self.closed.is_set():
+            self.closed.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        """ Write the events queued so far and flush the file."""
+        self.lock.acquire()
+        try:
+            if self.fh.closed:
+                return
+            pack = RECORD.pack
+            records = []
+            time = 0.0
+            # stop at the events queued now, so a busy link can not keep
+            # the writer here forever
+            for i in xrange(len(self.events)):
+                time,id,kind,reason = self.events.popleft()
+                flags = 0
+                if id == None:
+                    id = 0
+                    flags = NO_ID
+                records.append(pack(time,id & 0xffffffff,kind,reason,flags))
+                if len(records) == 65536:
+                    self.fh.write("".join(records))
+                    records = []
+            # events missed since the last flush, at the time of the
+            # last one written
+            missed = self.missed - self.reported
+            if missed:
+                records.append(pack(time,min(missed,0xffffffff),OVERRUN,0,0))
+                self.reported += missed
+            self.fh.write("".join(records))
+            self.fh.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """ Write every queued event and close the file."""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.writer.join()
+        self.flush()
+        self.lock.acquire()
+        self.fh.close()
+        self.lock.release()
+
+
+def read_trace(file):
+    """ Generate the events in the trace (file) as (time,id,kind,reason)
+    tuples, with the same values as were given to Trace.event.  Kinds
+    and reasons Trace did not know are given as "unknown"."""
+    fh = open(file,'rb')
+    if fh.read(len(MAGIC)) != MAGIC:
+        raise ValueError("%s is not a packet trace" % file)
+    unpack = RECORD.unpack_from
+    size = RECORD.size
+    while True:
+        chunk = fh.read(size*65536)
+        for offset in xrange(0,len(chunk) - size + 1,size):
+            time,id,kind,reason,flags = unpack(chunk,offset)
+            if flags & NO_ID:
+                id = None
+            if kind < len(KINDS):
+                kind = KINDS[kind]
+            else:
+                kind = "unknown"
+            if reason < len(REASONS):
+                reason = REASONS[reason]
+            else:
+                reason = "unknown"
+            yield time,id,kind,reason
+        if len(chunk) < size*65536:
+            break
+    fh.close()
+
+def parse_options():
+    """ Parse options. """
+    parser = optparse.OptionParser(usage = "%prog [options] trace",
+                                   version = "%prog 0.1")
+
+    parser.add_option("","--out",type="string",dest="out",
+                      default=None,
+                      help="file to write the text log to, instead of stdout")
+
+    (options,args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give one trace file")
+    return options,args
+
+if __name__ == '__main__':
+    options,args = parse_options()
+    out = sys.stdout
+    if options.out != None:
+        out = open(options.out,'w')
+    lines = []
+    for time,id,kind,reason in read_trace(args[0]):
+        if id == None:
+            lines.append("%f %s\n" % (time,kind))
+        elif reason == None:
+            lines.append("%f %d %s\n" % (time,id,kind))
+        else:
+            lines.append("%f %d %s %s\n" % (time,id,kind,reason))
+        if len(lines) == 65536:
+            out.write("".join(lines))
+            lines = []
+    out.write("".join(lines))
+    if options.out != None:
+        out.close()
@@ -0,0 +1,111 @@
+"""
+  Implements links that run in virtual time
+
+  A VirtualLoop runs the events of EventLinks and EventTCPSockets in
+  time order, in the calling thread, jumping its clock straight to
+  each event instead of waiting for it.  VirtualLinks pass packets
+  directly to the link at the other end instead of using UDP sockets.
+  A run takes only as long as it takes to process its events, and
+  since nothing depends on the wall clock or on thread scheduling,
+  the same run always gives the same results.
+
+  This program is licensed under the GPL; see LICENSE for details.
+
+"""
+
+import heapq
+import itertools
+import threading
+
+from eventlink import *
+
+__all__ = [ "VirtualLoop","VirtualLink" ]
+
+class VirtualLoop(EventLoop):
+    """
+    Runs timed events in order against a virtual clock that starts at
+    zero.
+    """
+    def __init__(self):
+        # the loop is never started as a thread, and has no sockets to
+        # read from, so no wakeup pipe is needed
+        threading.Thread.__init__(self)
+        self.events = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.links = {}
+        self.now = 0.0
+
+    def clock(self):
+        """ Return the virtual time, in seconds."""
+        return self.now
+
+    def add(self,link):
+        raise ValueError("a virtual loop can not read from sockets")
+
+    def wakeup(self):
+        pass
+
+    def run(self,until=None):
+        """ Run events until there are none left, or until the next one
+        is later than (until) seconds.  Returns the virtual time."""
+        while self.events:
+            if (until != None) and (self.events[0][0] > until):
+                self.now = until
+                break
+            when,sequence,function,args = heapq.heappop(self.events)
+            self.now = max(self.now,when)
+            function(*args)
+        return self.now
+
+
+class VirtualLink(EventLink):
+    """
+    A virtual link between two emulated machines in the same process,
+    emulated by a VirtualLoop.  It has the same interface as Link.
+    """
+    # numbers the links, to name them in metrics
+    count = itertools.count(1)
+
+    def __init__(self,size,rate,delay,log_name,loop,queue=None,impair=None,
+                 metrics=None):
+        """
+        Initialize the link:
+        * size       the size of the outgoing queue, in packets
+        * rate       the bandwidth of the link, in Mbps
+        * delay      the propagation delay of the link, in ms
+        * log_name   file to log packets to, with virtual times; a
+                     name ending in .trace writes a binary trace
+        * loop       the VirtualLoop to run on
+        * queue      the queue discipline for outgoing packets, from
+                     queues.py; by default a queue of (size) packets
+        * impair     the Impairments to apply to packets, from
+                     impair.py; by default none
+        * metrics    the Registry to keep the link's metrics in, from
+                     metrics.py; by default none are kept
+        """
+        self.number = VirtualLink.count.next()
+        EventLink.__init__(self,size,rate,delay,log_name,
+                           None,None,None,None,loop,queue,impair,metrics)
+        self.peer = None
+
+    def name(self):
+        return "virtual%d" % self.number
+
+    def create_socket(self):
+        self.socket = None
+
+    def connect(self,peer):
+        """ Connect this link and (peer) to each other, so that each
+        delivers the packets sent on it to the other."""
+        self.peer = peer
+        peer.peer = self
+
+    def arrive(self,data):
+        """ Deliver a packet to the other side of the link."""
+        self.propagating -= 1
+        self.peer.deliver(data)
+
+    def idle(self):
+        """ Return at once; run the loop to let the link go idle."""
+        return
@@ -0,0 +1,75 @@
+import optparse
+import socket
+import time
+
+import router
+
+""" Measures the CPU a router spends forwarding a packet.
+
+"python benchmark.py" forwards the same packet through one router many
+times, once in each header format, with and without a trace, and
+prints the CPU time per packet.  The router sends the packets to a UDP
+socket that is never read, and the per-hop delay is turned off, so the
+time is that of handling the header, looking up the route and
+sending.  Each packet is copied into the router's receive buffer, as
+if it had just been received, and handled from there.
+
+"""
+
+def forwarding(r,packet,count):
+    """ Return the CPU seconds per packet for router (r) to forward
+    (packet) (count) times, as if each had been received into its
+    buffer.
+    """
+    length = len(packet)
+    buffer = r.buffer
+    start = time.clock()
+    for i in xrange(count):
+        buffer[:length] = packet
+        r.handle_buffer(length)
+    return (time.clock() - start)/count
+
+def parse_options():
+    """ Parse command line options. """
+    parser = optparse.OptionParser(usage = "%prog [options]",
+                                   version = "%prog 0.1")
+
+    parser.add_option("-n","--count",type="int",dest="count",
+                      default=100000,
+                      help="packets to forward in each format")
+    parser.add_option("-s","--size",type="int",dest="size",
+                      default=100,
+                      help="bytes of data in each packet")
+    parser.add_option("-p","--port",type="int",dest="port",
+                      default=5900,
+                      help="first of the two UDP ports to use")
+
+    (options,args) = parser.parse_args()
+    return options
+
+if __name__ == "__main__":
+    options = parse_options()
+    r = router.Router("one","localhost",options.port,False)
+    r.delay = 0
+    sink = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    sink.bind(("localhost",options.port + 1))
+    r.add_link("two","localhost",options.port + 1)
+    r.add_route("three","two")
+    data = "x" * options.size
+    text = "vr zero three ping\n"
+    binary = router.HEADER.pack(router.MAGIC,0,router.intern_id("zero"),
+                                router.intern_id("three"),
+                                router.intern_id("ping"),0)
+    tests = [("text",text + data),
+             ("text, traced",text + "trace zero\n" + data),
+             ("binary",binary + data),
+             ("binary, traced",
+              router.HEADER.pack(router.MAGIC,router.TRACE,
+                                 router.intern_id("zero"),
+                                 router.intern_id("three"),
+                                 router.intern_id("ping"),1) +
+              router.HOP.pack(router.intern_id("zero")) +
+              "\0" * (router.TRACE_SIZE - router.HOP.size) + data)]
+    for name,packet in tests:
+        print "%-16s %6.2f us per packet" % \
+            (name,forwarding(r,packet,options.count)*1000000)
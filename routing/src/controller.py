@@ -1,22 +1,32 @@
+import collections
 import optparse
 import readline
 import sys
+import time
 
 # local imports
 import dv
+import host
+import ls
 import ping
 import router
+import scheduler
 
 class Controller:
     """ A controller that sets up a virtual network of routers, runs a
-    routing protocol, and allows tests with ping.  The controller accepts
-    the following commands at the prompt:
+    routing protocol -- distance vector or link state -- and allows
+    tests with ping.  The controller accepts the following commands at
+    the prompt:
     
     * start [id] [id] ... [id] : start routers with given ids
     * stop [id] [id] ... [id]  : stop routers with given ids
     * ping [times] [from] [to] : ping a number of times from one
                                  router to another
+    * converge [seconds]       : wait for the routes to converge, and
+                                 report how long they took
     * quit                     : quit the program
+
+    Commands can also be piped in, so that runs can be scripted.
     """
     def __init__(self):
         """ Initialize the controller, parse command line options, and
@@ -24,7 +34,17 @@ class Controller:
         """
         self.routers = {}
         self.pingers = {}
+        self.protocols = {}
         self.parse_options()
+        # timers for the routing protocols; a host also runs the
+        # routers
+        if self.options.loop:
+            self.timers = host.Host()
+        else:
+            self.timers = scheduler.Scheduler()
+        self.timers.start()
+        # when routers were last started or stopped
+        self.changed = time.time()
         self.create_network(self.options.config)
     
     def parse_options(self):
@@ -32,6 +52,19 @@ class Controller:
 
         * -c or --config  : configuration file for the network
         * -v or --verbose : turn on debugging
+        * -p or --protocol: routing protocol, dv or ls
+        * --period        : seconds between distance vector updates,
+                            or link state hellos
+        * --timeout       : seconds before a silent neighbor is down
+        * --holddown      : seconds to hold down an unreachable route
+        * --refresh       : seconds between periodic link state
+                            advertisements
+        * --damping       : least seconds between triggered updates
+        * --infinity      : distance vector cost of an unreachable
+                            destination, more than the longest path
+        * --text          : send text packet headers instead of binary
+        * --loop          : run every router from one event loop,
+                            instead of a thread for each
         """
         parser = optparse.OptionParser(usage = "%prog [options]",
                                        version = "%prog 0.1")
@@ -42,12 +75,41 @@ class Controller:
         parser.add_option("-v","--verbose",action="store_true",dest="verbose",
                           default=False,
                           help="print debugging info")
+        parser.add_option("-p","--protocol",type="choice",dest="protocol",
+                          choices=["dv","ls"],default="dv",
+                          help="routing protocol: dv or ls")
+        parser.add_option("","--period",type="float",dest="period",
+                          default=1.0,
+                          help="seconds between distance vector updates or link state hellos")
+        parser.add_option("","--timeout",type="float",dest="timeout",
+                          default=3.5,
+                          help="seconds before a silent neighbor is down")
+        parser.add_option("","--holddown",type="float",dest="holddown",
+                          default=3.0,
+                          help="seconds to hold down an unreachable route")
+        parser.add_option("","--refresh",type="float",dest="refresh",
+                          default=10.0,
+                          help="seconds between periodic link state advertisements")
+        parser.add_option("","--damping",type="float",dest="damping",
+                          default=0.1,
+                          help="least seconds between triggered updates")
+        parser.add_option("","--infinity",type="int",dest="infinity",
+                          default=dv.INFINITY,
+                          help="distance vector cost of an unreachable destination")
+        parser.add_option("","--text",action="store_true",dest="text",
+                          default=False,
+                          help="send text packet headers instead of binary")
+        parser.add_option("","--loop",action="store_true",dest="loop",
+                          default=False,
+                          help="run every router from one event loop")
 
         (options,args) = parser.parse_args()
         self.options = options
 
     def create_network(self,file):
-        """ Create a virtual network from a configuration file.
+        """ Create a virtual network from a configuration file.  Each
+        link connects its two routers in both directions, with the
+        delay in milliseconds given after the ids, if any, in each.
         """
         if not file:
             print "No network configuration!"
@@ -67,8 +129,12 @@ class Controller:
                     port = int(fields[3])
                 except:
                     continue
-                r = router.Router(id,address,port,self.options.verbose)
-                r.start()
+                r = router.Router(id,address,port,self.options.verbose,
+                                  not self.options.text)
+                if self.options.loop:
+                    self.timers.add(r)
+                else:
+                    r.start()
                 self.routers[id] = r
             # create link
             if fields[0] == "link":
@@ -78,21 +144,43 @@ class Controller:
                 id2 = fields[2]
                 if id1 not in self.routers or id2 not in self.routers:
                     continue
-                address = self.routers[id2].address
-                port = self.routers[id2].port
-                self.routers[id1].add_link(id2,address,port)
+                delay = None
+                if len(fields) > 3:
+                    try:
+                        delay = float(fields[3])/1000
+                    except:
+                        continue
+                r1 = self.routers[id1]
+                r2 = self.routers[id2]
+                r1.add_link(id2,r2.address,r2.port,delay)
+                r2.add_link(id1,r1.address,r1.port,delay)
         # create routing
         for id in self.routers.keys():
-            d = dv.DV(self.routers[id])
+            if self.options.protocol == "ls":
+                d = ls.LS(self.routers[id],self.timers,self.options.period,
+                          self.options.timeout,self.options.refresh,
+                          self.options.damping)
+            else:
+                d = dv.DV(self.routers[id],self.timers,self.options.period,
+                          self.options.timeout,self.options.holddown,
+                          self.options.damping,self.options.infinity)
+            self.protocols[id] = d
             p = ping.Ping(self.routers[id])
             self.pingers[id] = p
+        for id in self.protocols.keys():
+            self.protocols[id].start()
+        self.changed = time.time()
 
     def commands(self):
         """ Read and process commands from the terminal. """
         print "Welcome to the routing lab!"
         while True:
             # line = sys.stdin.readline()
-            line = raw_input("> ")
+            try:
+                line = raw_input("> ")
+            except EOFError:
+                self.quit()
+                break
             if line == "":
                 continue
             if line.startswith("help"):
@@ -100,6 +188,7 @@ class Controller:
                 print "  start [id] [id] ... [id] -- start routers with given ids"
                 print "  stop [id] [id] ... [id]  -- stop routers with given ids"
                 print "  ping [times] [from] [to] -- ping a number of times from one router to another"
+                print "  converge [seconds]       -- wait for the routes to converge, and report how long they took"
                 print "  quit                     -- quit the program"
                 continue
             if line.startswith("quit"):
@@ -120,6 +209,10 @@ class Controller:
                     continue
                 self.ping(fields[1],fields[2],fields[3])
                 continue
+            if line.startswith("converge"):
+                fields = line.split()
+                self.converge(*fields[1:2])
+                continue
             print "Unknown command"
 
     def quit(self):
@@ -127,6 +220,12 @@ class Controller:
         print "Quitting ..."
         for id in self.routers.keys():
             self.routers[id].quit()
+        for id in self.routers.keys():
+            if self.routers[id].is_alive():
+                self.routers[id].join()
+        for id in self.protocols.keys():
+            self.protocols[id].quit()
+        self.timers.quit()
 
     def stop(self,ids):
         """ Execute the stop command. """
@@ -136,6 +235,7 @@ class Controller:
                 continue
             print "Stopping",id
             self.routers[id].stop()
+            self.changed = time.time()
 
     def restart(self,ids):
         """ Execute the start command. """
@@ -145,6 +245,7 @@ class Controller:
                 continue
             print "Starting",id
             self.routers[id].restart()
+            self.changed = time.time()
 
     def ping(self,times,id_from,id_to):
         """ Execute the ping command. """
@@ -161,6 +262,68 @@ class Controller:
             return
         self.pingers[id_from].ping(id_to,times)
 
+    def converge(self,limit="60"):
+        """ Execute the converge command: wait up to (limit) seconds
+        for every running router to have a shortest path route to
+        every router it can reach, and none to those it can not, then
+        print how long that took since routers were last started or
+        stopped. """
+        try:
+            limit = float(limit)
+        except:
+            print "Number of seconds must be a number"
+            return
+        end = time.time() + limit
+        while True:
+            wrong = self.wrong_routes()
+            now = time.time()
+            if wrong == 0:
+                print "Converged in %.3f seconds" % (now - self.changed)
+                return
+            if now >= end:
+                print "Not converged after %.3f seconds: %d wrong routes" % \
+                    (now - self.changed,wrong)
+                return
+            time.sleep(0.05)
+
+    def wrong_routes(self):
+        """ Count the routes of the running routers that are not on a
+        shortest path, including missing routes and routes to
+        unreachable routers. """
+        live = [id for id in self.routers if self.routers[id].handling]
+        tables = {}
+        for id in live:
+            r = self.routers[id]
+            r.forwarding_sem.acquire()
+            tables[id] = dict(r.forwarding)
+            r.forwarding_sem.release()
+        wrong = 0
+        for dest in self.routers:
+            # hop counts to (dest) over running routers; links are
+            # symmetric, so search outward from it
+            distance = {}
+            queue = collections.deque()
+            if dest in tables:
+                distance[dest] = 0
+                queue.append(dest)
+            while queue:
+                id = queue.popleft()
+                for neighbor in self.routers[id].links:
+                    if neighbor in tables and neighbor not in distance:
+                        distance[neighbor] = distance[id] + 1
+                        queue.append(neighbor)
+            for id in live:
+                if id == dest:
+                    continue
+                next = tables[id].get(dest)
+                if id not in distance:
+                    if next != None:
+                        wrong += 1
+                elif distance.get(next) != distance[id] - 1 or \
+                        next not in self.routers[id].links:
+                    wrong += 1
+        return wrong
+
 if __name__ == "__main__":
     c = Controller()
     c.commands()
@@ -1,21 +1,330 @@
+import threading
+import time
+
+import scheduler
+
+""" A distance vector routing protocol, in the style of RIP.
+
+Each router advertises its distance vector -- the cost of its best
+route to every destination it knows -- to each of its neighbors,
+every (period) seconds and also soon after its routes change (a
+triggered update).  Triggered updates carry only the routes that
+changed, and are sent at most once every (damping) seconds, so that a
+burst of changes goes out as one update rather than a storm of them.
+Every link costs 1, and a cost of (infinity) means a destination is
+unreachable.  An advertisement is a 'dv' packet sent straight over
+the link, with one line per destination:
+
+  dest cost
+
+Advertisements larger than a packet are split into several, each of
+which stands on its own.
+
+The protocol uses three standard defenses against routing loops:
+
+* split horizon with poisoned reverse: a router advertises routes
+  that go through a neighbor back to that neighbor with a cost of
+  (infinity), so two routers never count to infinity between them.
+
+* hold-down: when a route becomes unreachable, the router ignores new
+  routes to its destination for (holddown) seconds, unless they come
+  from the neighbor the route used to go through, so that stale
+  advertisements still circulating can not bring it back.  The
+  unreachable route is advertised until the hold-down ends, and is
+  then forgotten.
+
+* expiry: a neighbor that has not been heard from for (timeout)
+  seconds, such as a router stopped by the controller, is considered
+  down, and every route through it becomes unreachable.
+
+Routes are installed in the router with add_route() and removed with
+delete_route().  Routes to neighbors are installed by the router when
+the link is added; they are removed when the neighbor expires, and
+installed again when it is heard from.
+
+Since a route costing (infinity) is unreachable, routers more than
+(infinity) - 1 hops apart can not reach each other.  It is INFINITY,
+16 as in RIP, by default, which is too small for the longest paths of
+some networks of hundreds of routers, such as rings and long chains;
+a larger one lets routes grow longer, but makes loops that split
+horizon does not prevent take longer to count up to it.
+
+The protocol's timers run on a Scheduler, which may be shared by the
+protocols of every router in the network.
+
+"""
+
+# the default cost of an unreachable destination
+INFINITY = 16
+
+# the largest advertisement sent in one packet, leaving room for the
+# header within the router's packet size
+ADVERTISEMENT_SIZE = 1400
+
 class DV:
     """ Implements a distance vector routing protocol.
     """
-    def __init__(self,router):
+    def __init__(self,router,timers=None,period=1.0,timeout=3.5,
+                 holddown=3.0,damping=0.1,infinity=INFINITY):
         """ Initialize the protocol with the (router) object it is
         attached to.  Register the protocol as a handler for the 'dv'
-        application identifier.
+        application identifier.  It advertises once start() is called.
+
+        * timers   : the Scheduler to run timers on; by default the
+                     protocol starts one of its own
+        * period   : seconds between periodic advertisements
+        * timeout  : seconds after which a silent neighbor is down
+        * holddown : seconds to hold down an unreachable route
+        * damping  : least seconds between triggered updates
+        * infinity : the cost of an unreachable destination
         """
         self.router = router
+        if timers == None:
+            timers = scheduler.Scheduler()
+            timers.start()
+        self.timers = timers
+        self.period = period
+        self.timeout = timeout
+        self.holddown = holddown
+        self.damping = damping
+        self.infinity = infinity
+        self.lock = threading.Lock()
+        # the last vector heard from each neighbor, and when
+        self.vectors = {}
+        self.heard = {}
+        # routing table: destination -> (cost,next hop)
+        self.routes = {}
+        # destinations in hold-down -> time the hold-down ends
+        self.held = {}
+        # the router installed routes to its neighbors when the links
+        # were added; they stand until the neighbors have had time to
+        # be heard from
+        for id in self.router.get_neighbors():
+            self.vectors[id] = {}
+            self.routes[id] = (1,id)
+        # destinations whose routes changed since the last update
+        self.dirty = set()
+        # when the last update was sent, and the scheduled periodic
+        # and triggered updates
+        self.sent = 0
+        self.periodic = None
+        self.triggered = None
         self.router.register_handler('dv',self)
-        self.dv()
 
-    def dv(self):
-        for r in self.router.get_neighbors():
-            print self.router.id+":"+r
-            self.router.send_packet(r,"dv",self.router.id,False)
-        
+    # public methods
+
+    def start(self):
+        """ Start advertising.  The controller starts every router's
+        protocol once they have all registered, so that no
+        advertisement finds its neighbor without a handler.
+        """
+        now = time.time()
+        self.lock.acquire()
+        for id in self.vectors:
+            self.heard[id] = now
+        self.periodic = self.timers.schedule(now,self.tick)
+        self.lock.release()
+
+    def quit(self):
+        """ Stop advertising.
+        """
+        self.lock.acquire()
+        for event in (self.periodic,self.triggered):
+            if event != None:
+                self.timers.cancel(event)
+        self.periodic = None
+        self.triggered = None
+        self.lock.release()
+
     def receive(self,id,data,path):
-        print "Data: "+data
-        if path:
-            print "Path: "+path
+        """ Receive an advertisement from neighbor (id) stored in
+        (data).
+        """
+        if id not in self.router.links:
+            return
+        fields = data.split()
+        try:
+            vector = zip(fields[0::2],map(int,fields[1::2]))
+        except ValueError:
+            return
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.heard[id] = now
+            # only destinations whose advertised cost changed need
+            # their routes recomputed
+            dests = []
+            if id not in self.vectors:
+                self.vectors[id] = {}
+                dests.append(id)
+            old = self.vectors[id]
+            for dest,cost in vector:
+                if old.get(dest) != cost:
+                    old[dest] = cost
+                    dests.append(dest)
+            if self.update(now,dests):
+                self.trigger(now)
+        finally:
+            self.lock.release()
+
+    def get_routes(self):
+        """ Return a copy of the routing table, as a dictionary of
+        destination -> (cost,next hop), including unreachable routes
+        still in hold-down.
+        """
+        self.lock.acquire()
+        routes = dict(self.routes)
+        self.lock.release()
+        return routes
+
+    # private methods
+
+    def tick(self):
+        """ Expire silent neighbors and old unreachable routes, and
+        send the periodic update.
+        """
+        self.lock.acquire()
+        try:
+            if self.periodic == None:
+                return
+            now = time.time()
+            self.expire(now)
+            advertisements = self.advertisements(now,self.routes)
+            self.periodic = self.timers.schedule(now + self.period,
+                                                 self.tick)
+        finally:
+            self.lock.release()
+        self.advertise(advertisements)
+
+    def trigger(self,now):
+        """ Schedule a triggered update, unless one is already
+        scheduled.  Must be called with the lock held.
+        """
+        if self.triggered != None or self.periodic == None:
+            return
+        when = max(now,self.sent + self.damping)
+        self.triggered = self.timers.schedule(when,self.flush)
+
+    def flush(self):
+        """ Send a triggered update.
+        """
+        self.lock.acquire()
+        try:
+            if self.triggered == None:
+                return
+            self.triggered = None
+            advertisements = self.advertisements(time.time(),self.dirty)
+        finally:
+            self.lock.release()
+        self.advertise(advertisements)
+
+    def expire(self,now):
+        """ Drop neighbors not heard from for (timeout) seconds, and
+        forget unreachable routes whose hold-down has ended, taking
+        any other route to them that the neighbors have advertised.
+        Must be called with the lock held.
+        """
+        silent = [id for id in self.heard
+                  if now - self.heard[id] > self.timeout]
+        for id in silent:
+            if self.router.verbose:
+                print "[%s]: neighbor %s is down" % (self.router.id,id)
+            del self.heard[id]
+            del self.vectors[id]
+        if silent and self.update(now,self.routes):
+            self.trigger(now)
+        released = [dest for dest in self.held if self.held[dest] <= now]
+        for dest in released:
+            del self.held[dest]
+            if self.routes[dest][0] >= self.infinity:
+                del self.routes[dest]
+        if released and self.update(now,released):
+            self.trigger(now)
+
+    def update(self,now,dests):
+        """ Recompute the best route to each of (dests) from the
+        vectors of the live neighbors, and install the routes that
+        changed.  Returns True if the routing table changed.  Must be
+        called with the lock held.
+        """
+        changed = False
+        for dest in list(dests):
+            if dest == self.router.id:
+                continue
+            new = None
+            old = self.routes.get(dest)
+            for id,vector in self.vectors.iteritems():
+                if id == dest:
+                    cost = 1
+                elif dest in vector:
+                    cost = vector[dest] + 1
+                else:
+                    continue
+                if cost >= self.infinity:
+                    continue
+                # prefer the next hop already in use, so that equal
+                # cost routes do not flap
+                if new == None or cost < new[0] or \
+                        (cost == new[0] and old != None and id == old[1]):
+                    new = (cost,id)
+            if dest in self.held:
+                # while held down, only the old next hop may bring the
+                # route back
+                if new != None and new[1] != old[1]:
+                    new = None
+            if new == None:
+                if old == None or old[0] >= self.infinity:
+                    continue
+                new = (self.infinity,old[1])
+                self.held[dest] = now + self.holddown
+                self.router.delete_route(dest)
+                if self.router.verbose:
+                    print "[%s]: %s is unreachable" % (self.router.id,dest)
+            else:
+                if new == old:
+                    continue
+                if dest in self.held:
+                    del self.held[dest]
+                self.router.add_route(dest,new[1])
+                if self.router.verbose:
+                    print "[%s]: route to %s via %s, cost %d" % \
+                        (self.router.id,dest,new[1],new[0])
+            self.routes[dest] = new
+            self.dirty.add(dest)
+            changed = True
+        return changed
+
+    def advertisements(self,now,dests):
+        """ Return the advertisements of the routes to (dests) for each
+        neighbor, as a list of (id,packets), poisoning the routes that
+        go through that neighbor, and note that an update was sent at
+        (now).  Must be called with the lock held.
+        """
+        self.sent = now
+        routes = [(dest,self.routes[dest]) for dest in dests
+                  if dest in self.routes]
+        self.dirty = set()
+        advertisements = []
+        for id in self.router.get_neighbors():
+            lines = ["%s 0\n" % self.router.id]
+            for dest,(cost,next) in routes:
+                if next == id:
+                    cost = self.infinity
+                lines.append("%s %d\n" % (dest,cost))
+            packets = []
+            data = ""
+            for line in lines:
+                if len(data) + len(line) > ADVERTISEMENT_SIZE:
+                    packets.append(data)
+                    data = ""
+                data += line
+            packets.append(data)
+            advertisements.append((id,packets))
+        return advertisements
+
+    def advertise(self,advertisements):
+        """ Send (advertisements) to the neighbors.
+        """
+        for id,packets in advertisements:
+            for data in packets:
+                self.router.send_link(id,'dv',data)
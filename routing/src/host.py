@@ -0,0 +1,134 @@
+import errno
+import fcntl
+import heapq
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+import scheduler
+
+""" A host runs many routers from a single thread with an event loop,
+rather than a thread for each, so that a network of hundreds of
+routers is not slowed down by switching between as many threads.
+
+The host polls the UDP sockets of all its routers at once, and has
+each router handle the packets that arrive on its socket.  It is also
+a Scheduler, so that the timers of the routing protocols and the
+delayed packets of the routers run from the same loop, in between
+packets.  Other threads, such as the controller's, can still send
+packets and schedule calls; the host wakes when they do through a
+pipe that it polls along with the sockets.
+
+The host supports the public methods of a Scheduler, and also:
+
+* add(router)
+
+  Run (router) from the host.  The router's own thread must not be
+  started.
+
+"""
+
+# the most packets to handle from one socket before looking at the
+# others
+BATCH = 64
+
+class Host(scheduler.Scheduler):
+    """ Run routers and scheduled calls from an event loop.
+    """
+    def __init__(self):
+        """ Initialize the host with no routers.
+        """
+        scheduler.Scheduler.__init__(self)
+        # routers by the file number of their socket
+        self.routers = {}
+        self.poller = select.poll()
+        # a pipe written to by other threads to wake the loop; it never
+        # blocks the writer, since one byte in it is enough
+        self.waker,self.waking = os.pipe()
+        for fd in (self.waker,self.waking):
+            fcntl.fcntl(fd,fcntl.F_SETFL,
+                        fcntl.fcntl(fd,fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.waker,select.POLLIN)
+
+    # public methods
+
+    def add(self,router):
+        """ Run (router) from this host.
+        """
+        if not router.udp:
+            return
+        router.host = self
+        router.udp.setblocking(0)
+        fd = router.udp.fileno()
+        self.condition.acquire()
+        self.routers[fd] = router
+        self.poller.register(fd,select.POLLIN)
+        self.wake()
+        self.condition.release()
+
+    # private methods
+
+    def wake(self):
+        """ Wake the loop from polling, unless this is the loop.
+        """
+        if threading.current_thread() is self:
+            return
+        try:
+            os.write(self.waking,"w")
+        except OSError:
+            pass
+
+    def run(self):
+        """ Make each call when its time comes, and handle the packets
+        that arrive in between.
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                if not self.running:
+                    return
+                event = None
+                timeout = None
+                if self.events:
+                    delay = self.events[0][0] - time.time()
+                    if delay <= 0:
+                        event = heapq.heappop(self.events)
+                    else:
+                        timeout = int(delay*1000) + 1
+            finally:
+                self.condition.release()
+            if event:
+                when,sequence,function,args = event
+                self.call(function,args)
+                continue
+            for fd,flags in self.poller.poll(timeout):
+                if fd == self.waker:
+                    try:
+                        os.read(self.waker,4096)
+                    except OSError:
+                        pass
+                    continue
+                self.receive(self.routers[fd])
+
+    def receive(self,router):
+        """ Have (router) handle the packets waiting on its socket, up
+        to BATCH of them.
+        """
+        for i in range(BATCH):
+            try:
+                length,address = router.udp.recvfrom_into(router.buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return
+                print "[%s]: UDP socket failed" % (router.id)
+                print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
+                self.poller.unregister(router.udp.fileno())
+                return
+            try:
+                router.handle_buffer(length)
+            except:
+                print "[%s]: failed to handle a packet" % (router.id)
+                print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
@@ -0,0 +1,455 @@
+import heapq
+import threading
+import time
+
+import scheduler
+
+""" A link state routing protocol, in the style of OSPF.
+
+Each router says hello to its neighbors every (period) seconds, and
+considers a neighbor down when it has not heard from it for (timeout)
+seconds.  Whenever its set of live neighbors changes, and every
+(refresh) seconds besides, a router originates a link state
+advertisement (LSA) listing them, with a sequence number one higher
+than its last.  LSAs are flooded: a router that receives an LSA newer
+than the one it has from that origin stores it in its link state
+database (LSDB) and passes it on to its other neighbors, so that every
+router soon has the same database.  LSAs to be sent to a neighbor are
+held for up to (pacing) seconds and sent together, so that a burst of
+them takes a few packets rather than one each.  When a neighbor comes
+up, each side sends the other its whole database.  LSAs that have not been
+refreshed for three times (refresh) seconds are dropped.
+
+Packets for the protocol are 'ls' packets sent straight over the link,
+with one line per message:
+
+  hello
+  lsa origin sequence neighbor neighbor ...
+
+Every link costs 1, and a link is used only if both of its routers
+list the other, so a router that stops is cut off as soon as its
+neighbors notice, whatever its own last LSA says.
+
+Each router keeps a shortest path tree rooted at itself, computed with
+Dijkstra's algorithm using a heap.  When a link changes, only the part
+of the tree it affects is recomputed: a link that goes down detaches
+the subtree below it, whose routers are then reattached by running
+Dijkstra from the rest of the tree; a link that comes up relaxes the
+routers it brings closer, and their subtrees.  The first hop toward
+each router is installed in the router with add_route(), and routes to
+routers that can no longer be reached are removed with delete_route().
+
+The protocol's timers run on a Scheduler, which may be shared by the
+protocols of every router in the network.
+
+"""
+
+# the largest message sent in one packet, leaving room for the header
+# within the router's packet size
+PACKET_SIZE = 1400
+
+# the distance of a router that can not be reached
+INFINITE = float("inf")
+
+class LS:
+    """ Implements a link state routing protocol.
+    """
+    def __init__(self,router,timers=None,period=1.0,timeout=3.5,
+                 refresh=10.0,damping=0.1,pacing=0.02):
+        """ Initialize the protocol with the (router) object it is
+        attached to.  Register the protocol as a handler for the 'ls'
+        application identifier.  It starts once start() is called.
+
+        * timers   : the Scheduler to run timers on; by default the
+                     protocol starts one of its own
+        * period   : seconds between hellos
+        * timeout  : seconds after which a silent neighbor is down
+        * refresh  : seconds between periodic LSAs
+        * damping  : least seconds between LSAs
+        * pacing   : most seconds to hold LSAs to send together
+        """
+        self.router = router
+        if timers == None:
+            timers = scheduler.Scheduler()
+            timers.start()
+        self.timers = timers
+        self.period = period
+        self.timeout = timeout
+        self.refresh = refresh
+        self.damping = damping
+        self.pacing = pacing
+        self.lock = threading.Lock()
+        # live neighbors -> when they were last heard from; neighbors
+        # are taken to be up until they have had time to be heard from
+        self.heard = {}
+        # LSDB: origin -> (sequence,set of neighbors,time received)
+        self.lsdb = {}
+        self.sequence = 0
+        # shortest path tree: distance, parent and first hop of each
+        # reachable router, and the children of each router in the tree
+        self.distance = {self.router.id : 0}
+        self.parent = {}
+        self.first = {}
+        self.children = {}
+        # routes installed in the router: destination -> next hop; the
+        # router installed routes to its neighbors when the links were
+        # added
+        self.installed = {}
+        for id in self.router.get_neighbors():
+            self.installed[id] = id
+        # lines waiting to be sent to each neighbor
+        self.outbox = {}
+        # when our LSA was last originated, and the scheduled periodic,
+        # triggered and pacing timers
+        self.originated = 0
+        self.periodic = None
+        self.triggered = None
+        self.paced = None
+        self.router.register_handler('ls',self)
+
+    # public methods
+
+    def start(self):
+        """ Start the protocol.  The controller starts every router's
+        protocol once they have all registered, so that no message
+        finds its neighbor without a handler.
+        """
+        now = time.time()
+        self.lock.acquire()
+        for id in self.router.get_neighbors():
+            self.heard[id] = now
+        self.full()
+        self.periodic = self.timers.schedule(now,self.tick)
+        self.lock.release()
+
+    def quit(self):
+        """ Stop the protocol.
+        """
+        self.lock.acquire()
+        for event in (self.periodic,self.triggered,self.paced):
+            if event != None:
+                self.timers.cancel(event)
+        self.periodic = None
+        self.triggered = None
+        self.paced = None
+        self.lock.release()
+
+    def receive(self,id,data,path):
+        """ Receive hellos and LSAs from neighbor (id) stored in
+        (data).
+        """
+        if id not in self.router.links:
+            return
+        self.lock.acquire()
+        try:
+            if self.periodic == None:
+                return
+            now = time.time()
+            changes = []
+            if id not in self.heard:
+                # the neighbor came up: bring it up to date
+                changes.append((self.router.id,id))
+                self.queue(id,self.database())
+                self.trigger(now)
+            self.heard[id] = now
+            flood = []
+            for line in data.split("\n"):
+                fields = line.split()
+                if len(fields) < 3 or fields[0] != "lsa":
+                    continue
+                try:
+                    origin = fields[1]
+                    sequence = int(fields[2])
+                except ValueError:
+                    continue
+                if origin == self.router.id:
+                    # an old LSA of ours, from before a restart
+                    if sequence >= self.sequence:
+                        self.sequence = sequence
+                        self.trigger(now)
+                    continue
+                if origin in self.lsdb and self.lsdb[origin][0] >= sequence:
+                    continue
+                changes.extend(self.install(origin,sequence,set(fields[3:]),
+                                            now))
+                flood.append(line + "\n")
+            self.spf(changes)
+            if flood:
+                for neighbor in self.heard:
+                    if neighbor != id:
+                        self.queue(neighbor,flood)
+        finally:
+            self.lock.release()
+
+    def get_routes(self):
+        """ Return a copy of the routing table, as a dictionary of
+        destination -> (cost,next hop).
+        """
+        self.lock.acquire()
+        routes = dict([(dest,(self.distance[dest],self.first[dest]))
+                       for dest in self.first])
+        self.lock.release()
+        return routes
+
+    # private methods
+
+    def tick(self):
+        """ Say hello, expire silent neighbors and old LSAs, and
+        refresh our LSA when it is due.
+        """
+        sends = []
+        self.lock.acquire()
+        try:
+            if self.periodic == None:
+                return
+            now = time.time()
+            changes = []
+            for id in [id for id in self.heard
+                       if now - self.heard[id] > self.timeout]:
+                if self.router.verbose:
+                    print "[%s]: neighbor %s is down" % (self.router.id,id)
+                del self.heard[id]
+                changes.append((self.router.id,id))
+            if changes:
+                self.trigger(now)
+            for origin in [origin for origin in self.lsdb
+                           if now - self.lsdb[origin][2] > 3*self.refresh]:
+                changes.extend(self.install(origin,None,set(),now))
+            self.spf(changes)
+            if now - self.originated >= self.refresh:
+                self.originate(now)
+            for id in self.router.get_neighbors():
+                sends.append((id,["hello\n"]))
+            self.periodic = self.timers.schedule(now + self.period,self.tick)
+        finally:
+            self.lock.release()
+        self.send(sends)
+
+    def trigger(self,now):
+        """ Schedule our LSA to be originated, unless it already is.
+        Must be called with the lock held.
+        """
+        if self.triggered != None or self.periodic == None:
+            return
+        self.triggered = self.timers.schedule(
+            max(now,self.originated + self.damping),self.flush)
+
+    def flush(self):
+        """ Originate our LSA, as triggered.
+        """
+        self.lock.acquire()
+        try:
+            if self.triggered == None:
+                return
+            self.triggered = None
+            self.originate(time.time())
+        finally:
+            self.lock.release()
+
+    def originate(self,now):
+        """ Make a new LSA listing our live neighbors, and flood it.
+        Must be called with the lock held.
+        """
+        self.sequence += 1
+        self.originated = now
+        line = "lsa %s %d %s\n" % (self.router.id,self.sequence,
+                                   " ".join(sorted(self.heard)))
+        for id in self.heard:
+            self.queue(id,[line])
+
+    def queue(self,id,lines):
+        """ Queue (lines) to be sent to neighbor (id) when the pacing
+        timer runs out.  Must be called with the lock held.
+        """
+        self.outbox.setdefault(id,[]).extend(lines)
+        if self.paced == None:
+            self.paced = self.timers.schedule(time.time() + self.pacing,
+                                              self.pace)
+
+    def pace(self):
+        """ Send the queued lines.
+        """
+        self.lock.acquire()
+        try:
+            if self.paced == None:
+                return
+            self.paced = None
+            outbox = self.outbox
+            self.outbox = {}
+        finally:
+            self.lock.release()
+        self.send(outbox.items())
+
+    def database(self):
+        """ Return the whole LSDB, and our own LSA, as lines.  Must be
+        called with the lock held.
+        """
+        lines = ["lsa %s %d %s\n" % (self.router.id,self.sequence,
+                                     " ".join(sorted(self.heard)))]
+        for origin,(sequence,neighbors,received) in self.lsdb.iteritems():
+            lines.append("lsa %s %d %s\n" % (origin,sequence,
+                                             " ".join(sorted(neighbors))))
+        return lines
+
+    def install(self,origin,sequence,neighbors,now):
+        """ Store the LSA of (origin), or drop it if (sequence) is None,
+        and return the links whose state may have changed.  Must be
+        called with the lock held.
+        """
+        old = set()
+        if origin in self.lsdb:
+            old = self.lsdb[origin][1]
+        if sequence == None:
+            del self.lsdb[origin]
+        else:
+            self.lsdb[origin] = (sequence,neighbors,now)
+        return [(origin,id) for id in old ^ neighbors]
+
+    def linked(self,a,b):
+        """ Return True if there is a working link between (a) and (b):
+        for our own links, if the neighbor is live; for others, if the
+        LSAs of both routers list the other.  Must be called with the
+        lock held.
+        """
+        if a == self.router.id:
+            return b in self.heard
+        if b == self.router.id:
+            return a in self.heard
+        return a in self.lsdb and b in self.lsdb[a][1] and \
+            b in self.lsdb and a in self.lsdb[b][1]
+
+    def adjacent(self,id):
+        """ Return the routers with a working link to (id).  Must be
+        called with the lock held.
+        """
+        if id == self.router.id:
+            return self.heard.keys()
+        if id not in self.lsdb:
+            return []
+        return [other for other in self.lsdb[id][1]
+                if self.linked(id,other)]
+
+    def spf(self,changes):
+        """ Update the shortest path tree for the links in (changes),
+        and install the routes that changed.  Must be called with the
+        lock held.
+        """
+        if not changes:
+            return
+        touched = set()
+        heap = []
+        for a,b in changes:
+            if self.linked(a,b):
+                # the link came up: it may bring either end closer
+                for u,v in ((a,b),(b,a)):
+                    if u in self.distance and \
+                            self.distance[u] + 1 < self.distance.get(v,INFINITE):
+                        heapq.heappush(heap,(self.distance[u] + 1,v,u))
+            else:
+                # the link went down: if it was in the tree, the subtree
+                # below it must be reattached
+                for u,v in ((a,b),(b,a)):
+                    if self.parent.get(v) == u:
+                        self.detach(v,heap,touched)
+        self.dijkstra(heap,touched)
+        self.install_routes(touched)
+
+    def full(self):
+        """ Compute the whole shortest path tree, when the protocol
+        starts.  Must be called with the lock held.
+        """
+        touched = set(self.distance)
+        self.distance = {self.router.id : 0}
+        self.parent = {}
+        self.first = {}
+        self.children = {}
+        heap = [(1,id,self.router.id) for id in self.heard]
+        heapq.heapify(heap)
+        self.dijkstra(heap,touched)
+        touched.update(self.installed)
+        self.install_routes(touched)
+
+    def detach(self,root,heap,touched):
+        """ Remove the subtree under (root) from the shortest path tree,
+        and push on the (heap) the best way back into the tree for each
+        of its routers.  Must be called with the lock held.
+        """
+        subtree = [root]
+        for id in subtree:
+            subtree.extend(self.children.get(id,()))
+        self.children[self.parent[root]].discard(root)
+        for id in subtree:
+            del self.distance[id]
+            del self.parent[id]
+            del self.first[id]
+            if id in self.children:
+                del self.children[id]
+        touched.update(subtree)
+        for id in subtree:
+            for other in self.adjacent(id):
+                if other in self.distance:
+                    heapq.heappush(heap,(self.distance[other] + 1,id,other))
+
+    def dijkstra(self,heap,touched):
+        """ Run Dijkstra's algorithm from the entries (distance,router,
+        parent) on the (heap), adding the routers whose place in the
+        tree changes to (touched).  Must be called with the lock held.
+        """
+        root = self.router.id
+        while heap:
+            distance,id,parent = heapq.heappop(heap)
+            if distance >= self.distance.get(id,INFINITE):
+                continue
+            # the parent may have moved, or left the tree, since this
+            # entry was pushed
+            if self.distance.get(parent,INFINITE) + 1 != distance:
+                continue
+            if id in self.parent:
+                self.children[self.parent[id]].discard(id)
+            self.distance[id] = distance
+            self.parent[id] = parent
+            self.children.setdefault(parent,set()).add(id)
+            if parent == root:
+                self.first[id] = id
+            else:
+                self.first[id] = self.first[parent]
+            touched.add(id)
+            for other in self.adjacent(id):
+                if distance + 1 < self.distance.get(other,INFINITE):
+                    heapq.heappush(heap,(distance + 1,other,id))
+
+    def install_routes(self,touched):
+        """ Install the routes to the (touched) routers that changed.
+        Must be called with the lock held.
+        """
+        for dest in touched:
+            if dest == self.router.id:
+                continue
+            next = self.first.get(dest)
+            if next == self.installed.get(dest):
+                continue
+            if next == None:
+                del self.installed[dest]
+                self.router.delete_route(dest)
+                if self.router.verbose:
+                    print "[%s]: %s is unreachable" % (self.router.id,dest)
+            else:
+                self.installed[dest] = next
+                self.router.add_route(dest,next)
+                if self.router.verbose:
+                    print "[%s]: route to %s via %s, cost %d" % \
+                        (self.router.id,dest,next,self.distance[dest])
+
+    def send(self,sends):
+        """ Send each list of lines in (sends) to its neighbor, in as
+        few packets as they fit in.
+        """
+        for id,lines in sends:
+            data = ""
+            for line in lines:
+                if data and len(data) + len(line) > PACKET_SIZE:
+                    self.router.send_link(id,'ls',data)
+                    data = ""
+                data += line
+            if data:
+                self.router.send_link(id,'ls',data)
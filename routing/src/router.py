@@ -1,4 +1,7 @@
+import heapq
+import itertools
 import socket
+import struct
 import sys
 import threading
 import time
@@ -7,25 +10,51 @@ import time
 is identified by a text identifier (id) and listens for incoming
 packets on a UDP socket using the provided (address) and (port).
 
-When routers send packets, they include the following header:
+When routers send packets, they include a header with the identifier
+of the source router (from_id), the identifier of the destination
+router (to_id), and a text identifier for the application (app) that
+the packet should be delivered to, once it reaches the destination
+router.  The header is binary:
+
+  magic flags from to app hops
+
+packed in network byte order as 1, 1, 2, 2, 2 and 1 bytes.  The router
+and application identifiers are interned: each is given a number the
+first time it is seen, from a table shared by every router in the
+process, which is how the controller runs them; routers in different
+processes do not share the table, and must use text headers to talk
+to each other.  Routers forward a binary packet without copying or
+parsing anything but its header, and drop one too short to hold it.
+
+Routers created with (binary) False send the text header of earlier
+versions instead:
 
   vr from_id to_id app
 
-The (from_id) is the identifier of the source router and the (to_id)
-is the identifier of the destination router.  The (app) is a text
-identifier for the application that the packet should be delivered to,
-once it reaches the destination router.
+and every router handles both, forwarding each packet in the format it
+arrived in.
 
 To send a packet to the next hop, a router looks up the (address) and
-(port) of the next hop and sends a UDP packet.  Each time a router
-forwards a packet, it adds 50 ms seconds of delay, so that the RTT for
-a message on a path of length n hops is n*100 ms.
+(port) of the next hop and sends a UDP packet once the delay of the
+link to it has passed.  Links have a delay of 50 ms unless given
+another, so that the RTT for a message on a path of length n hops is
+n*100 ms.  Packets waiting out their delay are kept in a heap, which
+the router's thread sends from when they are due, so a router can have
+any number of packets in flight at once.  A router can instead be run
+by a Host, along with many others, in which case the host's loop
+receives its packets and sends its delayed ones, and the router's own
+thread is never started.
 
 The router also supports path tracing, similar to traceroute.  If
-requested by the application, the router adds a "trace" header to the
-packet, and accumulates the list of router ids that the packet follows
-while it is being forwarded. This path is given to the receiving
-application in the receive() method.
+requested by the application, the router adds a trace to the packet,
+and accumulates the list of router ids that the packet follows while
+it is being forwarded. This path is given to the receiving application
+in the receive() method, as "trace id id ...".  In a binary packet the
+trace is a field of MAX_HOPS two byte router numbers after the header,
+of which (hops) are used, and each router writes its number into the
+next slot in place; a packet that has followed more than MAX_HOPS
+routers records only the first of them.  In a text packet it is a
+second header line, "trace id id ...".
 
 The router supports the following public methods:
 
@@ -50,13 +79,15 @@ The router supports the following public methods:
 
   Returns the next hop identifier for the route to destination (id).
 
-* add_link(id,address,port)
+* add_link(id,address,port,delay)
 
   Adds a link from this router to the neighbor identified by (id).
   The (address) and (port) identify the UDP socket on which the
-  neighbor is listening.  This is used when forwarding packets to that
-  router.  This method should only be called by the controller that
-  sets up the network and NOT by the routing protocol.
+  neighbor is listening.  The optional (delay) is the delay of the
+  link in seconds, which otherwise is the router's default (delay).
+  This is used when forwarding packets to that router.  This method
+  should only be called by the controller that sets up the network and
+  NOT by the routing protocol.
 
 * get_neighbors()
 
@@ -70,6 +101,13 @@ The router supports the following public methods:
   The (trace) parameter is a boolean that indicates whether to trace
   the route.
 
+* send_link(id,app,data)
+
+  Send a packet straight over the link to the neighbor (id), without
+  consulting the forwarding table.  This is for routing protocols,
+  which must reach their neighbors even when they have no route to
+  them.
+
 * stop()
 
   Stop handling packets.  This is useful for simulating a failed
@@ -85,37 +123,95 @@ The router supports the following public methods:
 
 """
 
+# the first byte of a binary packet; text packets start with "v"
+MAGIC = 0xb5
+
+# binary header: magic, flags, from, to, app, hops
+HEADER = struct.Struct("!BBHHHB")
+HOPS = HEADER.size - 1
+
+# flags
+TRACE = 1
+
+# the trace field of a binary packet
+HOP = struct.Struct("!H")
+MAX_HOPS = 32
+TRACE_SIZE = MAX_HOPS*HOP.size
+
+# interned router and application identifiers: number -> id and
+# id -> number, shared by every router in the process
+names = []
+numbers = {}
+names_sem = threading.Semaphore()
+
+def intern_id(id):
+    """ Return the number of router or application identifier (id),
+    giving it the next one if it has none yet.
+    """
+    number = numbers.get(id)
+    if number != None:
+        return number
+    names_sem.acquire()
+    if id not in numbers:
+        if len(names) > 0xffff:
+            names_sem.release()
+            raise ValueError("too many identifiers to intern")
+        numbers[id] = len(names)
+        names.append(id)
+    number = numbers[id]
+    names_sem.release()
+    return number
+
 class Router(threading.Thread):
     """ Emulate a router by sending UDP packets.
     """
-    def __init__(self,id,address,port,verbose):
+    def __init__(self,id,address,port,verbose,binary=True):
         """ Initialize the router using:
 
         * id       : text identifier of the router
         * address  : IP address for the UDP socket
         * port     : port for the UDP socket
         * verbose  : turn on debugging
+        * binary   : send binary headers rather than text
         """
         threading.Thread.__init__(self)
         threading.Thread.daemon = True
         self.id = id
+        self.number = intern_id(id)
+        self.binary = binary
         self.address = address
         self.port = port
         self.verbose = verbose
+        # seconds of delay of links not given one
+        self.delay = 0.05
         # handlers
         self.handlers = {}
-        # links
+        # links, and their delays
         self.links = {}
-        # forwarding table
+        self.link_delays = {}
+        # forwarding table, and the same routes by the number of the
+        # destination, for forwarding binary packets
         self.forwarding = {}
-        self.forwarding_sem = threading.Semaphore()
+        self.next_hops = {}
+        # locks rather than semaphores, since they are taken for every
+        # packet and a lock costs a fraction as much
+        self.forwarding_sem = threading.Lock()
         # UDP socket variables
         self.size = 1500
+        self.buffer = bytearray(self.size)
         self.udp = None
         self.running = True
         self.handling = True
         self.create_socket()
-        self.udp_sem = threading.Semaphore()
+        self.udp_sem = threading.Lock()
+        # packets waiting out the delay of their link: a heap of
+        # (time due,sequence,address,port,packet)
+        self.delayed = []
+        self.delayed_sem = threading.Lock()
+        self.sequence = itertools.count()
+        # the Host that runs this router instead of its own thread, if
+        # any; it also runs the delayed packets
+        self.host = None
 
     # public methods
 
@@ -130,6 +226,8 @@ class Router(threading.Thread):
         """
         self.forwarding_sem.acquire()
         self.forwarding[id] = next
+        if next in self.links:
+            self.next_hops[intern_id(id)] = next
         self.forwarding_sem.release()
 
     def delete_route(self,id):
@@ -138,6 +236,7 @@ class Router(threading.Thread):
         self.forwarding_sem.acquire()
         if id in self.forwarding:
             del self.forwarding[id]
+        self.next_hops.pop(intern_id(id),None)
         self.forwarding_sem.release()
 
     def get_route(self,id):
@@ -151,11 +250,14 @@ class Router(threading.Thread):
         self.forwarding_sem.release()
         return next
 
-    def add_link(self,id,address,port):
+    def add_link(self,id,address,port,delay=None):
         """ Add a link to the neighbor router identified by (id) and
-        listening with a UDP socket using (address) and (port).
+        listening with a UDP socket using (address) and (port), with a
+        (delay) in seconds, or the router's default delay if None.
         """
-        self.links[id] = (address,port)
+        # resolve the address once, rather than for every packet sent
+        self.links[id] = (socket.gethostbyname(address),port)
+        self.link_delays[id] = delay
         self.add_route(id,id)
 
     def get_neighbors(self):
@@ -168,12 +270,37 @@ class Router(threading.Thread):
         """ Send a packet of (data) to the (app) listening on
         destination router (id).
         """
+        if self.binary:
+            flags = 0
+            if trace:
+                flags = TRACE
+            packet = bytearray(HEADER.pack(MAGIC,flags,self.number,
+                                           intern_id(id),intern_id(app),0))
+            if trace:
+                packet += bytearray(TRACE_SIZE)
+            packet += data
+            self.handle_binary(packet,len(packet))
+            return
         packet = "vr %s %s %s\n" % (self.id,id,app)
         if trace:
             packet += "trace\n"
         packet += data
         self.handle(packet)
 
+    def send_link(self,id,app,data):
+        """ Send a packet of (data) to the (app) listening on neighbor
+        (id), over the link to it.
+        """
+        if not self.handling:
+            return
+        address,port = self.links[id]
+        if self.binary:
+            packet = HEADER.pack(MAGIC,0,self.number,intern_id(id),
+                                 intern_id(app),0)
+        else:
+            packet = "vr %s %s %s\n" % (self.id,id,app)
+        self.send(address,port,packet + data)
+
     def stop(self):
         """ Stop this router from handling any packets.
         """
@@ -188,6 +315,7 @@ class Router(threading.Thread):
         """ Quit the router.
         """
         self.running = False
+        self.wake()
 
     # private methods
 
@@ -198,11 +326,15 @@ class Router(threading.Thread):
             self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.udp.bind((self.address,self.port))
             self.udp.settimeout(1)
+            self.udp_address = self.udp.getsockname()
         except:
             print "[%s]: can't create UDP socket" % (self.id)
             print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
             if self.udp:
                 self.udp.close()
+            # a router without a socket handles nothing, and has no
+            # thread to wake
+            self.udp = None
 
     def run(self):
         """ Run this router in a thread, handling all incoming UDP
@@ -211,8 +343,15 @@ class Router(threading.Thread):
         if not self.udp:
             return
         while self.running:
+            # wait for a packet, but no longer than until the next
+            # delayed packet is due
+            due = self.send_delayed()
+            if due == None:
+                self.udp.settimeout(1)
+            else:
+                self.udp.settimeout(min(max(due - time.time(),0.001),1))
             try:
-                packet,address = self.udp.recvfrom(self.size)
+                length,address = self.udp.recvfrom_into(self.buffer)
             except socket.timeout:
                 continue
             except:
@@ -220,12 +359,23 @@ class Router(threading.Thread):
                 print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
                 self.running = False
                 continue
-            self.handle(packet)
+            self.handle_buffer(length)
+
+    def handle_buffer(self,length):
+        """ Handle the packet of (length) bytes received into the
+        buffer, in whichever format it is.
+        """
+        if length == 0:
+            return
+        if self.buffer[0] == MAGIC:
+            self.handle_binary(self.buffer,length)
+        else:
+            self.handle(str(self.buffer[:length]))
 
     def handle(self,packet):
-        """ Handle the (packet).  Deliver to a local application if its
-        destination id is the same as mine.  Otherwise, forward it to
-        the next hop.
+        """ Handle the text (packet).  Deliver to a local application
+        if its destination id is the same as mine.  Otherwise, forward
+        it to the next hop.
         """
         if not self.handling:
             return
@@ -243,24 +393,81 @@ class Router(threading.Thread):
             self.deliver(from_id,app,packet[index+1:])
             return
         # forward data that is not addressed to me
-        time.sleep(0.05)
         self.forward(to_id,packet)
 
+    def handle_binary(self,packet,length):
+        """ Handle the binary packet in the first (length) bytes of the
+        bytearray (packet), as handle() does a text packet.  Only the
+        header is read, and the trace is added to in place.
+        """
+        if not self.handling:
+            return
+        # the buffer holds whatever the last longer packet left in it
+        if length < HEADER.size:
+            self.drop_short(length)
+            return
+        magic,flags,from_n,to_n,app_n,hops = HEADER.unpack_from(packet)
+        if flags & TRACE and length < HEADER.size + TRACE_SIZE:
+            self.drop_short(length)
+            return
+        if flags & TRACE and hops < MAX_HOPS:
+            HOP.pack_into(packet,HEADER.size + hops*HOP.size,self.number)
+            hops += 1
+            packet[HOPS] = hops
+        # deliver data that is addressed to me
+        if to_n == self.number:
+            offset = HEADER.size
+            path = None
+            if flags & TRACE:
+                offset += TRACE_SIZE
+                path = "trace " + " ".join(
+                    [names[HOP.unpack_from(packet,HEADER.size + i*HOP.size)[0]]
+                     for i in range(hops)])
+            self.dispatch(names[from_n],names[app_n],
+                          str(packet[offset:length]),path)
+            return
+        # forward data that is not addressed to me; a single lookup in
+        # a dictionary is atomic, so this needs no lock
+        next = self.next_hops.get(to_n)
+        if not next:
+            print "[%s]: no route for id %s" % (self.id,names[to_n])
+            return
+        if self.verbose:
+            print "[%s]: forwarding packet for %s to %s" % \
+                (self.id,names[to_n],next)
+        if length < len(packet):
+            packet = buffer(packet,0,length)
+        self.transmit(next,packet)
+
+    def drop_short(self,length):
+        """ Drop a binary packet of (length) bytes, too short for its
+        header.
+        """
+        if self.verbose:
+            print "[%s]: dropping a short packet of %d bytes" % \
+                (self.id,length)
+
     def deliver(self,from_id,app,data):
         """ Deliver the (data) to a listening (app).  The (from_id) is
         the id of the router that sent the packet.  The (data) has the
         header removed already.
         """
-        # find the application
-        if app not in self.handlers:
-            print "[%s]: no handler for application %s" % (self.id,app)
-            return
         # get trace
         path = None
         if data.startswith("trace"):
             index = data.find("\n")
             path = data[:index]
             data = data[index+1:]
+        self.dispatch(from_id,app,data,path)
+
+    def dispatch(self,from_id,app,data,path):
+        """ Give the (data) and the (path) it took to a listening
+        (app).
+        """
+        # find the application
+        if app not in self.handlers:
+            print "[%s]: no handler for application %s" % (self.id,app)
+            return
         # deliver the data
         if self.verbose:
             print "[%s]: delivering packet to %s" % (self.id,app)
@@ -274,16 +481,74 @@ class Router(threading.Thread):
         if not next:
             print "[%s]: no route for id %s" % (self.id,id)
             return
-        address,port = self.links[next]
         if self.verbose:
             print "[%s]: forwarding packet for %s to %s" % (self.id,id,next)
         # send the packet
-        self.send(address,port,packet)
+        self.transmit(next,packet)
+
+    def transmit(self,next,packet):
+        """ Send a (packet) to the neighbor (next) when the delay of
+        the link to it has passed.
+        """
+        address,port = self.links[next]
+        delay = self.link_delays[next]
+        if delay == None:
+            delay = self.delay
+        if delay <= 0:
+            self.send(address,port,packet)
+            return
+        # copy the packet, which may be in the receive buffer
+        if self.host:
+            self.host.schedule(time.time() + delay,self.send_due,
+                               address,port,str(packet))
+            return
+        entry = (time.time() + delay,self.sequence.next(),address,port,
+                 str(packet))
+        self.delayed_sem.acquire()
+        heapq.heappush(self.delayed,entry)
+        first = self.delayed[0] is entry
+        self.delayed_sem.release()
+        # the router's thread may be waiting for a later packet
+        if first and threading.current_thread() is not self:
+            self.wake()
+
+    def send_delayed(self):
+        """ Send the delayed packets that are due, and return when the
+        next one will be, or None if there are none.
+        """
+        while True:
+            self.delayed_sem.acquire()
+            if not self.delayed:
+                self.delayed_sem.release()
+                return None
+            if self.delayed[0][0] > time.time():
+                due = self.delayed[0][0]
+                self.delayed_sem.release()
+                return due
+            due,sequence,address,port,packet = heapq.heappop(self.delayed)
+            self.delayed_sem.release()
+            self.send_due(address,port,packet)
+
+    def send_due(self,address,port,packet):
+        """ Send a delayed (packet) to (address) and (port), unless the
+        router was stopped in the meantime.
+        """
+        if self.handling:
+            self.send(address,port,packet)
+
+    def wake(self):
+        """ Wake the router's thread from waiting for a packet, with an
+        empty packet to itself.
+        """
+        if self.udp:
+            self.udp.sendto("",self.udp_address)
 
     def send(self,address,port,packet):
         """ Send a (packet) to a neighbor router listening on a UDP
         socket identified by (address) and (port).
         """
+        if not self.udp:
+            return
         self.udp_sem.acquire()
         self.udp.sendto(packet,(address,port))
         self.udp_sem.release()
@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+""" A scheduler runs functions at given times, all from one thread,
+so that many routers and protocols can have timers without a thread
+each.  The functions should be quick, since each one delays those
+after it.
+
+The scheduler supports the following public methods:
+
+* schedule(when,function,*args)
+
+  Call (function) with (args) at time (when), as given by
+  time.time().  Returns an event that can be given to cancel().
+
+* cancel(event)
+
+  Cancel a call that has not happened yet.
+
+* quit()
+
+  Stop the scheduler, dropping any calls not yet made.
+
+"""
+
+class Scheduler(threading.Thread):
+    """ Run scheduled calls from a thread.
+    """
+    def __init__(self):
+        """ Initialize the scheduler with no calls scheduled.
+        """
+        threading.Thread.__init__(self)
+        threading.Thread.daemon = True
+        # heap of [when,sequence,function,args]; the sequence keeps
+        # calls scheduled for the same time in order
+        self.events = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+    # public methods
+
+    def schedule(self,when,function,*args):
+        """ Call (function) with (args) at time (when).  Returns the
+        event, for cancel().
+        """
+        event = [when,self.sequence.next(),function,args]
+        self.condition.acquire()
+        heapq.heappush(self.events,event)
+        # wake the thread if this is now the first call
+        if self.events[0] is event:
+            self.wake()
+        self.condition.release()
+        return event
+
+    def cancel(self,event):
+        """ Cancel the scheduled (event).
+        """
+        self.condition.acquire()
+        event[2] = None
+        self.condition.release()
+
+    def quit(self):
+        """ Quit the scheduler.
+        """
+        self.condition.acquire()
+        self.running = False
+        self.wake()
+        self.condition.release()
+        if self.is_alive():
+            self.join()
+
+    # private methods
+
+    def wake(self):
+        """ Wake the thread to look at the first call again.  Must be
+        called with the condition held.
+        """
+        self.condition.notify()
+
+    def run(self):
+        """ Make each call when its time comes.
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                while self.running:
+                    if not self.events:
+                        self.condition.wait()
+                        continue
+                    delay = self.events[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if not self.running:
+                    return
+                when,sequence,function,args = heapq.heappop(self.events)
+            finally:
+                self.condition.release()
+            self.call(function,args)
+
+    def call(self,function,args):
+        """ Call (function) with (args), unless it was cancelled,
+        reporting rather than raising any exception.
+        """
+        if function == None:
+            return
+        try:
+            function(*args)
+        except:
+            print "scheduler: call to %s failed" % (function.__name__)
+            print "Error: ",sys.exc_info()[0],sys.exc_info()[1]
@@ -0,0 +1,70 @@
+import optparse
+import random
+
+""" Generates network configuration files for the controller.
+
+"python topology.py --routers 200 --degree 3 > big.conf" writes a
+random connected network of 200 routers, numbered r0, r1, ... and
+listening on consecutive ports, with links chosen so that each router
+has about (degree) neighbors on average: first a random spanning tree,
+so that every router can reach every other, and then random extra
+links.  The same (seed) always gives the same network.
+
+"""
+
+def generate(routers,degree,address,port,seed):
+    """ Return the lines of a configuration file for a random
+    connected network of (routers) routers with an average (degree),
+    listening on (address) starting at (port).
+    """
+    rng = random.Random(seed)
+    ids = ["r%d" % i for i in range(routers)]
+    lines = ["# routers in the network: (id) (host) (port)\n"]
+    for i,id in enumerate(ids):
+        lines.append("router %s %s %d\n" % (id,address,port + i))
+    links = set()
+    # a random spanning tree
+    for i in range(1,routers):
+        links.add((rng.randrange(i),i))
+    # extra links, up to the average degree
+    wanted = min(routers*degree/2,routers*(routers - 1)/2)
+    while len(links) < wanted:
+        a = rng.randrange(routers)
+        b = rng.randrange(routers)
+        if a == b:
+            continue
+        links.add((min(a,b),max(a,b)))
+    lines.append("# links in the network: (id) (id)\n")
+    for a,b in sorted(links):
+        lines.append("link %s %s\n" % (ids[a],ids[b]))
+    return lines
+
+def parse_options():
+    """ Parse command line options. """
+    parser = optparse.OptionParser(usage = "%prog [options]",
+                                   version = "%prog 0.1")
+
+    parser.add_option("-r","--routers",type="int",dest="routers",
+                      default=100,
+                      help="number of routers")
+    parser.add_option("-d","--degree",type="int",dest="degree",
+                      default=3,
+                      help="average number of neighbors of a router")
+    parser.add_option("-a","--address",type="string",dest="address",
+                      default="localhost",
+                      help="address the routers listen on")
+    parser.add_option("-p","--port",type="int",dest="port",
+                      default=5000,
+                      help="port of the first router")
+    parser.add_option("-s","--seed",type="int",dest="seed",
+                      default=1,
+                      help="seed for the random network")
+
+    (options,args) = parser.parse_args()
+    return options
+
+if __name__ == "__main__":
+    options = parse_options()
+    for line in generate(options.routers,options.degree,options.address,
+                         options.port,options.seed):
+        print line,